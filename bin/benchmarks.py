@@ -0,0 +1,391 @@
+"""
+Micro-benchmarks for the hot paths of enumeration and training.
+
+Usage: python bin/benchmarks.py <benchmark>[:<argument>...] [<benchmark>[:<argument>...] ...]
+Run without arguments to see the available benchmarks.
+"""
+try:
+    import binutil  # required to import from dreamcoder modules
+except ModuleNotFoundError:
+    import bin.binutil  # alt import if called as module
+
+import sys
+import time
+
+from dreamcoder.grammar import Grammar
+from dreamcoder.type import Context, arrow, tint, tlist
+
+
+def listGrammar():
+    from dreamcoder.domains.list.listPrimitives import bootstrapTarget
+    return Grammar.uniform(bootstrapTarget())
+
+
+class ListContext(Context):
+    """The original type context, whose substitution is a list that extend copies and lookup scans"""
+    substitution = None
+
+    def __init__(self, nextVariable=0, substitution=[]):
+        self.nextVariable = nextVariable
+        self.substitution = substitution
+
+    def lookup(self, j):
+        for v, t in self.substitution:
+            if v == j:
+                return t
+        return None
+
+    def __len__(self): return len(self.substitution)
+
+    def _withNextVariable(self, nextVariable):
+        return ListContext(nextVariable, self.substitution)
+
+    def extend(self, j, t):
+        return ListContext(self.nextVariable, [(j, t)] + self.substitution)
+
+
+def bestOf(n, f):
+    """Fastest of n runs of f, in seconds"""
+    times = []
+    for _ in range(n):
+        startTime = time.time()
+        f()
+        times.append(time.time() - startTime)
+    return min(times)
+
+
+def typeContext(budget=10.5):
+    """Candidates per second built during enumeration from a list grammar, and likelihood summaries per second
+    of ever larger programs, for both implementations of Context"""
+    from dreamcoder.program import Program
+
+    g = listGrammar()
+    # Measure the contexts themselves, not the candidate cache
+    g.candidateCacheSize = 0
+    requests = [arrow(tlist(tint), tlist(tint)), arrow(tlist(tint), tint), arrow(tint, tlist(tint))]
+    # Nested maps: every map introduces fresh type variables, so the substitution grows with the program
+    def nestedMaps(n):
+        body = "$0"
+        for _ in range(n):
+            body = "(map (lambda (+ $0 1)) %s)" % body
+        return Program.parse("(lambda %s)" % body)
+
+    for name, empty in [("list substitution", ListContext(0, [])),
+                        ("trie substitution", Context.EMPTY)]:
+        candidates = 0
+        programs = 0
+        buildCandidates = g.buildCandidates
+        def counting(*a, **k):
+            nonlocal candidates
+            cs = buildCandidates(*a, **k)
+            candidates += len(cs)
+            return cs
+        g.buildCandidates = counting
+        def enumerate():
+            nonlocal programs
+            for request in requests:
+                for _ in g.enumeration(empty, [], request, maximumDepth=99, upperBound=budget):
+                    programs += 1
+        dt = bestOf(3, enumerate)
+        del g.buildCandidates
+        print("%s: %d candidates for %d programs; %.0f candidates/second" %
+              (name, candidates // 3, programs // 3, candidates / 3 / dt))
+
+        for n in [5, 20, 80]:
+            p = nestedMaps(n)
+            request = arrow(tlist(tint), tlist(tint))
+            k, summary = g.likelihoodSummary(empty, [], request, p)
+            assert summary is not None
+            dt = bestOf(3, lambda: g.likelihoodSummary(empty, [], request, p))
+            print("\t%d nested maps (%d type variables bound): %.0f likelihood summaries/second" %
+                  (n, len(k), 1. / dt))
+
+
+def candidateCache(budget=10.5, samples=2000):
+    """Enumeration, likelihood summaries and sampling from a list grammar, with and without the buildCandidates cache"""
+    import random
+    requests = [arrow(tlist(tint), tlist(tint)), arrow(tlist(tint), tint), arrow(tint, tlist(tint))]
+
+    for size in [0, Grammar.candidateCacheSize]:
+        g = listGrammar()
+        g.candidateCacheSize = size
+        programs = []
+        def enumerate():
+            del programs[:]
+            for request in requests:
+                context, request = request.instantiate(Context.EMPTY)
+                for _, _, p in g.enumeration(context, [], request, maximumDepth=99, upperBound=budget):
+                    programs.append((request, p))
+        enumerationTime = bestOf(3, enumerate)
+        def summarize():
+            for request, p in programs:
+                g.likelihoodSummary(Context.EMPTY, [], request, p)
+        summaryTime = bestOf(3, summarize)
+        def sample():
+            random.seed(0)
+            for i in range(samples):
+                g.sample(requests[i % len(requests)], maximumDepth=6)
+        sampleTime = bestOf(3, sample)
+        print("cache size %d: %.0f programs enumerated/second, %.0f likelihood summaries/second, %.0f samples/second" %
+              (size, len(programs) / enumerationTime, len(programs) / summaryTime, samples / sampleTime))
+        if size:
+            print("\t%d hits, %d misses, %d entries" %
+                  (g.candidateCacheHits, g.candidateCacheMisses, len(g.candidateCache)))
+
+
+def recognitionFrontiers(n=256):
+    """n frontiers of list programs, each for its own task, and a grammar for them"""
+    from dreamcoder.frontier import Frontier, FrontierEntry
+    from dreamcoder.task import Task
+
+    g = listGrammar()
+    request = arrow(tlist(tint), tlist(tint))
+    frontiers = []
+    for ll, _, p in g.enumeration(Context.EMPTY, [], request, maximumDepth=99, upperBound=11.):
+        frontiers.append(Frontier([FrontierEntry(p, logPrior=ll, logLikelihood=0.)],
+                                  task=Task("task %d" % len(frontiers), request, [])))
+        if len(frontiers) == n:
+            break
+    return g, frontiers
+
+
+def recognitionTraining(steps=200):
+    """Frontiers per second of contextual recognition model training, for several batch sizes"""
+    import random
+    import torch
+    import torch.nn as nn
+    from dreamcoder.recognition import RecognitionModel
+
+    class FixedFeatureExtractor(nn.Module):
+        """A random but fixed feature vector for each task"""
+        def __init__(self):
+            super(FixedFeatureExtractor, self).__init__()
+            self.outputDimensionality = 64
+            self.recomputeTasks = False
+            self.features = {}
+
+        def featuresOfTask(self, t):
+            if t.name not in self.features:
+                self.features[t.name] = torch.randn(self.outputDimensionality)
+            return self.features[t.name]
+
+    g, frontiers = recognitionFrontiers()
+    for batchSize in [1, 8, 32, 128]:
+        random.seed(0)
+        torch.manual_seed(0)
+        model = RecognitionModel(example_encoder=FixedFeatureExtractor(), grammar=g, contextual=True, rank=16)
+        startTime = time.time()
+        model.train(frontiers, steps=steps, helmholtzRatio=0., batchSize=batchSize, biasOptimal=True)
+        dt = time.time() - startTime
+        print("batch size %d: %.1f steps/second, %.0f frontiers/second" %
+              (batchSize, steps / dt, steps * batchSize / dt))
+
+
+def programInterning(n=20000):
+    """Memory used by a corpus of parsed list programs, with and without hash-consing, and the cost of comparing them"""
+    import random
+    import tracemalloc
+    from dreamcoder.program import Program, ProgramInterner
+
+    # Dreams: programs sampled from the prior, like the Helmholtz corpora
+    random.seed(0)
+    g = listGrammar()
+    sources = []
+    while len(sources) < n:
+        p = g.sample(arrow(tlist(tint), tlist(tint)), maximumDepth=6)
+        if p is not None:
+            sources.append(str(p))
+
+    for name, parse in [("Program.parse", Program.parse), ("ProgramInterner.parse", None)]:
+        interner = ProgramInterner()
+        parse = parse or interner.parse
+        tracemalloc.start()
+        programs = [parse(s) for s in sources]
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        copies = [parse(s) for s in sources]
+        comparisons = bestOf(3, lambda: sum(p == q for p, q in zip(programs, copies)))
+        print("%s: %d programs take %.1f MB (%.0f bytes/program); %.0f comparisons/second of equal programs" %
+              (name, len(programs), size / 1e6, size / len(programs), len(programs) / comparisons))
+        if name != "Program.parse":
+            print("\t%d distinct nodes" % len(interner))
+
+
+def nodeMemory(checkpoint=None):
+    """Bytes per node of frontiers (programs, their types and frontier entries) in memory and pickled.
+    Takes the frontiers of a checkpoint if given one (nodeMemory:path/to/checkpoint.pickle),
+    and otherwise frontiers of programs sampled from the list prior"""
+    import pickle
+    import random
+    import tracemalloc
+    from dreamcoder.frontier import Frontier, FrontierEntry
+    from dreamcoder.task import Task
+
+    sys.setrecursionlimit(10000)
+    g = listGrammar()
+    if checkpoint is not None:
+        with open(checkpoint, "rb") as handle:
+            result = pickle.load(handle)
+        frontiers = list(result.allFrontiers.values()) + \
+            [f for fs in result.frontiersOverTime.values() for f in fs]
+    else:
+        random.seed(0)
+        request = arrow(tlist(tint), tlist(tint))
+        frontiers = []
+        for j in range(2000):
+            programs = [g.sample(request, maximumDepth=6) for _ in range(5)]
+            frontiers.append(Frontier([FrontierEntry(p, logPrior=g.logLikelihood(request, p), logLikelihood=0.)
+                                       for p in programs if p is not None],
+                                      task=Task("task %d" % j, request, [])))
+    # Every entry also carries the type of its program, as the grammars of a checkpoint do for theirs
+    data = [[(e, e.program.infer()) for e in f] for f in frontiers]
+
+    def typeNodes(t): return 1 + sum(typeNodes(a) for a in getattr(t, "arguments", []))
+    nodes = sum(1 + sum(1 for _ in e.program.walk()) + typeNodes(t) for f in data for e, t in f)
+
+    pickled = pickle.dumps(data)
+    tracemalloc.start()
+    loaded = pickle.loads(pickled)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("%d frontiers, %d nodes: %.0f bytes/node in memory, %.0f bytes/node pickled" %
+          (len(frontiers), nodes, size / nodes, len(pickled) / nodes))
+
+
+def checkpointing(iterations=10):
+    """Seconds and bytes per checkpoint when every iteration pickles the whole ECResult,
+    and when it commits to an incremental checkpoint store"""
+    import os
+    import random
+    import shutil
+    import tempfile
+    import dill
+    import torch
+    from dreamcoder.checkpoint import CheckpointStore
+    from dreamcoder.dreamcoder import ECResult
+    from dreamcoder.frontier import Frontier, FrontierEntry
+    from dreamcoder.task import Task
+
+    sys.setrecursionlimit(10000)
+    random.seed(0)
+    g = listGrammar()
+    request = arrow(tlist(tint), tlist(tint))
+    tasks = [Task("task %d" % j, request, [(([random.randint(0, 9) for _ in range(5)],), [])] * 5)
+             for j in range(500)]
+    directory = tempfile.mkdtemp()
+    store = CheckpointStore(os.path.join(directory, "store"))
+    result = ECResult()
+    full, incremental = [], []
+    try:
+        for j in range(int(iterations)):
+            # Each iteration solves a tenth of the tasks and trains a new recognition model
+            for t in random.sample(tasks, len(tasks) // 10):
+                programs = [g.sample(request, maximumDepth=6) for _ in range(5)]
+                f = Frontier([FrontierEntry(p, logPrior=g.logLikelihood(request, p), logLikelihood=0.)
+                              for p in programs if p is not None], task=t)
+                result.allFrontiers[t] = f
+                result.recordFrontier(f)
+            result.grammars.append(g)
+            result.searchTimes.append([random.random() for _ in tasks])
+            result.models = [torch.nn.Sequential(torch.nn.Linear(256, 256), torch.nn.Linear(256, 256))]
+
+            path = os.path.join(directory, "checkpoint_%d.pickle" % j)
+            start = time.time()
+            with open(path, "wb") as handle: dill.dump(result, handle)
+            full.append((time.time() - start, os.path.getsize(path)))
+
+            start = time.time()
+            final = store.commit(result, j + 1)
+            incremental.append((time.time() - start,
+                                sum(os.path.getsize(os.path.join(final, f)) for f in os.listdir(final))))
+    finally:
+        shutil.rmtree(directory)
+    for name, costs in [("full pickle", full), ("incremental", incremental)]:
+        print("%s: last iteration %.3f s, %d bytes; all %d iterations %.3f s, %d bytes" %
+              (name, costs[-1][0], costs[-1][1], len(costs), sum(c[0] for c in costs), sum(c[1] for c in costs)))
+
+
+def programCompilation(n=2000):
+    """Cost of running list programs sampled from the prior on random inputs,
+    interpreted by Program.evaluate and compiled by ProgramCompiler, and of compiling them"""
+    import random
+    from dreamcoder.domains.list.listPrimitives import bootstrapTarget_extra
+    from dreamcoder.program import ProgramCompiler
+
+    random.seed(0)
+    g = Grammar.uniform(bootstrapTarget_extra())
+    request = arrow(tlist(tint), tlist(tint))
+    programs = [p for p in (g.sample(request, maximumDepth=6) for _ in range(int(n))) if p is not None]
+    inputs = [[random.randint(0, 9) for _ in range(10)] for _ in range(10)]
+
+    def runAll(functions):
+        for f in functions:
+            for x in inputs:
+                try: f()(x)
+                except Exception: pass
+
+    start = time.time()
+    compiled = [ProgramCompiler().compile(p) for p in programs]
+    compiling = (time.time() - start) / len(programs)
+    interpreted = bestOf(3, lambda: runAll([lambda p=p: p.evaluate([]) for p in programs]))
+    fast = bestOf(3, lambda: runAll(compiled))
+    examples = len(programs) * len(inputs)
+    print("%d programs, %d examples each: evaluate %.2f us/example, compiled %.2f us/example (%.1fx), compiling %.1f us/program" %
+          (len(programs), len(inputs), interpreted / examples * 1e6, fast / examples * 1e6, interpreted / fast, compiling * 1e6))
+
+
+def observationalEquivalence(domain="list", upperBound=11.):
+    """Python enumeration for the largest group of list (data/list_tasks.json) or text tasks with the same request,
+    up to a fixed description length, with and without observational equivalence pruning"""
+    from dreamcoder.domains.list.listPrimitives import bootstrapTarget
+    from dreamcoder.enumeration import enumerateForTasks
+    from dreamcoder.likelihoodModel import AllOrNothingLikelihoodModel
+    from dreamcoder.grammar import EnumerationState
+
+    if domain == "list":
+        from dreamcoder.domains.list.main import retrieveJSONTasks
+        tasks = retrieveJSONTasks("data/list_tasks.json")
+        g = Grammar.uniform(bootstrapTarget())
+    else:
+        from dreamcoder.domains.text.makeTextTasks import makeTasks
+        from dreamcoder.domains.text.textPrimitives import primitives
+        tasks = makeTasks()
+        g = Grammar.uniform(primitives + bootstrapTarget())
+    requests = {}
+    for t in tasks: requests.setdefault(str(t.request), []).append(t)
+    tasks = max(requests.values(), key=len)
+    print("%d %s tasks of type %s" % (len(tasks), domain, tasks[0].request))
+
+    for pruning in [False, True]:
+        state = EnumerationState(g, tasks[0].request)
+        start = time.time()
+        frontiers, _, programs = enumerateForTasks(g, tasks, AllOrNothingLikelihoodModel(timeout=0.01),
+                                                   timeout=3600, evaluationTimeout=0.01,
+                                                   lowerBound=0., upperBound=float(upperBound), budgetIncrement=1.,
+                                                   maximumFrontiers={t: 10**9 for t in tasks},
+                                                   enumerationState=state, observationalEquivalence=pruning)
+        elapsed = time.time() - start
+        print("%s: %d programs in %.1f s, %d tasks solved, %d frontier entries" %
+              ("pruning" if pruning else "no pruning", programs, elapsed,
+               sum(not f.empty for f in frontiers.values()), sum(len(f) for f in frontiers.values())))
+
+
+BENCHMARKS = {"typeContext": typeContext,
+              "candidateCache": candidateCache,
+              "recognitionTraining": recognitionTraining,
+              "programInterning": programInterning,
+              "nodeMemory": nodeMemory,
+              "checkpointing": checkpointing,
+              "programCompilation": programCompilation,
+              "observationalEquivalence": observationalEquivalence}
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or any(b.split(":")[0] not in BENCHMARKS for b in sys.argv[1:]):
+        print(__doc__)
+        for name, f in BENCHMARKS.items():
+            print("\t%s: %s" % (name, f.__doc__))
+        sys.exit(1)
+    for b in sys.argv[1:]:
+        print(b)
+        name, *arguments = b.split(":")
+        BENCHMARKS[name](*arguments)
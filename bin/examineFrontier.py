@@ -252,29 +252,30 @@ if __name__ == "__main__":
             print("\t", Pstring)
             print("\t", "samples:")
             print("\t", [preg.sample() for i in range(5)])
-            entry.trainHit = ll >= task.gt
+            trainHit = ll >= task.gt
             if ll >= task.gt:
                 print(f"\t HIT (train), Ground truth: {task.gt}, found ll: {ll}")
             else:
                 print(f"\t MISS (train), Ground truth: {task.gt}, found ll: {ll}")
-            entry.testHit = testing_likelihood >= ground_truth_testing
+            testHit = testing_likelihood >= ground_truth_testing
             if testing_likelihood >= ground_truth_testing:
                 print(f"\t HIT (test), Ground truth: {ground_truth_testing}, found ll: {testing_likelihood}")
             else:
                 print(f"\t MISS (test), Ground truth: {ground_truth_testing}, found ll: {testing_likelihood}")
+            return trainHit, testHit
 
 
         print("\t", "best Posterior:")
         entry = max(frontier.entries, key=lambda e: e.logLikelihood + e.logPrior)
-        examineProgram(entry)
-        posteriorHits += int(entry.trainHit)
-        posteriorHits_test += int(entry.testHit)
+        trainHit, testHit = examineProgram(entry)
+        posteriorHits += int(trainHit)
+        posteriorHits_test += int(testHit)
 
         print("\t", "best Likelihood:")
         entry = max(frontier.entries, key=lambda e: e.logLikelihood)
-        examineProgram(entry)
-        likelihoodHits += int(entry.trainHit)
-        likelihoodHits_test += int(entry.testHit)
+        trainHit, testHit = examineProgram(entry)
+        likelihoodHits += int(trainHit)
+        likelihoodHits_test += int(testHit)
         print()
 
         print("\t","Posterior predictive samples...")
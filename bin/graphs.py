@@ -19,6 +19,8 @@ from dreamcoder.domains.tower.main import TowerCNN
 
 
 def loadfun(x):
+    # Incremental checkpoint stores are directories; only read the fields we graph
+    if os.path.isdir(x): return LazyECResult(x)
     with open(x, 'rb') as handle:
         result = dill.load(handle)
     return result
@@ -1,18 +1,65 @@
+"""
+Mines symmetry-breaking rules for the primitives of a domain and saves them
+where `--symmetryRules` looks for them (data/symmetry/, one file per primitive
+set). Usage:
+
+    python bin/symmetryBreaking.py list [--primitives common] [--upperBound 12]
+    python bin/symmetryBreaking.py text
+    python bin/symmetryBreaking.py recognition   # does a recognition model learn them?
+"""
+
 try:
     import binutil  # required to import from dreamcoder modules
 except ModuleNotFoundError:
     import bin.binutil  # alt import if called as module
 
+import argparse
+
 from dreamcoder.dreaming import backgroundHelmholtzEnumeration
-from dreamcoder.grammar import Grammar
+from dreamcoder.grammar import Grammar, SymmetryRules
 from dreamcoder.program import Program
 from dreamcoder.recognition import DummyFeatureExtractor, RecognitionModel
 from dreamcoder.task import Task
 from dreamcoder.type import arrow, tint
-from dreamcoder.utilities import eprint
+from dreamcoder.utilities import eprint, timing
 
 
-def main():
+def listDomain(primitives):
+    from dreamcoder.domains.list.listPrimitives import basePrimitives, primitives as richPrimitives, \
+        McCarthyPrimitives, bootstrapTarget_extra, no_length
+    from dreamcoder.domains.list.main import retrieveJSONTasks
+    prims = {"base": basePrimitives,
+             "McCarthy": McCarthyPrimitives,
+             "common": bootstrapTarget_extra,
+             "noLength": no_length,
+             "rich": richPrimitives}[primitives or "common"]()
+    return Grammar.uniform(prims), retrieveJSONTasks("data/list_tasks.json")
+
+
+def textDomain(primitives):
+    from dreamcoder.domains.list.listPrimitives import bootstrapTarget
+    from dreamcoder.domains.text.makeTextTasks import makeTasks
+    from dreamcoder.domains.text.textPrimitives import primitives as textPrimitives
+    return Grammar.uniform(textPrimitives + bootstrapTarget()), makeTasks()
+
+
+DOMAINS = {"list": listDomain,
+           "text": textDomain}
+
+
+def mineRules(domain, primitives=None, upperBound=12., output=None):
+    grammar, tasks = DOMAINS[domain](primitives)
+    with timing("Mined symmetry-breaking rules for %d primitives" % len(grammar.primitives)):
+        rules = SymmetryRules.mine(grammar, tasks, upperBound=upperBound)
+    eprint(rules)
+    output = output or SymmetryRules.defaultPath(grammar.primitives)
+    rules.save(output)
+    eprint("Saved", len(rules), "rules to", output)
+    return rules
+
+
+def recognitionExperiment():
+    """Trains recognition models on a tiny arithmetic DSL to see whether they learn to break symmetries"""
     trainingTimeout = 600
     rt = arrow(tint,tint)
     g = Grammar.uniform([Program.parse(p)
@@ -45,5 +92,21 @@ def main():
         eprint(g.sample(rt, maximumDepth=20))
 
 
+def main():
+    parser = argparse.ArgumentParser(description="Mine symmetry-breaking rules for the primitives of a domain")
+    parser.add_argument("domain", choices=sorted(DOMAINS) + ["recognition"])
+    parser.add_argument("--primitives", default=None,
+                        help="Primitive set of the list domain, as in its --primitives. Default: common")
+    parser.add_argument("--upperBound", default=12., type=float,
+                        help="Description length of the equivalent programs searched for. Default: 12")
+    parser.add_argument("--output", default=None,
+                        help="Where to save the rules. Default: data/symmetry/<primitive set>.json")
+    arguments = parser.parse_args()
+    if arguments.domain == "recognition":
+        recognitionExperiment()
+    else:
+        mineRules(arguments.domain, arguments.primitives, arguments.upperBound, arguments.output)
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,310 @@
+"""Incremental checkpoints for ecIterator.
+
+A checkpoint store is an append-only directory holding one subdirectory per
+iteration. Each iteration only writes what changed since the previous one: one
+pickle per ECResult field holding an edit (new frontiers, the new grammar,
+appended search times...), the weights of any recognition model as a
+state_dict in recognition.pt, and the tasks that have not been seen before in
+tasks.pickle. Tasks and weights are referenced from the field pickles by key,
+so they are written exactly once.
+
+Any iteration can be reconstructed by replaying the edits up to it, either for
+the whole result (CheckpointStore.load, used by --resume) or for a single
+field (CheckpointStore.field, used by LazyECResult for graphing).
+"""
+
+import os
+import shutil
+
+import dill
+import torch
+
+from dreamcoder.frontier import FrontierHistory
+from dreamcoder.task import Task
+from dreamcoder.utilities import eprint
+
+
+_MISSING = object()
+
+
+class _HistorySize():
+    """Shadow of a FrontierHistory, which only ever grows"""
+    def __init__(self, history):
+        self.history = history
+        self.size = history.size()
+
+
+def _shadow(x):
+    """Copy of the lists, dicts and sets in x that shares everything else with x"""
+    if type(x) is list: return [_shadow(y) for y in x]
+    if type(x) is dict: return {k: _shadow(v) for k, v in x.items()}
+    if type(x) is set: return set(x)
+    if isinstance(x, FrontierHistory): return _HistorySize(x)
+    return x
+
+
+def _delta(old, new):
+    """Edit turning the shadow old into new, or None if nothing changed.
+    Anything that is not a list, dict, set or FrontierHistory is compared by identity:
+    ecIterator replaces frontiers, grammars and models rather than mutating them."""
+    if type(new) is list and type(old) is list:
+        if len(old) <= len(new) and all(_delta(o, n) is None for o, n in zip(old, new)):
+            if len(old) == len(new): return None
+            return ("extend", new[len(old):])
+        return ("set", new)
+    if type(new) is dict and type(old) is dict:
+        changes = {}
+        for k, v in new.items():
+            d = _delta(old[k], v) if k in old else ("set", v)
+            if d is not None: changes[k] = d
+        removed = [k for k in old if k not in new]
+        if changes or removed: return ("update", changes, removed)
+        return None
+    if type(new) is set and type(old) is set:
+        added, removed = new - old, old - new
+        if added or removed: return ("union", added, removed)
+        return None
+    if isinstance(new, FrontierHistory) and isinstance(old, _HistorySize) and old.history is new:
+        programs, versions = new.since(old.size)
+        if programs or versions: return ("history", (programs, versions))
+        return None
+    if new is old: return None
+    if new is _MISSING: return ("delete",)
+    return ("set", new)
+
+
+def _apply(value, delta):
+    kind = delta[0]
+    if kind == "set": return delta[1]
+    if kind == "delete": return _MISSING
+    if kind == "extend":
+        value.extend(delta[1])
+        return value
+    if kind == "update":
+        _, changes, removed = delta
+        for k, d in changes.items(): value[k] = _apply(value.get(k, _MISSING), d)
+        for k in removed: del value[k]
+        return value
+    if kind == "union":
+        _, added, removed = delta
+        value |= added
+        value -= removed
+        return value
+    if kind == "history":
+        value.extend(delta[1])
+        return value
+    assert False, "unknown checkpoint edit %s" % kind
+
+
+class _DeltaPickler(dill.Pickler):
+    """Pickles an iteration's edits, replacing tasks by their key in the store
+    and the tensors of recognition models by their name in a state_dict"""
+
+    def __init__(self, handle, store, states):
+        super(_DeltaPickler, self).__init__(handle)
+        self.store = store
+        self.states = states
+
+    def persistent_id(self, o):
+        if isinstance(o, Task): return ("task", self.store._taskKey(o))
+        if isinstance(o, torch.nn.Module):
+            self.states.register(o)
+            return None
+        if isinstance(o, torch.Tensor):
+            key = self.states.keys.get(id(o))
+            if key is not None: return ("tensor", key)
+        return None
+
+
+class _DeltaUnpickler(dill.Unpickler):
+    def __init__(self, handle, store, iteration):
+        super(_DeltaUnpickler, self).__init__(handle)
+        self.store = store
+        self.iteration = iteration
+
+    def persistent_load(self, pid):
+        kind, key = pid
+        if kind == "task": return self.store._task(key)
+        if kind == "tensor":
+            m, name = key
+            return self.store._states(self.iteration)[m][name]
+        assert False, "unknown persistent id %s" % kind
+
+
+class _ModuleStates():
+    """The state_dicts of the recognition models met while pickling an iteration"""
+
+    def __init__(self):
+        self.modules = {}
+        self.states = []
+        self.keys = {}
+
+    def register(self, module):
+        if id(module) in self.modules: return
+        self.modules[id(module)] = module
+        m = len(self.states)
+        state = {}
+        for name, tensor in module.state_dict(keep_vars=True).items():
+            if id(tensor) in self.keys: continue
+            self.keys[id(tensor)] = (m, name)
+            state[name] = tensor
+        self.states.append(state)
+
+
+class CheckpointStore():
+    TASKS = "tasks.pickle"
+    WEIGHTS = "recognition.pt"
+    SUFFIX = ".pickle"
+
+    def __init__(self, path):
+        self.path = path
+        # Task -> key, for every task written so far or loaded
+        self.taskKeys = {}
+        self.pendingTasks = {}
+        self.nextTaskKey = 0
+        # Caches for reading
+        self.tasks = {}
+        self.loadedTasks = set()
+        self.weights = {}
+        # Shadow of the last committed result
+        self.shadow = None
+        if self.iterations(): self._trackTasks()
+
+    def iterationPath(self, iteration):
+        return os.path.join(self.path, "iteration_%04d" % iteration)
+
+    def iterations(self):
+        """Committed iterations, in order"""
+        if not os.path.isdir(self.path): return []
+        return sorted(int(d[len("iteration_"):]) for d in os.listdir(self.path)
+                      if d.startswith("iteration_") and not d.endswith(".tmp"))
+
+    def _upTo(self, iteration):
+        iterations = self.iterations()
+        if iteration is None:
+            if not iterations:
+                eprint("Checkpoint store", self.path, "is empty")
+                assert False
+            iteration = iterations[-1]
+        if iteration not in iterations:
+            eprint("Checkpoint store", self.path, "has no iteration", iteration,
+                   "(available: %s)" % iterations)
+            assert False
+        return [i for i in iterations if i <= iteration]
+
+    def _taskKey(self, task):
+        key = self.taskKeys.get(task)
+        if key is None: key = self.pendingTasks.get(task)
+        if key is None:
+            key = self.nextTaskKey + len(self.pendingTasks)
+            self.pendingTasks[task] = key
+        return key
+
+    def _loadTasks(self, iterations):
+        for i in iterations:
+            if i in self.loadedTasks: continue
+            self.loadedTasks.add(i)
+            path = os.path.join(self.iterationPath(i), self.TASKS)
+            if os.path.exists(path):
+                with open(path, "rb") as handle:
+                    self.tasks.update(dill.load(handle))
+
+    def _trackTasks(self):
+        self._loadTasks(self.iterations())
+        self.taskKeys = {t: k for k, t in self.tasks.items()}
+        self.nextTaskKey = max(self.tasks, default=-1) + 1
+
+    def _task(self, key):
+        if key not in self.tasks: self._loadTasks(self.iterations())
+        return self.tasks[key]
+
+    def _states(self, iteration):
+        if iteration not in self.weights:
+            self.weights[iteration] = torch.load(os.path.join(self.iterationPath(iteration), self.WEIGHTS))
+        return self.weights[iteration]
+
+    def _read(self, iteration, name):
+        with open(os.path.join(self.iterationPath(iteration), name + self.SUFFIX), "rb") as handle:
+            return _DeltaUnpickler(handle, self, iteration).load()
+
+    def commit(self, result, iteration):
+        """Writes the parts of result that changed since the last commit as the given iteration"""
+        if iteration in self.iterations():
+            eprint("Checkpoint store", self.path, "already has iteration", iteration,
+                   "- it is append-only, so resume from its last iteration or use another output prefix.")
+            assert False
+
+        fields = dict(result.__dict__)
+        fields["__class__"] = type(result)
+        old = self.shadow or {}
+        changes = {}
+        for name in set(fields) | set(old):
+            d = _delta(old.get(name, _MISSING), fields.get(name, _MISSING))
+            if d is not None: changes[name] = d
+
+        final = self.iterationPath(iteration)
+        temporary = final + ".tmp"
+        if os.path.exists(temporary): shutil.rmtree(temporary)
+        os.makedirs(temporary)
+        states = _ModuleStates()
+        try:
+            for name, d in changes.items():
+                with open(os.path.join(temporary, name + self.SUFFIX), "wb") as handle:
+                    _DeltaPickler(handle, self, states).dump(d)
+            if states.states:
+                torch.save(states.states, os.path.join(temporary, self.WEIGHTS))
+            if self.pendingTasks:
+                with open(os.path.join(temporary, self.TASKS), "wb") as handle:
+                    dill.dump({k: t for t, k in self.pendingTasks.items()}, handle)
+        except:
+            self.pendingTasks = {}
+            shutil.rmtree(temporary)
+            raise
+        os.rename(temporary, final)
+
+        self.taskKeys.update(self.pendingTasks)
+        self.nextTaskKey += len(self.pendingTasks)
+        self.tasks.update({k: t for t, k in self.pendingTasks.items()})
+        self.loadedTasks.add(iteration)
+        self.pendingTasks = {}
+        self.track(result)
+        return final
+
+    def track(self, result):
+        """Makes the next commit relative to result"""
+        self.shadow = _shadow(dict(result.__dict__, __class__=type(result)))
+
+    def fieldNames(self, iteration=None):
+        names = set()
+        for i in self._upTo(iteration):
+            names.update(f[:-len(self.SUFFIX)] for f in os.listdir(self.iterationPath(i))
+                         if f.endswith(self.SUFFIX) and f != self.TASKS)
+        names.discard("__class__")
+        return names
+
+    def field(self, name, iteration=None):
+        """Value of a single field of the result at the given iteration (default: the last one)"""
+        value = _MISSING
+        for i in self._upTo(iteration):
+            if os.path.exists(os.path.join(self.iterationPath(i), name + self.SUFFIX)):
+                value = _apply(value, self._read(i, name))
+        if value is _MISSING: raise KeyError(name)
+        return value
+
+    def load(self, iteration=None):
+        """Reconstructs the result at the given iteration (default: the last one).
+        Later commits to this store are relative to the returned result."""
+        fields = {}
+        for i in self._upTo(iteration):
+            for f in os.listdir(self.iterationPath(i)):
+                if not f.endswith(self.SUFFIX) or f == self.TASKS: continue
+                name = f[:-len(self.SUFFIX)]
+                fields[name] = _apply(fields.get(name, _MISSING), self._read(i, name))
+        fields = {k: v for k, v in fields.items() if v is not _MISSING}
+        cls = fields.pop("__class__")
+        result = cls.__new__(cls)
+        result.__dict__.update(fields)
+
+        self._trackTasks()
+        self.track(result)
+        return result
@@ -18,7 +18,7 @@ from dreamcoder.domains.logo.logoPrimitives import primitives, turtle, tangle, t
 from dreamcoder.dreamcoder import ecIterator
 from dreamcoder.grammar import Grammar, ContextualGrammar
 from dreamcoder.program import Program, Index
-from dreamcoder.recognition import variable, maybe_cuda
+from dreamcoder.recognition import variable, maybe_cuda, TaskCache
 from dreamcoder.task import Task
 from dreamcoder.type import arrow
 from dreamcoder.utilities import eprint, testTrainSplit, loadPickle
@@ -225,23 +225,36 @@ class LogoFeatureCNN(nn.Module):
         self.outputDimensionality = 256
 
         
-    def forward(self, v):
+    def inputTensor(self, v):
+        """The 1 x 1 x resizedDimension x resizedDimension input of the encoder for a flattened image"""
         assert len(v) == self.inputImageDimension*self.inputImageDimension
-        floatOnlyTask = list(map(float, v))
-        reshaped = [floatOnlyTask[i:i + self.inputImageDimension]
-                    for i in range(0, len(floatOnlyTask), self.inputImageDimension)]
-        v = variable(reshaped).float()
+        v = variable(np.asarray(v, dtype=np.float32)).view(self.inputImageDimension, self.inputImageDimension)
         # insert channel and batch
         v = torch.unsqueeze(v, 0)
         v = torch.unsqueeze(v, 0)
         v = maybe_cuda(v, next(self.parameters()).is_cuda)/256.
         window = int(self.inputImageDimension/self.resizedDimension)
-        v = F.avg_pool2d(v, (window,window))
+        return F.avg_pool2d(v, (window,window))
+
+    def forward(self, v):
+        if not torch.is_tensor(v): v = self.inputTensor(v)
         v = self.encoder(v)
         return v.view(-1)
 
+    def taskTensor(self, t):
+        """inputTensor of the image of t"""
+        # Tasks are encoded every epoch, so their images are converted into tensors only once
+        inputs = self.__dict__.get('inputCache')
+        if inputs is None: inputs = self.inputCache = TaskCache(1000)
+        return inputs.get(t, lambda: self.inputTensor(t.highresolution),
+                          next(self.parameters()).device)
+
     def featuresOfTask(self, t):  # Take a task and returns [features]
-        return self(t.highresolution)
+        return self(self.taskTensor(t))
+
+    def featuresOfTasks(self, ts):
+        """Encodes the images of the tasks as one batch"""
+        return self.encoder(torch.cat([self.taskTensor(t) for t in ts]))
 
     def tasksOfPrograms(self, ps, types):
         images = drawLogo(*ps, resolution=128)
@@ -8,7 +8,8 @@ from dreamcoder.utilities import *
 import os
 import datetime
 
-from dreamcoder.recognition import variable
+from dreamcoder.recognition import variable, TaskCache
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
@@ -61,19 +62,14 @@ class TowerCNN(nn.Module):
             self.CUDA=True
             self.cuda()  # I think this should work?
 
-    def forward(self, v, v2=None):
-        """v: tower to build. v2: image of tower we have built so far"""
-        # insert batch if it is not already there
+    def inputTensor(self, v, v2=None):
+        """Batched input tensor of the encoder for the images v & v2, which are batched or not"""
         if len(v.shape) == 3:
             v = np.expand_dims(v, 0)
-            inserted_batch = True
             if v2 is not None:
                 assert len(v2.shape) == 3
                 v2 = np.expand_dims(v2, 0)
-        elif len(v.shape) == 4:
-            inserted_batch = False
-            pass
-        else:
+        elif len(v.shape) != 4:
             assert False, "v has the shape %s"%(str(v.shape))
         
         if v2 is None: v2 = np.zeros(v.shape)
@@ -85,20 +81,34 @@ class TowerCNN(nn.Module):
         window = int(self.inputImageDimension/self.resizedDimension)
         v = F.avg_pool2d(v, (window,window))
         #showArrayAsImage(np.transpose(v.data.numpy()[0,:3,:,:],[1,2,0]))
-        v = self.encoder(v)
+        return v
+
+    def forward(self, v, v2=None):
+        """v: tower to build. v2: image of tower we have built so far.
+        v may also be a batch made by inputTensor, in which case v2 is ignored"""
+        if torch.is_tensor(v): return self.encoder(v)
+        # insert batch if it is not already there
+        inserted_batch = len(v.shape) == 3
+        v = self.encoder(self.inputTensor(v, v2))
         if inserted_batch:
             return v.view(-1)
         else:
             return v
 
+    def goalTensor(self, t):
+        """inputTensor of the goal of t with nothing built so far, computed once per task"""
+        inputs = self.__dict__.get('inputCache')
+        if inputs is None: inputs = self.inputCache = TaskCache(500)
+        return inputs.get(t, lambda: self.inputTensor(t.getImage()), self.CUDA)
+
     def featuresOfTask(self, t, t2=None):  # Take a task and returns [features]
-        return self(t.getImage(),
-                    None if t2 is None else t2.getImage(drawHand=True))
+        if t2 is None: return self(self.goalTensor(t)).view(-1)
+        return self(t.getImage(), t2.getImage(drawHand=True))
     
     def featuresOfTasks(self, ts, t2=None):  # Take a task and returns [features]
         """Takes the goal first; optionally also takes the current state second"""
         if t2 is None:
-            pass
+            return self(torch.cat([self.goalTensor(t) for t in ts]))
         elif isinstance(t2, Task):
             assert False
             #t2 = np.array([t2.getImage(drawHand=True)]*len(ts))
@@ -3,6 +3,7 @@ import datetime
 import dill
 import gc
 
+from dreamcoder.checkpoint import CheckpointStore
 from dreamcoder.compression import induceGrammar
 from dreamcoder.recognition import *
 from dreamcoder.enumeration import *
@@ -34,8 +35,9 @@ class ECResult():
                  timesAtEachWake=None,
                  allFrontiers=None,
                  taskLanguage=None,
-                 tasksAttempted=None,):
-        self.frontiersOverTime = {} # Map from task to [frontier at iteration 1, frontier at iteration 2, ...]
+                 tasksAttempted=None,
+                 phaseTimeline=None):
+        self.frontiersOverTime = FrontierHistory(frontiersOverTime) # Map from task to [frontier at iteration 1, frontier at iteration 2, ...]
         self.hitsAtEachWake = hitsAtEachWake or []
         self.timesAtEachWake = timesAtEachWake or []
         self.testingSearchTime = testingSearchTime or []
@@ -56,6 +58,7 @@ class ECResult():
         self.taskLanguage = taskLanguage or {} # Maps from task names to language.
         self.models = models or [] # List of recognition models.
         self.tasksAttempted = tasksAttempted or set() # Tasks we have attempted so far.
+        self.phaseTimeline = phaseTimeline or [] # [{"phase", "iteration", "start", "end", "CPUs"}], see PhaseTimeline.
 
     def __repr__(self):
         attrs = ["{}={}".format(k, v) for k, v in self.__dict__.items()]
@@ -69,9 +72,10 @@ class ECResult():
         return testing
 
     def recordFrontier(self, frontier):
-        t = frontier.task
-        if t not in self.frontiersOverTime: self.frontiersOverTime[t] = []
-        self.frontiersOverTime[t].append(frontier)
+        if not isinstance(self.frontiersOverTime, FrontierHistory):
+            # Backward compatibility with checkpoints that kept a list of frontiers for each task
+            self.frontiersOverTime = FrontierHistory(self.frontiersOverTime)
+        self.frontiersOverTime.record(frontier)
 
     # Linux does not like files that have more than 256 characters
     # So when exporting the results we abbreviate the parameters
@@ -83,6 +87,7 @@ class ECResult():
                      "recognitionTimeout": "RT",
                      "recognitionSteps": "RS",
                      "recognitionEpochs": "RE",
+                     "recognitionBatchSize": "RB",
                      'useWakeLanguage' : "LANG",
                      "iterations": "it",
                      "maximumFrontier": "MF",
@@ -145,6 +150,82 @@ ECResult.abbreviationToParameter = {
     v: k for k, v in ECResult.abbreviations.items()}
 
 
+class LazyECResult(ECResult):
+    """An ECResult backed by a CheckpointStore, which only reads each field the first time it is accessed.
+    Use this for graphing: it never loads the recognition models unless you ask for them."""
+    def __init__(self, store, iteration=None):
+        if not isinstance(store, CheckpointStore): store = CheckpointStore(store)
+        self.__dict__["_store"] = store
+        self.__dict__["_iteration"] = iteration
+
+    def __getattr__(self, name):
+        store = self.__dict__.get("_store")
+        if store is None or name.startswith("__"): raise AttributeError(name)
+        try:
+            value = store.field(name, self.__dict__["_iteration"])
+        except KeyError:
+            raise AttributeError(name)
+        self.__dict__[name] = value
+        return value
+
+
+class PhaseTimeline():
+    """Records when each phase of an ecIterator iteration ran, and on how many CPUs, in result.phaseTimeline.
+    Phases launched in the background hold their CPUs until they finish; the phases
+    running in the foreground share whatever is left of the budget."""
+    def __init__(self, result, CPUs):
+        if not hasattr(result, 'phaseTimeline'): result.phaseTimeline = [] # Backward compatibility with old checkpoints
+        self.result = result
+        self.CPUs = CPUs
+        self.background = [] # [(phase, process, queue, callback)]
+
+    def available(self):
+        """CPUs not held by a background phase"""
+        self.poll()
+        return max(1, self.CPUs - sum(phase["CPUs"] for phase, _, _, _ in self.background))
+
+    def begin(self, name, iteration, CPUs):
+        phase = {"phase": name, "iteration": iteration, "start": time.time(), "end": None, "CPUs": CPUs}
+        self.result.phaseTimeline.append(phase)
+        return phase
+
+    def end(self, phase):
+        phase["end"] = time.time()
+
+    def launch(self, name, iteration, CPUs, f, callback):
+        """Runs f() in a forked process. callback is called on its return value by poll or join, in this process."""
+        from multiprocessing import Queue
+        phase = self.begin(name, iteration, CPUs)
+        q = Queue()
+        process = launchParallelProcess(lambda: (f(), time.time()), q=q, ID=name)
+        self.background.append((phase, process, q, callback))
+
+    def poll(self, block=False):
+        """Calls back every background phase that has finished. If block, waits for all of them."""
+        from queue import Empty
+        while True:
+            for entry in list(self.background):
+                phase, process, q, callback = entry
+                try:
+                    message = dill.loads(q.get(block=block, timeout=1. if block else None))
+                except Empty:
+                    if not block or process.is_alive() or not q.empty(): continue
+                    eprint("Background phase", phase["phase"], "died without reporting back, aborting.")
+                    assert False
+                process.join()
+                self.background.remove(entry)
+                if message["result"] != "success":
+                    eprint("Exception in background phase", phase["phase"], ":")
+                    eprint(message["stacktrace"])
+                    raise message["exception"]
+                value, phase["end"] = message["value"]
+                callback(value)
+            if not (block and self.background): return
+
+    def join(self):
+        self.poll(block=True)
+
+
 def explorationCompression(*arguments, **keywords):
     for r in ecIterator(*arguments, **keywords):
         pass
@@ -195,6 +276,7 @@ def ecIterator(grammar, tasks,
                recognitionEpochs=None,
                recognitionTimeout=None,
                recognitionSteps=None,
+               recognitionBatchSize=1,
                helmholtzRatio=0.,
                activation='relu',
                topK=1,
@@ -226,6 +308,14 @@ def ecIterator(grammar, tasks,
                lc_score=False,
                max_compression=0,
                max_mem_per_enumeration_thread=1000000,
+               persistentSolvers=False,
+               resumableEnumeration=False,
+               observationalEquivalence=False,
+               streamHelmholtz=False,
+               incrementalCheckpoints=False,
+               symmetryRules=None,
+               pipelinePhases=False,
+               concurrentEnsemble=False,
                # Entrypoint flags for integration tests. If these are set, we return early at semantic breakpoints in the iteration.
                test_task_language=False, # Integration test on the language we add to tasks.
                test_background_helmholtz=False, # Integration test for enumerating Helmholtz frontiers in the background.
@@ -336,6 +426,7 @@ def ecIterator(grammar, tasks,
             del parameters["mask"]
     if not mask and 'mask' in parameters: del parameters["mask"]
     if not auxiliaryLoss and 'auxiliaryLoss' in parameters: del parameters['auxiliaryLoss']
+    if recognitionBatchSize == 1 and 'recognitionBatchSize' in parameters: del parameters['recognitionBatchSize']
     if not useDSL:
         for k in {"structurePenalty", "pseudoCounts", "aic"}:
             del parameters[k]
@@ -376,6 +467,14 @@ def ecIterator(grammar, tasks,
             "arguments",
             "args",
             "primitives",
+            "persistentSolvers",
+            "resumableEnumeration",
+            "observationalEquivalence",
+            "streamHelmholtz",
+            "incrementalCheckpoints",
+            "symmetryRules",
+            "pipelinePhases",
+            "concurrentEnsemble",
         ]
         parameters["iterations"] = iteration
         checkpoint_params = [k for k in sorted(parameters.keys()) if k not in exclude_from_path and not k.startswith('test_')]
@@ -384,6 +483,10 @@ def ecIterator(grammar, tasks,
                 ECResult.abbreviate(k),
                 ECResult.abbreviate_value(parameters[k])) for k in checkpoint_params]
         return "{}_{}{}.pickle".format(outputPrefix, "_".join(kvs), extra)
+
+    # Directory of the incremental checkpoint store, shared by every iteration
+    def checkpointStorePath():
+        return checkpointPath("incremental")[:-len(".pickle")]
     
     print(f"Checkpoints will be written to [{checkpointPath('iter')}]")
     print(f"Checkpoint path len = [{len(checkpointPath('iter'))}]")
@@ -405,17 +508,38 @@ def ecIterator(grammar, tasks,
     def reportMemory():
         eprint(f"Currently using this much memory: {getThisMemoryUsage()}")
     
+    if symmetryRules is not None:
+        path = symmetryRules or SymmetryRules.defaultPath(grammar.primitives)
+        rules = SymmetryRules.load(path).install()
+        eprint("Enumeration breaks symmetries with", len(rules), "mined rules from", path)
+
     # Restore checkpoint
+    store = None
     if resume is not None:
         try:
             resume = int(resume)
-            path = checkpointPath(resume)
+            path = checkpointStorePath() if incrementalCheckpoints else checkpointPath(resume)
         except ValueError:
             path = resume
-        with open(path, "rb") as handle:
-            result = dill.load(handle)
+        if os.path.isdir(path):
+            store = CheckpointStore(path)
+            result = store.load(resume if isinstance(resume, int) else None)
+        else:
+            with open(path, "rb") as handle:
+                result = dill.load(handle)
         resume = len(result.grammars) - 1
         eprint("Loaded checkpoint from", path)
+        if outputPrefix is not None and incrementalCheckpoints and not addFullTaskMetrics:
+            # The store is append-only, so check now rather than after spending an iteration
+            output = store if store is not None and \
+                     os.path.abspath(store.path) == os.path.abspath(checkpointStorePath()) \
+                     else CheckpointStore(checkpointStorePath())
+            later = [i for i in output.iterations() if i > resume]
+            if later:
+                eprint("Cannot resume from iteration", resume, "because checkpoint store", output.path,
+                       "already has iterations", later,
+                       "- it is append-only, so resume from its last iteration or use another output prefix.")
+                assert False
         grammar = result.grammars[-1] if result.grammars else grammar
         # Backward compatability if we weren't tracking attempted tasks.
         if not hasattr(result, 'tasksAttempted'): result.tasksAttempted = set()
@@ -526,6 +650,11 @@ def ecIterator(grammar, tasks,
         if t.add_as_supervised:
             result.allFrontiers[t] = result.allFrontiers[t].combine(Frontier.makeFrontierFromSupervised(t)).topK(maximumFrontier)
     
+    if pipelinePhases and cuda:
+        eprint("Cannot test in a forked process once CUDA is initialized; not pipelining phases.")
+        pipelinePhases = False
+    timeline = PhaseTimeline(result, CPUs)
+
     # Set up the task batcher.
     if taskReranker == 'default':
         taskBatcher = DefaultTaskBatcher()
@@ -576,12 +705,26 @@ def ecIterator(grammar, tasks,
             
         if (not should_skip_test) and testingTimeout > 0 and ((j % testEvery == 0) or (j == iterations - 1)):
             eprint("Evaluating on held out testing tasks for iteration: %d" % (j))
-            evaluateOnTestingTasks(result, testingTasks, grammar,
-                                   CPUs=CPUs, maximumFrontier=maximumFrontier,
-                                   solver=solver,
-                                   enumerationTimeout=testingTimeout, evaluationTimeout=evaluationTimeout,
-                                   test_dsl_only=test_dsl_only,
-                                   max_mem_per_enumeration_thread=max_mem_per_enumeration_thread)            
+            testing = dict(maximumFrontier=maximumFrontier,
+                           solver=solver,
+                           enumerationTimeout=testingTimeout, evaluationTimeout=evaluationTimeout,
+                           test_dsl_only=test_dsl_only,
+                           max_mem_per_enumeration_thread=max_mem_per_enumeration_thread,
+                           persistentSolvers=persistentSolvers,
+                           resumableEnumeration=resumableEnumeration,
+                           observationalEquivalence=observationalEquivalence)
+            if pipelinePhases and CPUs > 1:
+                # Split the CPUs in proportion to the enumeration budgets of testing and waking
+                testingWork = len(testingTasks) * testingTimeout
+                wakingWork = min(len(tasks), taskBatchSize or len(tasks)) * enumerationTimeout
+                testingCPUs = min(CPUs - 1, max(1, int(round(CPUs * testingWork / (testingWork + wakingWork)))))
+                eprint("Testing in the background on %d CPUs while waking and sleeping on the rest." % testingCPUs)
+                evaluateOnTestingTasksInBackground(timeline, j, result, testingTasks, grammar,
+                                                   CPUs=testingCPUs, **testing)
+            else:
+                phase = timeline.begin("testing", j, CPUs)
+                evaluateOnTestingTasks(result, testingTasks, grammar, CPUs=CPUs, **testing)
+                timeline.end(phase)
         # If we have to also enumerate Helmholtz frontiers,
         # do this extra sneaky in the background
         if n_models > 0 and biasOptimal and helmholtzRatio > 0 and \
@@ -595,7 +738,8 @@ def ecIterator(grammar, tasks,
                                                                     special=featureExtractor.special,
                                                                     executable='helmholtz',
                                                                     serialize_special=serialize_special,
-                                                                    maximum_size=maximum_helmholtz)
+                                                                    maximum_size=maximum_helmholtz,
+                                                                    stream=streamHelmholtz)
                 if test_background_helmholtz: # Integration test exitpoint for testing frontiers.
                     yield helmholtzFrontiers
             else:
@@ -617,14 +761,19 @@ def ecIterator(grammar, tasks,
                     enumeration_time = initialTimeout
             result.tasksAttempted.update(wakingTaskBatch)
             wake_generative = custom_wake_generative if custom_wake_generative is not None else default_wake_generative
+            phase = timeline.begin("wake", j, timeline.available())
             topDownFrontiers, times = wake_generative(grammar, wakingTaskBatch,
                                                       solver=solver,
                                                       args=arguments,
                                                       maximumFrontier=maximumFrontier,
                                                       enumerationTimeout=enumeration_time,
-                                                      CPUs=CPUs,
+                                                      CPUs=phase["CPUs"],
                                                       evaluationTimeout=evaluationTimeout,
-                                                      max_mem_per_enumeration_thread=max_mem_per_enumeration_thread)
+                                                      max_mem_per_enumeration_thread=max_mem_per_enumeration_thread,
+                                                      persistentSolvers=persistentSolvers,
+                                                      resumableEnumeration=resumableEnumeration,
+                                                      observationalEquivalence=observationalEquivalence)
+            timeline.end(phase)
             result.trainSearchTime = {t: tm for t, tm in times.items() if tm is not None}
         else:
             eprint("Skipping top-down enumeration because we are not using the generative model")
@@ -664,6 +813,7 @@ def ecIterator(grammar, tasks,
                     eprint(f"Found an annealing schedule; using {initialTimeout}s enumeration.")
                     enumeration_time = initialTimeout
                     
+            phase = timeline.begin("recognition_0", j, timeline.available())
             tasks_hit_recognition_0 = \
              sleep_recognition(result, grammar, wakingTaskBatch, tasks, testingTasks, result.allFrontiers.values(),
                                ensembleSize=ensembleSize, 
@@ -673,8 +823,9 @@ def ecIterator(grammar, tasks,
                                timeout=recognitionTimeout, evaluationTimeout=evaluationTimeout,
                                enumerationTimeout=enumeration_time,
                                helmholtzRatio=thisRatio, helmholtzFrontiers=helmholtzFrontiers(),
-                               auxiliaryLoss=auxiliaryLoss, cuda=cuda, CPUs=CPUs, solver=solver,
+                               auxiliaryLoss=auxiliaryLoss, cuda=cuda, CPUs=phase["CPUs"], solver=solver,
                                recognitionSteps=recognitionSteps, maximumFrontier=maximumFrontier,
+                               recognitionBatchSize=recognitionBatchSize,
                                featureExtractor=featureExtractor, 
                                language_encoder=language_encoder,
                                recognitionEpochs=recognitionEpochs[recognition_iteration],
@@ -685,7 +836,12 @@ def ecIterator(grammar, tasks,
                                language_lexicon=None,
                                test_only_after_recognition=test_only_after_recognition,
                                pretrained_word_embeddings=pretrained_word_embeddings,
-                               max_mem_per_enumeration_thread=max_mem_per_enumeration_thread)
+                               max_mem_per_enumeration_thread=max_mem_per_enumeration_thread,
+                               persistentSolvers=persistentSolvers,
+                               resumableEnumeration=resumableEnumeration,
+                               observationalEquivalence=observationalEquivalence,
+                               concurrentEnsemble=concurrentEnsemble)
+            timeline.end(phase)
 
             showHitMatrix(tasksHitTopDown, tasks_hit_recognition_0, wakingTaskBatch)
             
@@ -735,6 +891,7 @@ def ecIterator(grammar, tasks,
                     eprint(f"Found an annealing schedule; using {initialTimeout}s enumeration.")
                     enumeration_time = initialTimeout
                     
+            phase = timeline.begin("recognition_1", j, timeline.available())
             tasks_hit_recognition_1 = \
              sleep_recognition(result, grammar, wakingTaskBatch, tasks, testingTasks, result.allFrontiers.values(),
                                ensembleSize=ensembleSize, 
@@ -744,8 +901,9 @@ def ecIterator(grammar, tasks,
                                timeout=recognitionTimeout, evaluationTimeout=evaluationTimeout,
                                enumerationTimeout=enumeration_time,
                                helmholtzRatio=thisRatio, helmholtzFrontiers=helmholtzFrontiers(),
-                               auxiliaryLoss=auxiliaryLoss, cuda=cuda, CPUs=CPUs, solver=solver,
+                               auxiliaryLoss=auxiliaryLoss, cuda=cuda, CPUs=phase["CPUs"], solver=solver,
                                recognitionSteps=recognitionSteps, maximumFrontier=maximumFrontier,
+                               recognitionBatchSize=recognitionBatchSize,
                                featureExtractor=featureExtractor, 
                                language_encoder=language_encoder,
                                recognitionEpochs=recognitionEpochs[recognition_iteration],
@@ -758,7 +916,12 @@ def ecIterator(grammar, tasks,
                                helmholtz_translation_info=translation_info,
                                test_only_after_recognition=test_only_after_recognition,
                                pretrained_word_embeddings=pretrained_word_embeddings,
-                               max_mem_per_enumeration_thread=max_mem_per_enumeration_thread)
+                               max_mem_per_enumeration_thread=max_mem_per_enumeration_thread,
+                               persistentSolvers=persistentSolvers,
+                               resumableEnumeration=resumableEnumeration,
+                               observationalEquivalence=observationalEquivalence,
+                               concurrentEnsemble=concurrentEnsemble)
+            timeline.end(phase)
 
             showHitMatrix(tasksHitTopDown, tasks_hit_recognition_1, wakingTaskBatch)
             
@@ -777,11 +940,12 @@ def ecIterator(grammar, tasks,
         
         # Interactive mode.
         if interactive or useWakeLanguage:
+            phase = timeline.begin("wakeLanguage", j, timeline.available())
             tasks_hit_parser = default_wake_language(grammar, wakingTaskBatch,
                                     testingTasks=testingTasks,
                                     maximumFrontier=maximumFrontier,
                                     enumerationTimeout=enumerationTimeout,
-                                    CPUs=CPUs,
+                                    CPUs=phase["CPUs"],
                                     solver=solver,
                                     parser=parserModel,
                                     interactiveTasks=interactiveTasks,
@@ -791,6 +955,7 @@ def ecIterator(grammar, tasks,
                                     language_encoder=language_encoder,
                                     cuda=cuda,
                                     epochs=recognitionEpochs)
+            timeline.end(phase)
                                     
             for task in tasks_hit_parser:
                 if task not in result.allFrontiers: continue
@@ -822,17 +987,33 @@ def ecIterator(grammar, tasks,
                         output_dir = translation_info["output_dir"]
                 language_alignments = get_alignments(grammar=grammar, output_dir=output_dir)
                 
+            phase = timeline.begin("consolidation", j, timeline.available())
             grammar = consolidate(result, grammar, topK=topK, pseudoCounts=pseudoCounts, arity=arity, aic=aic,
-                                  structurePenalty=structurePenalty, compressor=compressor, CPUs=CPUs,
+                                  structurePenalty=structurePenalty, compressor=compressor, CPUs=phase["CPUs"],
                                   iteration=j, language_alignments=language_alignments,
                                   lc_score=lc_score,
                                   max_compression=max_compression)
+            timeline.end(phase)
             eprint(f"Currently using this much memory: {getThisMemoryUsage()}")
         else:
             eprint("Skipping consolidation.")
             result.grammars.append(grammar)
+
+        if timeline.background:
+            eprint("Waiting for held out testing to finish.")
+            timeline.join()
             
-        if outputPrefix is not None:
+        if outputPrefix is not None and incrementalCheckpoints:
+            if store is None or os.path.abspath(store.path) != os.path.abspath(checkpointStorePath()):
+                # Not resuming from this store: its first commit holds the whole result
+                store = CheckpointStore(checkpointStorePath())
+            path = store.commit(result, j + 1)
+            eprint("Exported iteration", j + 1, "to checkpoint store", store.path)
+            # No copy without the recognition models is written for graphing, as it is below:
+            # LazyECResult reads the store without loading them
+
+            graphPrimitives(result, "%s_primitives_%d_"%(outputPrefix,j))
+        elif outputPrefix is not None:
             path = checkpointPath(j + 1)
             with open(path, "wb") as handle:
                 try:
@@ -868,7 +1049,10 @@ def showHitMatrix(top, bottom, tasks):
 
 def evaluateOnTestingTasks(result, testingTasks, grammar, _=None,
                            CPUs=None, solver=None, maximumFrontier=None, enumerationTimeout=None, evaluationTimeout=None,
-                           test_dsl_only= False,max_mem_per_enumeration_thread=1000000):
+                           test_dsl_only= False,max_mem_per_enumeration_thread=1000000,
+                           persistentSolvers=False,
+                           resumableEnumeration=False,
+                           observationalEquivalence=False):
     
     if len(result.models) > 0 and not test_dsl_only:
         eprint("Evaluating on testing tasks using the recognizer.")
@@ -881,7 +1065,10 @@ def evaluateOnTestingTasks(result, testingTasks, grammar, _=None,
                                        enumerationTimeout=enumerationTimeout,
                                        evaluationTimeout=evaluationTimeout,
                                        testing=True,
-                                       max_mem_per_enumeration_thread=max_mem_per_enumeration_thread)
+                                       max_mem_per_enumeration_thread=max_mem_per_enumeration_thread,
+                                       persistentSolvers=persistentSolvers,
+                                       resumableEnumeration=resumableEnumeration,
+                                       observationalEquivalence=observationalEquivalence)
         updateTaskSummaryMetrics(result.recognitionTaskMetrics, recognizer.taskGrammarLogProductions(testingTasks), 'heldoutTaskLogProductions')
         updateTaskSummaryMetrics(result.recognitionTaskMetrics, recognizer.taskGrammarEntropies(testingTasks), 'heldoutTaskGrammarEntropies')
         updateTaskSummaryMetrics(result.recognitionTaskMetrics, recognizer.taskGrammarEntropies(testingTasks), 'heldoutTaskGrammarEntropies')
@@ -895,7 +1082,10 @@ def evaluateOnTestingTasks(result, testingTasks, grammar, _=None,
                                                        CPUs=CPUs,
                                                        evaluationTimeout=evaluationTimeout,
                                                        testing=True,
-                                                       max_mem_per_enumeration_thread=max_mem_per_enumeration_thread)
+                                                       max_mem_per_enumeration_thread=max_mem_per_enumeration_thread,
+                                                       persistentSolvers=persistentSolvers,
+                                                       resumableEnumeration=resumableEnumeration,
+                                                       observationalEquivalence=observationalEquivalence)
     updateTaskSummaryMetrics(result.recognitionTaskMetrics, times, 'heldoutTestingTimes')
     updateTaskSummaryMetrics(result.recognitionTaskMetrics,
                                      {f.task: f for f in testingFrontiers if len(f) > 0 },
@@ -908,6 +1098,33 @@ def evaluateOnTestingTasks(result, testingTasks, grammar, _=None,
     eprint("Hits %d/%d testing tasks" % (len(times), len(testingTasks)))
     result.testingSearchTime.append(times)
 
+def evaluateOnTestingTasksInBackground(timeline, iteration, result, testingTasks, grammar, CPUs=None, **keywords):
+    """Runs evaluateOnTestingTasks in a forked process launched on the timeline, so that waking and sleeping can
+    go on meanwhile on the other CPUs. Its results are merged into result once the timeline sees that it finished."""
+    models = list(result.models)
+
+    def test():
+        scratch = ECResult(models=models)
+        evaluateOnTestingTasks(scratch, testingTasks, grammar, CPUs=CPUs, **keywords)
+        return scratch.recognitionTaskMetrics, scratch.frontiersOverTime, scratch.testSearchTime, scratch.testingSearchTime
+
+    def merge(value):
+        metrics, frontiersOverTime, testSearchTime, testingSearchTime = value
+        # Tasks come back as copies: swap them for our own
+        canonical = {t: t for t in testingTasks}
+        def frontier(f): return Frontier(f.entries, task=canonical.get(f.task, f.task))
+        for fs in frontiersOverTime.values():
+            for f in fs: result.recordFrontier(frontier(f))
+        for t, m in metrics.items():
+            t = canonical.get(t, t)
+            for key, v in m.items():
+                updateTaskSummaryMetrics(result.recognitionTaskMetrics,
+                                         {t: frontier(v) if isinstance(v, Frontier) else v}, key)
+        result.testSearchTime = {canonical.get(t, t): tm for t, tm in testSearchTime.items()}
+        result.testingSearchTime.extend(testingSearchTime)
+
+    timeline.launch("testing", iteration, CPUs, test, merge)
+
 def default_wake_language(grammar, tasks, 
                     testingTasks,
                     maximumFrontier=None,
@@ -965,7 +1182,10 @@ def default_wake_generative(grammar, tasks,
                     CPUs=None,
                     solver=None,
                     evaluationTimeout=None,
-                    max_mem_per_enumeration_thread=1000000):
+                    max_mem_per_enumeration_thread=1000000,
+                    persistentSolvers=False,
+                    resumableEnumeration=False,
+                    observationalEquivalence=False):
     topDownFrontiers, times = multicoreEnumeration(grammar, tasks, 
                                                    args=args,
                                                    maximumFrontier=maximumFrontier,
@@ -973,7 +1193,10 @@ def default_wake_generative(grammar, tasks,
                                                    CPUs=CPUs,
                                                    solver=solver,
                                                    evaluationTimeout=evaluationTimeout,
-                                                   max_mem_per_enumeration_thread=max_mem_per_enumeration_thread)
+                                                   max_mem_per_enumeration_thread=max_mem_per_enumeration_thread,
+                                                   persistentSolvers=persistentSolvers,
+                                                   resumableEnumeration=resumableEnumeration,
+                                                   observationalEquivalence=observationalEquivalence)
     eprint("Generative model enumeration results:")
     eprint(Frontier.describe(topDownFrontiers))
     summaryStatistics("Generative model", [t for t in times.values() if t is not None])
@@ -1009,7 +1232,7 @@ def induce_synchronous_grammar(frontiers, tasks, testingTasks, tasksAttempted, g
 def sleep_recognition(result, grammar, taskBatch, tasks, testingTasks, allFrontiers, _=None,
                       ensembleSize=1, featureExtractor=None, matrixRank=None, mask=False,
                       activation=None, contextual=True, biasOptimal=True,
-                      previousRecognitionModel=None, recognitionSteps=None,
+                      previousRecognitionModel=None, recognitionSteps=None, recognitionBatchSize=1,
                       timeout=None, enumerationTimeout=None, evaluationTimeout=None,
                       helmholtzRatio=None, helmholtzFrontiers=None, maximumFrontier=None,
                       auxiliaryLoss=None, cuda=None, CPUs=None, solver=None,
@@ -1024,7 +1247,11 @@ def sleep_recognition(result, grammar, taskBatch, tasks, testingTasks, allFronti
                       helmholtz_translation_info=None,
                       test_only_after_recognition=False,
                       pretrained_word_embeddings=None,
-                      max_mem_per_enumeration_thread=1000000):
+                      max_mem_per_enumeration_thread=1000000,
+                      persistentSolvers=False,
+                      resumableEnumeration=False,
+                      observationalEquivalence=False,
+                      concurrentEnsemble=False):
     ### Pre-check: have we discovered any program solutions on the training set?
     ## If not, we have no data from which to train a joint language-example-based model, so we skip this round if you required training on both language and examples.
     n_frontiers = len([f for f in allFrontiers if not f.empty])
@@ -1074,18 +1301,21 @@ def sleep_recognition(result, grammar, taskBatch, tasks, testingTasks, allFronti
                                     nearest_tasks=nearest_tasks,
                                     id=i) for i in range(ensembleSize)]
     eprint(f"Currently using this much memory: {getThisMemoryUsage()}")
+    # Every member of the ensemble trains at the same time, each sampling Helmholtz programs on its own CPUs
+    memberCPUs = max(1, CPUs // len(recognizers))
     trainedRecognizers = parallelMap(min(CPUs,len(recognizers)),
                                      lambda recognizer: recognizer.train(allFrontiers,
                                                                          biasOptimal=biasOptimal,
                                                                          helmholtzFrontiers=helmholtzFrontiers, 
-                                                                         CPUs=CPUs,
+                                                                         CPUs=memberCPUs,
                                                                          evaluationTimeout=evaluationTimeout,
                                                                          timeout=timeout,
                                                                          steps=recognitionSteps,
                                                                          helmholtzRatio=helmholtzRatio,
                                                                          auxLoss=auxiliaryLoss,
                                                                          vectorized=True,
-                                                                         epochs=recognitionEpochs),
+                                                                         epochs=recognitionEpochs,
+                                                                         batchSize=recognitionBatchSize),
                                      recognizers,
                                      seedRandom=True)
     eprint(f"Currently using this much memory: {getThisMemoryUsage()}")
@@ -1098,7 +1328,10 @@ def sleep_recognition(result, grammar, taskBatch, tasks, testingTasks, allFronti
                                solver=solver,
                                enumerationTimeout=enumerationTimeout, evaluationTimeout=evaluationTimeout,
                                test_dsl_only=False,
-                               max_mem_per_enumeration_thread=max_mem_per_enumeration_thread)   
+                               max_mem_per_enumeration_thread=max_mem_per_enumeration_thread,
+                               persistentSolvers=persistentSolvers,
+                               resumableEnumeration=resumableEnumeration,
+                               observationalEquivalence=observationalEquivalence)   
         
         sys.exit(0)
     # Enumerate frontiers for each of the recognizers.
@@ -1107,21 +1340,35 @@ def sleep_recognition(result, grammar, taskBatch, tasks, testingTasks, allFronti
     mostTasks = 0
     bestRecognizer = None
     totalTasksHitBottomUp = set()
+    enumerationOptions = dict(CPUs=CPUs,
+                              maximumFrontier=maximumFrontier,
+                              enumerationTimeout=enumerationTimeout,
+                              evaluationTimeout=evaluationTimeout,
+                              solver=solver,
+                              max_mem_per_enumeration_thread=max_mem_per_enumeration_thread,
+                              persistentSolvers=persistentSolvers,
+                              resumableEnumeration=resumableEnumeration,
+                              observationalEquivalence=observationalEquivalence)
+    concurrentEnsemble = concurrentEnsemble and len(trainedRecognizers) > 1
+    if concurrentEnsemble:
+        # One enumeration for the whole ensemble, whose frontiers all of the recognizers share
+        eprint("Enumerating from all %d recognizers at once" % len(trainedRecognizers))
+        bottomupFrontiers, _, ensembleRecognitionTimes = \
+            RecognitionModel.enumerateEnsembleFrontiers(trainedRecognizers, taskBatch, **enumerationOptions)
+        ensembleFrontiers = [bottomupFrontiers]
     for recIndex, recognizer in enumerate(trainedRecognizers):
-        eprint("Enumerating from recognizer %d of %d" % (recIndex, len(trainedRecognizers)))
-        bottomupFrontiers, allRecognitionTimes = \
-                        recognizer.enumerateFrontiers(taskBatch, 
-                                                      CPUs=CPUs,
-                                                      maximumFrontier=maximumFrontier,
-                                                      enumerationTimeout=enumerationTimeout,
-                                                      evaluationTimeout=evaluationTimeout,
-                                                      solver=solver,
-                                                      max_mem_per_enumeration_thread=max_mem_per_enumeration_thread)
-        ensembleFrontiers.append(bottomupFrontiers)
+        if concurrentEnsemble:
+            allRecognitionTimes = ensembleRecognitionTimes[recIndex]
+            recognizerTasksHitBottomUp = {t for t, tm in allRecognitionTimes.items() if tm is not None}
+        else:
+            eprint("Enumerating from recognizer %d of %d" % (recIndex, len(trainedRecognizers)))
+            bottomupFrontiers, allRecognitionTimes = \
+                            recognizer.enumerateFrontiers(taskBatch, **enumerationOptions)
+            ensembleFrontiers.append(bottomupFrontiers)
+            ensembleRecognitionTimes.append(allRecognitionTimes)
+            recognizerTasksHitBottomUp = {f.task for f in bottomupFrontiers if not f.empty}
         ensembleTimes.append([t for t in allRecognitionTimes.values() if t is not None])
-        ensembleRecognitionTimes.append(allRecognitionTimes)
 
-        recognizerTasksHitBottomUp = {f.task for f in bottomupFrontiers if not f.empty}
         totalTasksHitBottomUp.update(recognizerTasksHitBottomUp)
         eprint("Recognizer %d solved %d/%d tasks; total tasks solved is now %d." % (recIndex, len(recognizerTasksHitBottomUp), len(tasks), len(totalTasksHitBottomUp)))
         if len(recognizerTasksHitBottomUp) >= mostTasks:
@@ -1150,8 +1397,12 @@ def sleep_recognition(result, grammar, taskBatch, tasks, testingTasks, allFronti
     eprint(f"Currently using this much memory: {getThisMemoryUsage()}")
 
     """ Rescore and combine the frontiers across the ensemble of recognition models."""
-    eprint("Recognition model enumeration results for the best recognizer.")
-    eprint(Frontier.describe(ensembleFrontiers[bestRecognizer]))
+    if concurrentEnsemble:
+        eprint("Recognition model enumeration results shared by the whole ensemble.")
+        eprint(Frontier.describe(ensembleFrontiers[0]))
+    else:
+        eprint("Recognition model enumeration results for the best recognizer.")
+        eprint(Frontier.describe(ensembleFrontiers[bestRecognizer]))
     summaryStatistics("Recognition model", ensembleTimes[bestRecognizer])
 
     eprint("Cumulative results for the full ensemble of %d recognizers: " % len(trainedRecognizers))
@@ -1354,6 +1605,57 @@ def commandlineArguments(_=None,
                         default=1000000000,	
                         type=int,
                         help="""The maximum memory to allow for an enumeration thread.""")
+    parser.add_argument("--persistentSolvers",
+                        action="store_true",
+                        default=False,
+                        help="""Run ocaml enumeration jobs on a pool of long-lived solver processes,
+                        which are sent each DSL and task once, instead of launching a new solver for every job.""")
+    parser.add_argument("--resumableEnumeration",
+                        action="store_true",
+                        default=False,
+                        help="""With the python solver: keep the search state of each enumeration job
+                        in a long-lived process, so that each budget increment picks up where the last one stopped
+                        instead of enumerating again from scratch.""")
+    parser.add_argument("--observationalEquivalence",
+                        action="store_true",
+                        default=False,
+                        help="""With the python solver: run each enumerated program once on the inputs of all of the tasks it is enumerated for,
+                        and skip programs computing the same outputs as one with no greater description length.
+                        Frontiers lose those equivalent programs.""")
+    parser.add_argument("--streamHelmholtz",
+                        action="store_true",
+                        default=False,
+                        help="""Read Helmholtz enumeration results one frontier at a time as the helmholtz binary writes them,
+                        keeping only a random sample of at most the feature extractor's maximum_helmholtz frontiers,
+                        instead of decoding the whole response at once.""")
+    parser.add_argument("--incrementalCheckpoints",
+                        action="store_true",
+                        default=False,
+                        help="""Write checkpoints to an append-only directory where each iteration only stores what changed
+                        (new frontiers, the new grammar, recognition weights as state_dicts) instead of pickling the whole ECResult.
+                        --resume accepts the directory, or an iteration number to resume from it, which must be its last iteration.
+                        Load it lazily for graphing with LazyECResult. Unlike ordinary checkpoints, no "_graph=True" copy without the
+                        recognition models is written: the store keeps their weights in separate files, which LazyECResult never reads
+                        unless asked for the models.""")
+    parser.add_argument("--symmetryRules",
+                        nargs="?",
+                        const="",
+                        default=None,
+                        help="""Prune programs with the symmetry-breaking rules mined by bin/symmetryBreaking.py, on top of the built-in ones.
+                        Takes the JSON file of rules; without one, uses the rules saved for the primitives of the grammar under data/symmetry.
+                        Only affects the python solver.""")
+    parser.add_argument("--concurrentEnsemble",
+                        action="store_true",
+                        default=False,
+                        help="""With an --ensembleSize above 1, enumerate from all of the recognition models at once,
+                        sharing the CPUs and the frontiers between them, instead of one after the other.
+                        Tasks whose frontier is full stop being searched by every model.""")
+    parser.add_argument("--pipelinePhases",
+                        action="store_true",
+                        default=False,
+                        help="""Test on the held out tasks in the background while waking and sleeping, instead of before them.
+                        Testing gets a share of the CPUs in proportion to its enumeration budget and returns it once done.
+                        Either way, when each phase ran and on how many CPUs is recorded in the phaseTimeline of the result.""")
     parser.add_argument("--skip_first_test",	
                         action="store_true",	
                         dest="skip_first_test",	
@@ -1399,6 +1701,10 @@ def commandlineArguments(_=None,
                         default=None,
                         help="Number of gradient steps to train the recognition model. Can be specified instead of train time or epochs.",
                         type=int)
+    parser.add_argument("--recognitionBatchSize",
+                        default=1,
+                        help="Number of frontiers in each gradient step of recognition model training. default: 1",
+                        type=int)
     parser.add_argument(
         "-k",
         "--topK",
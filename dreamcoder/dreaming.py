@@ -8,18 +8,18 @@ from pathos.multiprocessing import Pool
 from dreamcoder.domains.arithmetic.arithmeticPrimitives import k1, k0, addition, subtraction, multiplication
 from dreamcoder.frontier import Frontier, FrontierEntry
 from dreamcoder.grammar import Grammar
-from dreamcoder.program import Program
+from dreamcoder.program import Program, ProgramInterner
 from dreamcoder.recognition import RecognitionModel, DummyFeatureExtractor
 from dreamcoder.task import Task
 from dreamcoder.type import arrow, tint
 from dreamcoder.utilities import tuplify, timing, eprint, get_root_dir, mean, unfrozendict
 
 
-def helmholtzEnumeration(g, request, inputs, timeout, _=None,
-                         special=None, evaluationTimeout=None,
-                         use_vars_in_tokenized=False, executable=None,
-                         maximum_size=5000000):
-    """Returns json (as text)"""
+def helmholtzMessage(g, request, inputs, timeout, _=None,
+                     special=None, evaluationTimeout=None,
+                     use_vars_in_tokenized=False,
+                     maximum_size=5000000, stream=False):
+    """The request for the helmholtz binary (as text)"""
     message = {"request": request.json(),
                "timeout": timeout,
                "DSL": g.json(),
@@ -28,9 +28,21 @@ def helmholtzEnumeration(g, request, inputs, timeout, _=None,
     if evaluationTimeout: message["evaluationTimeout"] = evaluationTimeout
     if special: message["special"] = special
     if use_vars_in_tokenized: message["use_vars_in_tokenized"] = use_vars_in_tokenized
+    if stream: message["stream"] = True
     message = json.dumps(message)
     with open('/tmp/hm', 'w') as handle:
         handle.write(message)
+    return message
+
+def helmholtzEnumeration(g, request, inputs, timeout, _=None,
+                         special=None, evaluationTimeout=None,
+                         use_vars_in_tokenized=False, executable=None,
+                         maximum_size=5000000):
+    """Returns json (as text)"""
+    message = helmholtzMessage(g, request, inputs, timeout,
+                               special=special, evaluationTimeout=evaluationTimeout,
+                               use_vars_in_tokenized=use_vars_in_tokenized,
+                               maximum_size=maximum_size)
     try:
         binary_name = 'helmholtz' if executable is None else executable
         binary = os.path.join(get_root_dir(), binary_name)
@@ -39,16 +51,57 @@ def helmholtzEnumeration(g, request, inputs, timeout, _=None,
                                    stdout=subprocess.PIPE)
         response, error = process.communicate(bytes(message, encoding="utf-8"))
     except Exception as exc:
-        print("ERROR: %s", exc)
+        eprint("ERROR:", exc)
         return ""
     return response
 
+def streamingHelmholtzEnumeration(g, request, inputs, timeout, _=None,
+                                  special=None, evaluationTimeout=None,
+                                  use_vars_in_tokenized=False, executable=None,
+                                  maximum_size=5000000):
+    """Starts the helmholtz binary in the background;
+    returns the process, whose stdout has one frontier per line (as json), or None if it could not be started"""
+    message = helmholtzMessage(g, request, inputs, timeout,
+                               special=special, evaluationTimeout=evaluationTimeout,
+                               use_vars_in_tokenized=use_vars_in_tokenized,
+                               maximum_size=maximum_size, stream=True)
+    try:
+        binary_name = 'helmholtz' if executable is None else executable
+        binary = os.path.join(get_root_dir(), binary_name)
+        process = subprocess.Popen(binary,
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE)
+        process.stdin.write(bytes(message, encoding="utf-8"))
+        process.stdin.close()
+    except Exception as exc:
+        eprint("ERROR:", exc)
+        return None
+    return process
+
+def helmholtzFrontier(g, request, name, entry, parse=Program.parse):
+    return Frontier([FrontierEntry(program=parse(p),
+                                   logPrior=entry["ll"],
+                                   logLikelihood=0.,
+                                   tokens=g.escape_tokens_string(tokens).split())
+                     for p, tokens in zip(entry["programs"], entry["tokens"])],
+                    task=Task(name,
+                              request,
+                              []))
+
 def backgroundHelmholtzEnumeration(tasks, g, timeout, _=None,
                                    special=None, evaluationTimeout=None,
                                    use_vars_in_tokenized=False, dedup=True,
                                    executable=None,
                                    serialize_special=None,
-                                   maximum_size=None):
+                                   maximum_size=None,
+                                   stream=False):
+    """
+    Enumerates dreams for each request in the background; returns a function which waits for them and returns the frontiers.
+    maximum_size: keep a uniformly random subset of at most this many frontiers.
+    stream: have the helmholtz binary write one frontier per line, which we read as it comes.
+    Only a reservoir sample of maximum_size frontiers is ever parsed & held in memory,
+    and programs share their common subtrees.
+    """
     requests = list({t.request for t in tasks})
     if serialize_special is None:
          def _s(x): return x
@@ -58,6 +111,13 @@ def backgroundHelmholtzEnumeration(tasks, g, timeout, _=None,
     inputs = {r:  [serialize_x_fn(unfrozendict(x)) for x in list({tuplify(xs) for t in tasks if t.request == r
                    for xs, y in t.examples})]
               for r in requests}
+    if stream:
+        return streamingHelmholtzFrontiers(requests, inputs, g, timeout,
+                                           special=special, evaluationTimeout=evaluationTimeout,
+                                           use_vars_in_tokenized=use_vars_in_tokenized,
+                                           executable=executable,
+                                           maximum_size=maximum_size)
+
     workers = Pool(len(requests))
     promises = [workers.apply_async(helmholtzEnumeration,
                                     args=(g, r, inputs[r], float(timeout)),
@@ -75,14 +135,7 @@ def backgroundHelmholtzEnumeration(tasks, g, timeout, _=None,
                 try:
                     response = json.loads(result.decode("utf-8"))
                     for b, entry in enumerate(response):
-                        frontiers.append(Frontier([FrontierEntry(program=Program.parse(p),
-                                                                 logPrior=entry["ll"],
-                                                                 logLikelihood=0.,
-                                                                 tokens=g.escape_tokens_string(tokens).split())
-                                                   for p, tokens in zip(entry["programs"], entry["tokens"])],
-                                                  task=Task(str(b),
-                                                            request,
-                                                            [])))
+                        frontiers.append(helmholtzFrontier(g, request, str(b), entry))
                 except:
                     continue
         eprint("Total number of Helmholtz frontiers:", len(frontiers))
@@ -94,6 +147,68 @@ def backgroundHelmholtzEnumeration(tasks, g, timeout, _=None,
 
     return get
 
+def helmholtzEntries(process):
+    """
+    Yields a function returning each of the frontiers written by a helmholtz process (as json),
+    so that frontiers which are not kept are never decoded.
+    A binary built before streaming was supported ignores "stream" and writes all of them as one json list.
+    """
+    for line in process.stdout:
+        if not line.lstrip().startswith(b"["):
+            yield lambda line=line: json.loads(line)
+            continue
+        eprint("WARNING: The helmholtz binary does not stream its frontiers. Rebuild it to save memory.")
+        try:
+            entries = json.loads(line)
+        except ValueError as exc:
+            eprint("ERROR: Could not decode the frontiers of the helmholtz binary:", exc)
+            return
+        for entry in entries:
+            yield lambda entry=entry: entry
+
+def streamingHelmholtzFrontiers(requests, inputs, g, timeout, _=None,
+                                special=None, evaluationTimeout=None,
+                                use_vars_in_tokenized=False, executable=None,
+                                maximum_size=None):
+    processes = [streamingHelmholtzEnumeration(g, r, inputs[r], float(timeout),
+                                               special=special,
+                                               evaluationTimeout=evaluationTimeout,
+                                               use_vars_in_tokenized=use_vars_in_tokenized,
+                                               executable=executable)
+                 for r in requests]
+
+    def get():
+        # Reservoir sampling: after seeing n frontiers, each of them is in the reservoir with probability maximum_size/n.
+        # Lines that would not make it into the reservoir are never decoded.
+        frontiers = []
+        n = 0
+        parse = ProgramInterner().parse
+        with timing("(Helmholtz enumeration) Streamed json into frontiers"):
+            for request, process in zip(requests, processes):
+                if process is None: continue
+                for b, entry in enumerate(helmholtzEntries(process)):
+                    n += 1
+                    if maximum_size is None or len(frontiers) < maximum_size:
+                        slot = len(frontiers)
+                    else:
+                        slot = random.randrange(n)
+                        if slot >= maximum_size: continue
+                    try:
+                        frontier = helmholtzFrontier(g, request, str(b), entry(), parse=parse)
+                    except:
+                        continue
+                    if slot == len(frontiers):
+                        frontiers.append(frontier)
+                    else:
+                        frontiers[slot] = frontier
+                process.wait()
+        eprint("Total number of Helmholtz frontiers:", n)
+        if maximum_size is not None and n > maximum_size:
+            eprint("Took %d random Helmholtz frontiers." % len(frontiers))
+        return frontiers
+
+    return get
+
 
 if __name__ == "__main__":
     g = Grammar.uniform([k1, k0, addition, subtraction, multiplication])
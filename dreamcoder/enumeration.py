@@ -1,8 +1,10 @@
 from dreamcoder.likelihoodModel import AllOrNothingLikelihoodModel
 from dreamcoder.grammar import *
-from dreamcoder.utilities import get_root_dir, limit_virtual_memory_fn
+from dreamcoder.task import EvaluationTimeout
+from dreamcoder.utilities import get_root_dir, limit_virtual_memory_fn, CPUTimeLimit
 
 import os
+import pickle
 import traceback
 import subprocess
 
@@ -17,8 +19,30 @@ def multicoreEnumeration(g, tasks, _=None,
                          evaluationTimeout=None,
                          testing=False,
                          unigramGrammar=None,
-                         max_mem_per_enumeration_thread=1000000):
-    '''g: Either a Grammar, or a map from task to grammar.
+                         max_mem_per_enumeration_thread=1000000,
+                         persistentSolvers=False,
+                         resumableEnumeration=False,
+                         observationalEquivalence=False,
+                         workStealing=True,
+                         windowSeconds=None,
+                         jobMetrics=None,
+                         memberSearchTimes=None):
+    '''g: Either a Grammar, or a map from task to grammar,
+    or a list of those: one for each member of an ensemble, which all share the CPUs and the frontiers.
+    Once the frontier of a task is full, no member keeps searching for it.
+    persistentSolvers: dispatch ocaml jobs to a pool of long-lived solver processes (see SolverPool),
+    rather than launching a new solver process for every job.
+    resumableEnumeration: python solver only. Each job keeps its search state (see EnumerationState)
+    in a long-lived process, so each budget increment continues where the previous one stopped.
+    observationalEquivalence: python solver only. Skip programs equivalent on the tasks' inputs
+    to one of no greater description length (see ObservationalEquivalence).
+    workStealing: CPUs that no job is waiting for run the next MDL windows of jobs that are already running,
+    when JobSchedule expects those windows to finish before the job times out.
+    windowSeconds: how long each MDL window should take; windows are resized as jobs are timed (see JobSchedule).
+    Defaults to a tenth of the enumeration timeout, between 1 and 20 seconds.
+    jobMetrics: if a dict, filled with the JobSchedule.metrics of each job, keyed on (grammar, request).
+    memberSearchTimes: if a list, filled with a map from task to search time for each member of the ensemble:
+    how long its grammar took to find a program solving the task, or None.
     Returns (list-of-frontiers, map-from-task-to-search-time)'''
 
     # We don't use actual threads but instead use the multiprocessing
@@ -41,10 +65,15 @@ def multicoreEnumeration(g, tasks, _=None,
       likelihoodModel = AllOrNothingLikelihoodModel(timeout=evaluationTimeout) 
       
     solver = solvers[solver]
+    assert not resumableEnumeration or solver is solveForTask_python, \
+        "Resumable enumeration is only supported by the python solver."
+    assert not observationalEquivalence or solver is solveForTask_python, \
+        "Observational equivalence pruning is only supported by the python solver."
+    # Options only the python solver takes
+    solverOptions = {"observationalEquivalence": True} if observationalEquivalence else {}
 
-    if not isinstance(g, dict):
-        g = {t: g for t in tasks}
-    task2grammar = g
+    members = [m if isinstance(m, dict) else {t: m for t in tasks}
+               for m in (g if isinstance(g, list) else [g])]
 
     # If we are not evaluating on held out testing tasks:
     # Bin the tasks by request type and grammar
@@ -52,26 +81,48 @@ def multicoreEnumeration(g, tasks, _=None,
     # If we are evaluating testing tasks:
     # Make sure that each job corresponds to exactly one task
     jobs = {}
-    for i, t in enumerate(tasks):
-        if testing:
-            k = (task2grammar[t], t.request, i)
-        else:
-            k = (task2grammar[t], t.request)
-        jobs[k] = jobs.get(k, []) + [t]
+    # Map from job to the ensemble members whose grammar it enumerates
+    jobMembers = {}
+    for m, task2grammar in enumerate(members):
+        for i, t in enumerate(tasks):
+            if testing:
+                k = (task2grammar[t], t.request, i)
+            else:
+                k = (task2grammar[t], t.request)
+            if t not in jobs.get(k, []): jobs[k] = jobs.get(k, []) + [t]
+            jobMembers[k] = jobMembers.get(k, set()) | {m}
 
+    solverPool = None
     disableParallelism = len(jobs) == 1
-    parallelCallback = launchParallelProcess if not disableParallelism else lambda f, * \
-        a, **k: f(*a, **k)
-    if disableParallelism:
+    if persistentSolvers and solver is solveForTask_ocaml:
+        solverPool = SolverPool(max_mem_per_enumeration_thread=max_mem_per_enumeration_thread)
+        parallelCallback = solverPool.launch
+    elif disableParallelism:
         eprint("Disabling parallelism on the Python side because we only have one job.")
         eprint("If you are using ocaml, there could still be parallelism.")
+        parallelCallback = lambda f, *a, **k: wrapInThread(f)(*a, **k)
+    else:
+        parallelCallback = launchParallelProcess
+    # Map from job to the process that holds its search state
+    resumableProcesses = {}
 
     # Map from task to the shortest time to find a program solving it
-    bestSearchTime = {t: None for t in task2grammar}
-
-    lowerBounds = {k: 0. for k in jobs}
-
-    frontiers = {t: Frontier([], task=t) for t in task2grammar}
+    bestSearchTime = {t: None for t in tasks}
+    searchTimeOfMember = [{t: None for t in tasks} for _ in members]
+
+    schedules = {k: JobSchedule() for k in jobs}
+    if windowSeconds is None:
+        windowSeconds = 10. if enumerationTimeout is None else min(20., max(1., enumerationTimeout / 10.))
+    # Stealing needs jobs that run in the background, and can run several windows at once
+    workStealing = workStealing and not disableParallelism and not resumableEnumeration and not testing
+    # The python solver only ever uses one CPU; the rest of its allocation is better stolen
+    CPUsPerWindow = 1 if workStealing and solver is solveForTask_python else CPUs
+    startTime = time.time()
+
+    frontiers = {t: Frontier([], task=t) for t in tasks}
+    # Sources of the programs in each frontier, and the best log posterior among them
+    sources = {t: set() for t in tasks}
+    bestScores = {t: NEGATIVEINFINITY for t in tasks}
 
     # For each job we keep track of how long we have been working on it
     stopwatches = {t: Stopwatch() for t in jobs}
@@ -82,17 +133,6 @@ def multicoreEnumeration(g, tasks, _=None,
     def numberOfHits(f):
         return sum(e.logLikelihood > -0.01 for e in f)
 
-    def budgetIncrement(lb):
-        if True:
-            return 1.5
-        # Very heuristic - not sure what to do here
-        if lb < 24.:
-            return 1.
-        elif lb < 27.:
-            return 0.5
-        else:
-            return 0.25
-
     def maximumFrontiers(j):
         tasks = jobs[j]
         return {t: maximumFrontier - numberOfHits(frontiers[t]) for t in tasks}
@@ -102,7 +142,7 @@ def multicoreEnumeration(g, tasks, _=None,
         while n > 0:
             for t in tasks:
                 # During testing we use exactly one CPU per task
-                if testing and allocation[t] > 0:
+                if (testing or allocation[t] >= CPUsPerWindow) and allocation[t] > 0:
                     return allocation
                 allocation[t] += 1
                 n -= 1
@@ -130,10 +170,59 @@ def multicoreEnumeration(g, tasks, _=None,
     id2CPUs = {}
     # What job was each ID working on?
     id2job = {}
+    # Which tasks did it get? Results refer to them by position
+    id2tasks = {}
     nextID = 0
 
+    def launch(j, CPUs, stolen=False):
+        nonlocal nextID, activeCPUs
+        g, request = j[:2]
+        schedule = schedules[j]
+        thisTimeout = enumerationTimeout - stopwatches[j].elapsed
+        # A stolen window has to be done before the job runs out of time
+        bi = schedule.increment(CPUs, min(windowSeconds, thisTimeout) if stolen else windowSeconds)
+        lowerBound = schedule.lowerBound
+        eprint("(python) Launching %s (%d tasks) w/ %d CPUs. %f <= MDL < %f. Timeout %f.%s" %
+               (request, len(jobs[j]), CPUs, lowerBound, lowerBound + bi, thisTimeout,
+                " Stolen." if stolen else ""))
+        # Bookkeeping comes first: with a single job the callback runs the whole window before returning
+        ID = nextID
+        nextID += 1
+        id2CPUs[ID] = CPUs
+        id2job[ID] = j
+        id2tasks[ID] = jobs[j]
+        schedule.launched(ID, lowerBound + bi, CPUs, stolen)
+        activeCPUs += CPUs
+        if not stopwatches[j].running: stopwatches[j].start()
+        callback = parallelCallback
+        if resumableEnumeration:
+            if j not in resumableProcesses:
+                resumableProcesses[j] = ResumableEnumerationProcess(q, g, request)
+            callback = resumableProcesses[j].launch
+        callback(solveEncoded,
+                         solver=solver,
+                         args=args,
+                         q=q, g=g, ID=ID,
+                         elapsedTime=stopwatches[j].elapsed,
+                         CPUs=CPUs,
+                         tasks=jobs[j],
+                         lowerBound=lowerBound,
+                         upperBound=lowerBound + bi,
+                         budgetIncrement=bi,
+                         timeout=thisTimeout,
+                         evaluationTimeout=evaluationTimeout,
+                         maximumFrontiers=maximumFrontiers(j),
+                         testing=testing,
+                         likelihoodModel=likelihoodModel,
+                         unigramGrammar=unigramGrammar,
+                         max_mem_per_enumeration_thread=max_mem_per_enumeration_thread,
+                         **solverOptions)
+
     while True:
         refreshJobs()
+        # Search states of jobs that are over, and have no window in flight, are of no further use
+        for j in [j for j in resumableProcesses if j not in jobs and not schedules[j].running]:
+            resumableProcesses.pop(j).close()
         # Don't launch a job that we are already working on
         # We run the stopwatch whenever the job is being worked on
         # freeJobs are things that we are not working on but could be
@@ -142,41 +231,29 @@ def multicoreEnumeration(g, tasks, _=None,
         if freeJobs and activeCPUs < CPUs:
             # Allocate a CPU to each of the jobs that we have made the least
             # progress on
-            freeJobs.sort(key=lambda j: lowerBounds[j])
+            freeJobs.sort(key=lambda j: schedules[j].lowerBound)
             # Launch some more jobs until all of the CPUs are being used
             availableCPUs = CPUs - activeCPUs
             allocation = allocateCPUs(availableCPUs, freeJobs)
             for j in freeJobs:
                 if allocation[j] == 0:
                     continue
-                g, request = j[:2]
-                bi = budgetIncrement(lowerBounds[j])
-                thisTimeout = enumerationTimeout - stopwatches[j].elapsed
-                eprint("(python) Launching %s (%d tasks) w/ %d CPUs. %f <= MDL < %f. Timeout %f." %
-                       (request, len(jobs[j]), allocation[j], lowerBounds[j], lowerBounds[j] + bi, thisTimeout))
-                stopwatches[j].start()
-                parallelCallback(solver,
-                                 args=args,
-                                 q=q, g=g, ID=nextID,
-                                 elapsedTime=stopwatches[j].elapsed,
-                                 CPUs=allocation[j],
-                                 tasks=jobs[j],
-                                 lowerBound=lowerBounds[j],
-                                 upperBound=lowerBounds[j] + bi,
-                                 budgetIncrement=bi,
-                                 timeout=thisTimeout,
-                                 evaluationTimeout=evaluationTimeout,
-                                 maximumFrontiers=maximumFrontiers(j),
-                                 testing=testing,
-                                 likelihoodModel=likelihoodModel,
-                                 unigramGrammar=unigramGrammar,
-                                 max_mem_per_enumeration_thread=max_mem_per_enumeration_thread)
-                id2CPUs[nextID] = allocation[j]
-                id2job[nextID] = j
-                nextID += 1
-
-                activeCPUs += allocation[j]
-                lowerBounds[j] += bi
+                launch(j, allocation[j])
+
+        if workStealing:
+            # Nobody is waiting for the idle CPUs: run the next windows of the jobs that have been going longest,
+            # as long as those windows can finish in time. Otherwise the CPUs wait for the next regular window.
+            busyJobs = [j for j in jobs if stopwatches[j].running
+                        and stopwatches[j].elapsed < enumerationTimeout - 0.5]
+            busyJobs.sort(key=lambda j: schedules[j].oldestLaunch)
+            stealing = True
+            while stealing and activeCPUs < CPUs:
+                stealing = False
+                for j in busyJobs:
+                    if activeCPUs >= CPUs: break
+                    if schedules[j].canSteal(enumerationTimeout - stopwatches[j].elapsed):
+                        launch(j, 1, stolen=True)
+                        stealing = True
 
         # If nothing is running, and we just tried to launch jobs,
         # then that means we are finished
@@ -193,42 +270,168 @@ def multicoreEnumeration(g, tasks, _=None,
         elif message.result == "success":
             # Mark the CPUs is no longer being used and pause the stopwatch
             activeCPUs -= id2CPUs[message.ID]
-            stopwatches[id2job[message.ID]].stop()
-
-            newFrontiers, searchTimes, pc = message.value
-            for t, f in newFrontiers.items():
-                oldBest = None if len(
-                    frontiers[t]) == 0 else frontiers[t].bestPosterior
-                frontiers[t] = frontiers[t].combine(f)
-                newBest = None if len(
-                    frontiers[t]) == 0 else frontiers[t].bestPosterior
-
+            jobTasks = id2tasks.pop(message.ID)
+            newEntries, searchTimes, pc = message.value
+            j = id2job[message.ID]
+            schedule = schedules[j]
+            schedule.finished(message.ID, pc)
+            if not schedule.running:
+                stopwatches[j].stop()
+
+            # Parsed once even if they solve several tasks
+            parsed = {}
+            for t, entries, dt in zip(jobTasks, newEntries, searchTimes):
                 taskToNumberOfPrograms[t] += pc
+                if not entries: continue
+
+                if any(source in sources[t] for source, *_ in entries):
+                    # Same program found twice: let combine reconcile the entries
+                    frontiers[t] = frontiers[t].combine(decodeSearchFrontier(t, entries, parsed))
+                    sources[t] = {str(e.program) for e in frontiers[t]}
+                    newScore = max(e.logPrior + e.logLikelihood for e in frontiers[t])
+                else:
+                    # Windows do not overlap, so usually the new entries can just be appended
+                    frontiers[t] = Frontier(frontiers[t].entries + decodeSearchFrontier(t, entries, parsed).entries,
+                                            task=t)
+                    sources[t].update(source for source, *_ in entries)
+                    newScore = max(bestScores[t], max(logPrior + logLikelihood
+                                                      for _, logPrior, logLikelihood, _ in entries))
 
-                dt = searchTimes[t]
                 if dt is not None:
+                    for m in jobMembers[j]:
+                        if searchTimeOfMember[m][t] is None or dt < searchTimeOfMember[m][t]:
+                            searchTimeOfMember[m][t] = dt
                     if bestSearchTime[t] is None:
                         bestSearchTime[t] = dt
-                    else:
-                        # newBest & oldBest should both be defined
-                        assert oldBest is not None
-                        assert newBest is not None
-                        newScore = newBest.logPrior + newBest.logLikelihood
-                        oldScore = oldBest.logPrior + oldBest.logLikelihood
-
-                        if newScore > oldScore:
-                            bestSearchTime[t] = dt
-                        elif newScore == oldScore:
-                            bestSearchTime[t] = min(bestSearchTime[t], dt)
+                    elif newScore > bestScores[t]:
+                        bestSearchTime[t] = dt
+                    elif newScore == bestScores[t]:
+                        bestSearchTime[t] = min(bestSearchTime[t], dt)
+                bestScores[t] = newScore
         else:
             eprint("Unknown message result:", message.result)
             assert False
 
+    if solverPool is not None:
+        solverPool.close()
+    for p in resumableProcesses.values():
+        p.close()
+
     eprint("We enumerated this many programs, for each task:\n\t",
            list(taskToNumberOfPrograms.values()))
+    wallTime = time.time() - startTime
+    for j, schedule in schedules.items():
+        metrics = schedule.metrics(wallTime, CPUs)
+        if jobMetrics is not None: jobMetrics[j[:2]] = metrics
+        eprint("(python) Job %s: %d windows (%d stolen), %d programs at %.0f/s, %.0f%% of the CPUs, reached MDL %f." %
+               (j[1], metrics["windows"], metrics["stolen"], metrics["programs"],
+                metrics["programsPerSecond"], 100*metrics["utilization"], metrics["lowerBound"]))
+    if memberSearchTimes is not None: memberSearchTimes.extend(searchTimeOfMember)
 
     return [frontiers[t] for t in tasks], bestSearchTime
 
+class JobSchedule(object):
+    """
+    Everything multicoreEnumeration knows about the progress of one job: the MDL windows it has
+    handed out, and how long the finished ones took, from which it sizes the next window.
+    Assumes that enumerating the window [b, b + w) costs about exp(b + w): there are at most exp(b)
+    programs of description length b, and the solvers walk through the ones below b again to get to
+    the window. So windows narrower than a nat mostly repeat work, and are never handed out.
+    """
+    # Width of the first window, before anything has been timed
+    initialIncrement = 1.5
+    smallestIncrement = 1.
+    largestIncrement = 4.
+    # Most windows of one job that may be in flight at once
+    maximumRunning = 4
+
+    def __init__(self):
+        # Where the next window starts
+        self.lowerBound = 0.
+        # Map from ID to the (lowerBound, upperBound, CPUs, launch time) of each window in flight
+        self.running = {}
+        self.windows = 0
+        self.stolen = 0
+        self.programs = 0
+        # CPU seconds taken by the finished windows
+        self.busy = 0.
+        # Log of the CPU seconds per unit of exp(upper bound), as of the latest window to finish
+        self.logCost = None
+
+    @property
+    def oldestLaunch(self):
+        return min((launch for _, _, _, launch in self.running.values()), default=float('inf'))
+
+    def width(self, CPUs, seconds):
+        """Width of the next window that would take about that many seconds on that many CPUs,
+        or None before anything has been timed. Can be narrower than smallestIncrement, or negative."""
+        if self.logCost is None or seconds <= 0: return None
+        return math.log(seconds * CPUs) - self.logCost - self.lowerBound
+
+    def increment(self, CPUs, seconds):
+        """Width of the next window, so that it takes about that many seconds on that many CPUs"""
+        w = self.width(CPUs, seconds)
+        if w is None: return self.initialIncrement
+        return min(self.largestIncrement, max(self.smallestIncrement, w))
+
+    def canSteal(self, seconds):
+        """Can one more window of this job run on one CPU, and finish within seconds?"""
+        if len(self.running) >= self.maximumRunning: return False
+        w = self.width(1, seconds)
+        return w is not None and w >= self.smallestIncrement
+
+    def launched(self, ID, upperBound, CPUs, stolen=False):
+        self.running[ID] = (self.lowerBound, upperBound, CPUs, time.time())
+        self.lowerBound = upperBound
+        self.stolen += stolen
+
+    def finished(self, ID, programs):
+        lowerBound, upperBound, CPUs, launch = self.running.pop(ID)
+        seconds = time.time() - launch
+        self.windows += 1
+        self.programs += programs
+        self.busy += seconds * CPUs
+        if seconds > 0:
+            self.logCost = math.log(seconds * CPUs) - upperBound
+
+    def metrics(self, wallTime, CPUs):
+        return {"windows": self.windows,
+                "stolen": self.stolen,
+                "programs": self.programs,
+                "CPUSeconds": self.busy,
+                "programsPerSecond": self.programs / self.busy if self.busy > 0 else 0.,
+                "utilization": self.busy / (wallTime * CPUs) if wallTime > 0 else 0.,
+                "lowerBound": self.lowerBound}
+
+def encodeSearchResult(tasks, result):
+    """
+    Compact form of the (frontiers, searchTimes, number of programs enumerated) that a solver returns,
+    which is what workers send back to multicoreEnumeration. Tasks are referred to by their position in
+    tasks, rather than sent back with all of their examples, and programs by their source.
+    Each frontier becomes a list of (source, logPrior, logLikelihood, tokens).
+    """
+    frontiers, searchTimes, pc = result
+    return ([[(str(e.program), e.logPrior, e.logLikelihood, e.tokens) for e in frontiers[t]]
+             for t in tasks],
+            [searchTimes[t] for t in tasks],
+            pc)
+
+def decodeSearchFrontier(task, entries, parsed=None):
+    """Frontier of task from its entries in the result of encodeSearchResult.
+    parsed: optional map from source to program, shared between calls"""
+    if parsed is None: parsed = {}
+    frontier = []
+    for source, logPrior, logLikelihood, tokens in entries:
+        if source not in parsed: parsed[source] = Program.parse(source)
+        frontier.append(FrontierEntry(program=parsed[source],
+                                      logPrior=logPrior, logLikelihood=logLikelihood,
+                                      tokens=tokens))
+    return Frontier(frontier, task=task)
+
+def solveEncoded(_=None, solver=None, tasks=None, **k):
+    """Runs solver (one of the solveForTask_* functions) and encodes its result with encodeSearchResult"""
+    return encodeSearchResult(tasks, solver(tasks=tasks, **k))
+
 def wrapInThread(f):
     """
     Returns a function that is designed to be run in a thread/threadlike process.
@@ -254,6 +457,85 @@ def wrapInThread(f):
     return _f
 
 OCAML_TEST_FLAG = "is_ocaml_test" # Indicates a JSON response intended for testing.
+
+def ocamlTaskMessage(t):
+    """The JSON that the ocaml solver expects for a task"""
+    serialized_examples = []
+    for xs, y in t.examples:
+        if hasattr(t, "serializeSpecialInput"):
+            xs = t.serializeSpecialInput(xs)
+        if hasattr(t, "serializeSpecialOutput"):
+            y = t.serializeSpecialOutput(y, is_output=True)
+        serialized_examples.append({"inputs": list(xs), "output": y})
+
+    m = {
+        "examples": serialized_examples,
+        "name": t.name,
+        "request": t.request.json()}
+    if hasattr(t, "specialTask"):
+        special, extra = t.specialTask
+        m["specialTask"] = special
+        m["extras"] = extra
+    if hasattr(t, "raw_programs_to_test"):
+        m["raw_programs_to_test"] = t.raw_programs_to_test
+    return m
+
+def ocamlSearchMessage(tasks, CPUs=1, timeout=None,
+                       lowerBound=None, upperBound=None, budgetIncrement=None,
+                       verbose=False):
+    """Everything the ocaml solver needs for a job besides the DSL and the tasks"""
+    message = {"nc": CPUs,
+               "timeout": timeout,
+               "lowerBound": lowerBound,
+               "upperBound": upperBound,
+               "budgetIncrement": budgetIncrement,
+               "verbose": verbose,
+               "shatter": 5 if len(tasks) == 1 and "turtle" in str(tasks[0].request) else 10}
+    if hasattr(tasks[0], 'maxParameters') and tasks[0].maxParameters is not None:
+        message["maxParameters"] = tasks[0].maxParameters
+    return message
+
+def ocamlSolverFile(tasks):
+    solver_file = 'solver'
+    if hasattr(tasks[0], 'specialSolver'):
+        solver_file = tasks[0].specialSolver
+    return os.path.join(get_root_dir(), solver_file)
+
+def frontiersOfOcamlResponse(response, g, tasks, elapsedTime=0., unigramGrammar=None):
+    """Converts the response of the ocaml solver into (frontiers, searchTimes, number of programs enumerated)"""
+    def escape_tokens(tokens):
+        if unigramGrammar is not None:
+            return unigramGrammar.escape_tokens_string(tokens)
+        return g.escape_tokens_string(tokens)
+
+    pc = response.get("number_enumerated",0)  # TODO
+    frontiers = {}
+    searchTimes = {}
+    for t in tasks:
+        solutions = response[t.name]
+        frontier = Frontier([FrontierEntry(program=p,
+                                           logLikelihood=e["logLikelihood"],
+                                           tokens=escape_tokens(e["tokens"]).split(),
+                                           logPrior=g.logLikelihood(t.request, p))
+                             for e in solutions 
+                             for p in [Program.parse(e["program"])]],
+                            task=t)        
+        frontiers[t] = frontier
+        if frontier.empty:
+            searchTimes[t] = None
+        # This is subtle:
+        # The search time we report is actually not be minimum time to find any solution
+        # Rather it is the time to find the MAP solution
+        # This is important for regression problems,
+        # where we might find something with a good prior but bad likelihood early on,
+        # and only later discovered the good high likelihood program
+        else:
+            searchTimes[t] = min(
+                (e["logLikelihood"] + e["logPrior"],
+                 e["time"]) for e in solutions)[1] + elapsedTime
+
+    return frontiers, searchTimes, pc
+
 def solveForTask_ocaml(
     _=None,
                         args=None,
@@ -271,62 +553,34 @@ def solveForTask_ocaml(
 
     import json
 
-    from dreamcoder.domains.list.listPrimitives import basePrimitives, primitives, McCarthyPrimitives, bootstrapTarget_extra, no_length
+    if args is not None and "primitives" in args:
+        from dreamcoder.domains.list.listPrimitives import basePrimitives, primitives, McCarthyPrimitives, bootstrapTarget_extra, no_length
+
+        # updates the global PRIMITIVES list in case we're on mac so we did a multithreading spawn instead of a fork
+        {"base": basePrimitives,
+        "McCarthy": McCarthyPrimitives,
+        "common": bootstrapTarget_extra,
+        "noLength": no_length,
+        "rich": primitives}[args["primitives"]]() 
 
-    # updates the global PRIMITIVES list in case we're on mac so we did a multithreading spawn instead of a fork
-    {"base": basePrimitives,
-    "McCarthy": McCarthyPrimitives,
-    "common": bootstrapTarget_extra,
-    "noLength": no_length,
-    "rich": primitives}[args["primitives"]]() 
-    
     def taskMessage(t):
-        serialized_examples = []
-        for xs, y in t.examples:
-            if hasattr(t, "serializeSpecialInput"):
-                xs = t.serializeSpecialInput(xs)
-            if hasattr(t, "serializeSpecialOutput"):
-                y = t.serializeSpecialOutput(y, is_output=True)
-            serialized_examples.append({"inputs": list(xs), "output": y})
-        
-        m = {
-            "examples": serialized_examples,
-            "name": t.name,
-            "request": t.request.json(),
-            "maximumFrontier": maximumFrontiers[t]}
-        if hasattr(t, "specialTask"):
-            special, extra = t.specialTask
-            m["specialTask"] = special
-            m["extras"] = extra
-        if hasattr(t, "raw_programs_to_test"):
-            m["raw_programs_to_test"] = t.raw_programs_to_test
+        m = ocamlTaskMessage(t)
+        m["maximumFrontier"] = maximumFrontiers[t]
         return m
 
-
     message = {"DSL": g.json(),
                "tasks": [taskMessage(t)
                          for t in tasks],
-               "programTimeout": evaluationTimeout,
-               "nc": CPUs,
-               "timeout": timeout,
-               "lowerBound": lowerBound,
-               "upperBound": upperBound,
-               "budgetIncrement": budgetIncrement,
-               "verbose": verbose,
-               "shatter": 5 if len(tasks) == 1 and "turtle" in str(tasks[0].request) else 10}
-
-    if hasattr(tasks[0], 'maxParameters') and tasks[0].maxParameters is not None:
-        message["maxParameters"] = tasks[0].maxParameters
+               "programTimeout": evaluationTimeout}
+    message.update(ocamlSearchMessage(tasks, CPUs=CPUs, timeout=timeout,
+                                      lowerBound=lowerBound, upperBound=upperBound,
+                                      budgetIncrement=budgetIncrement, verbose=verbose))
 
     message = json.dumps(message)
     # uncomment this if you want to save the messages being sent to the solver
     
-    solver_file = 'solver'
-    if hasattr(tasks[0], 'specialSolver'):
-        solver_file = tasks[0].specialSolver
-
     try:
-        solver_file = os.path.join(get_root_dir(), solver_file)
+        solver_file = ocamlSolverFile(tasks)
         process = subprocess.Popen(solver_file,
                                    stdin=subprocess.PIPE,
                                    stdout=subprocess.PIPE)
@@ -347,41 +601,152 @@ def solveForTask_ocaml(
         print("ERROR in enumeration, returning empty frontiers for this batch of tasks.")
         response = {t.name : [] for t in tasks} # Empty response 
 
-    def escape_tokens(tokens):
-        if unigramGrammar is not None:
-            return unigramGrammar.escape_tokens_string(tokens)
-        return g.escape_tokens_string(tokens)
-
     if OCAML_TEST_FLAG in response:
         return response
         
-    pc = response.get("number_enumerated",0)  # TODO
-    frontiers = {}
-    searchTimes = {}
-    for t in tasks:
-        solutions = response[t.name]
-        frontier = Frontier([FrontierEntry(program=p,
-                                           logLikelihood=e["logLikelihood"],
-                                           tokens=escape_tokens(e["tokens"]).split(),
-                                           logPrior=g.logLikelihood(t.request, p))
-                             for e in solutions 
-                             for p in [Program.parse(e["program"])]],
-                            task=t)        
-        frontiers[t] = frontier
-        if frontier.empty:
-            searchTimes[t] = None
-        # This is subtle:
-        # The search time we report is actually not be minimum time to find any solution
-        # Rather it is the time to find the MAP solution
-        # This is important for regression problems,
-        # where we might find something with a good prior but bad likelihood early on,
-        # and only later discovered the good high likelihood program
-        else:
-            searchTimes[t] = min(
-                (e["logLikelihood"] + e["logPrior"],
-                 e["time"]) for e in solutions)[1] + elapsedTime
+    return frontiersOfOcamlResponse(response, g, tasks,
+                                    elapsedTime=elapsedTime, unigramGrammar=unigramGrammar)
 
-    return frontiers, searchTimes, pc
+class SolverWorker(object):
+    """
+    A long-lived `solver --worker` process.
+    Messages in both directions are framed as a decimal byte count on its own line,
+    followed by that many bytes of JSON.
+    The worker remembers every grammar and task registered with it,
+    so each of them only has to be serialized and sent once.
+    """
+    def __init__(self, solverFile, max_mem_per_enumeration_thread=1000000):
+        self.solverFile = solverFile
+        self.process = subprocess.Popen([solverFile, "--worker"],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+        limit_virtual_memory_with_psutil_if_possible(self.process, max_mem_per_enumeration_thread)
+        # IDs of the grammars and tasks that this worker already knows about
+        self.grammars = set()
+        self.tasks = set()
+
+    def send(self, message):
+        import json
+        message = json.dumps(message).encode("utf-8")
+        self.process.stdin.write(b"%d\n" % len(message))
+        self.process.stdin.write(message)
+        self.process.stdin.flush()
+
+    def receive(self):
+        import json
+        header = self.process.stdout.readline()
+        if not header:
+            raise EOFError("solver worker %s exited with code %s" % (self.solverFile, self.process.poll()))
+        return json.loads(self.process.stdout.read(int(header)).decode("utf-8"))
+
+    def close(self):
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except:
+            self.process.kill()
+
+class SolverPool(object):
+    """
+    Pool of long-lived ocaml solver processes, used by multicoreEnumeration in place of
+    launching one solver process per job.
+    Grammars and tasks get integer IDs the first time that they are seen,
+    and are registered with each worker at most once.
+    Jobs run on background threads, which report back through the same queue as launchParallelProcess.
+    """
+    def __init__(self, max_mem_per_enumeration_thread=1000000):
+        self.max_mem_per_enumeration_thread = max_mem_per_enumeration_thread
+        # map from solver file to idle workers for that solver
+        self.idle = {}
+        self.workers = []
+        self.grammarIDs = {}
+        self.taskIDs = {}
+        import threading
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _identify(table, x):
+        if x not in table:
+            table[x] = len(table)
+        return table[x]
+
+    def acquire(self, solverFile):
+        with self.lock:
+            idle = self.idle.get(solverFile, [])
+            if idle:
+                return idle.pop()
+        worker = SolverWorker(solverFile, self.max_mem_per_enumeration_thread)
+        with self.lock:
+            self.workers.append(worker)
+        return worker
+
+    def release(self, worker):
+        with self.lock:
+            self.idle.setdefault(worker.solverFile, []).append(worker)
+
+    def discard(self, worker):
+        with self.lock:
+            self.workers.remove(worker)
+        worker.process.kill()
+
+    def solve(self, _=None,
+              args=None,
+              elapsedTime=0.,
+              CPUs=1,
+              g=None, tasks=None,
+              lowerBound=None, upperBound=None, budgetIncrement=None,
+              timeout=None,
+              evaluationTimeout=None, maximumFrontiers=None,
+              unigramGrammar=None,
+              verbose=False,
+              **_k):
+        """Same contract as solveForTask_ocaml, but runs on one of the workers in the pool"""
+        with self.lock:
+            gi = self._identify(self.grammarIDs, g)
+            tis = [self._identify(self.taskIDs, t) for t in tasks]
+        worker = self.acquire(ocamlSolverFile(tasks))
+        try:
+            if gi not in worker.grammars:
+                worker.send({"registerGrammar": gi, "DSL": g.json()})
+                worker.grammars.add(gi)
+            for ti, t in zip(tis, tasks):
+                if ti not in worker.tasks:
+                    worker.send({"registerTask": ti, "task": ocamlTaskMessage(t),
+                                 "programTimeout": evaluationTimeout})
+                    worker.tasks.add(ti)
+            message = {"grammar": gi,
+                       "tasks": tis,
+                       "maximumFrontiers": [maximumFrontiers[t] for t in tasks]}
+            message.update(ocamlSearchMessage(tasks, CPUs=CPUs, timeout=timeout,
+                                              lowerBound=lowerBound, upperBound=upperBound,
+                                              budgetIncrement=budgetIncrement, verbose=verbose))
+            worker.send(message)
+            response = worker.receive()
+        except Exception as e:
+            # Don't fail on errors, but don't reuse a worker that is in an unknown state
+            eprint("ERROR in solver worker, returning empty frontiers for this batch of tasks:", e)
+            self.discard(worker)
+            response = {t.name : [] for t in tasks}
+        else:
+            self.release(worker)
+
+        return frontiersOfOcamlResponse(response, g, tasks,
+                                        elapsedTime=elapsedTime, unigramGrammar=unigramGrammar)
+
+    def launch(self, f, *a, **k):
+        """Drop-in replacement for launchParallelProcess when f runs solveForTask_ocaml through solveEncoded"""
+        import threading
+        assert f is solveEncoded and k["solver"] is solveForTask_ocaml
+        k["solver"] = self.solve
+        thread = threading.Thread(target=wrapInThread(f), args=a, kwargs=k)
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+        self.workers = []
+        self.idle = {}
 
 def solveForTask_pypy(_=None,
                       elapsedTime=0.,
@@ -401,13 +766,17 @@ def solveForTask_pypy(_=None,
                         lowerBound=lowerBound, upperBound=upperBound,unigramGrammar=None)
 
 def solveForTask_python(_=None,
+                        args=None,
                         elapsedTime=0.,
                         g=None, tasks=None,
                         lowerBound=None, upperBound=None, budgetIncrement=None,
                         timeout=None,
                         CPUs=1,
                         likelihoodModel=None,
-                        evaluationTimeout=None, maximumFrontiers=None, testing=False,unigramGrammar=None):
+                        evaluationTimeout=None, maximumFrontiers=None, testing=False,unigramGrammar=None,
+                        max_mem_per_enumeration_thread=None,
+                        enumerationState=None,
+                        observationalEquivalence=False):
     return enumerateForTasks(g, tasks, likelihoodModel,
                              timeout=timeout,
                              testing=testing,
@@ -415,12 +784,138 @@ def solveForTask_python(_=None,
                              evaluationTimeout=evaluationTimeout,
                              maximumFrontiers=maximumFrontiers,
                              budgetIncrement=budgetIncrement,
-                             lowerBound=lowerBound, upperBound=upperBound,unigramGrammar=None)
+                             lowerBound=lowerBound, upperBound=upperBound,unigramGrammar=None,
+                             enumerationState=enumerationState,
+                             observationalEquivalence=observationalEquivalence)
+
 
+class ResumableEnumerationProcess(object):
+    """
+    Long-lived process which owns the EnumerationState of one multicoreEnumeration job.
+    The search state is far too large to send between processes,
+    so instead every window of the job runs in this process, which keeps the state in between.
+    launch has the same contract as launchParallelProcess, except that q is fixed when the process starts.
+    """
+    def __init__(self, q, g, request):
+        from multiprocessing import Pipe, Process
+        self.request = request
+        self.connection, child = Pipe()
+        self.process = Process(target=ResumableEnumerationProcess._serve,
+                               args=(q, child, EnumerationState(g, request)))
+        self.process.daemon = True
+        self.process.start()
+
+    @staticmethod
+    def _serve(q, connection, enumerationState):
+        import dill
+        while True:
+            message = connection.recv()
+            if message is None:
+                return
+            f, k = dill.loads(message)
+            wrapInThread(f)(q=q, enumerationState=enumerationState, **k)
+
+    def launch(self, f, *a, **k):
+        import dill
+        assert not a
+        k.pop("q")
+        self.connection.send(dill.dumps((f, k)))
+
+    def close(self):
+        self.connection.send(None)
+        self.process.join()
 
 class EnumerationTimeout(Exception):
     pass
 
+class ObservationalEquivalence(object):
+    """
+    Prunes enumerated programs that compute the same function, on the inputs of the tasks being solved,
+    as a program of no greater description length seen before.
+    Programs are scored against every task in one go: each distinct input is run at most once,
+    under one timer, and each task stops at its first wrong output, as Task.check does.
+    Only programs that solve some task get a signature (their outputs on every input),
+    because a program solving nothing never enters a frontier, and checking it is cheaper than running it everywhere.
+    This is only sound for the all-or-nothing likelihood of tasks that do not override check or logLikelihood,
+    and it trades away frontier entries: a frontier never holds two programs that compute the same thing.
+    """
+    UNKNOWN = object()
+
+    def __init__(self, tasks, evaluationTimeout=None):
+        self.tasks = tasks
+        # Union of the inputs of the tasks, along with the task whose predict runs each
+        self.inputs = []
+        # For each task, the positions of its inputs in self.inputs
+        self.positions = []
+        seen = {}
+        for t in tasks:
+            positions = []
+            for x, _ in t.examples:
+                k = tuplify(x)
+                if k not in seen:
+                    seen[k] = len(self.inputs)
+                    self.inputs.append((t, x))
+                positions.append(seen[k])
+            self.positions.append(positions)
+        # A program that loops forever would have timed out once per task when checked separately
+        self.timeout = None if evaluationTimeout is None else evaluationTimeout * len(tasks)
+        # Map from signature to the smallest description length of a program with that signature
+        self.signatures = {}
+        self.evaluated = 0
+        self.pruned = 0
+
+    @staticmethod
+    def applies(tasks, likelihoodModel):
+        return isinstance(likelihoodModel, AllOrNothingLikelihoodModel) and \
+            all(type(t).check is Task.check and type(t).logLikelihood is Task.logLikelihood and not t.cache
+                for t in tasks)
+
+    def score(self, p, descriptionLength):
+        """None if p is equivalent to a program seen before, otherwise a list with the log likelihood of each task.
+        If p times out, each entry is None and the tasks have to be scored separately."""
+        self.evaluated += 1
+        try:
+            with CPUTimeLimit(self.timeout, EvaluationTimeout):
+                try:
+                    # Compiled right away: p is about to run on many inputs, and will not be checked again
+                    f = ProgramCompiler().compile(p)()
+                except Exception:
+                    return [NEGATIVEINFINITY for _ in self.tasks]
+                outputs = [ObservationalEquivalence.UNKNOWN] * len(self.inputs)
+
+                def output(i):
+                    if outputs[i] is ObservationalEquivalence.UNKNOWN:
+                        t, x = self.inputs[i]
+                        try:
+                            outputs[i] = t.predict(f, x)
+                        except EvaluationTimeout:
+                            raise
+                        except BaseException:
+                            outputs[i] = None
+                    return outputs[i]
+
+                likelihoods = [NEGATIVEINFINITY if any(output(i) != y for i, (_, y) in zip(positions, t.examples)) else 0.
+                               for t, positions in zip(self.tasks, self.positions)]
+                if all(l == NEGATIVEINFINITY for l in likelihoods): return likelihoods
+
+                for i in range(len(self.inputs)): output(i)
+        except EvaluationTimeout:
+            return [None for _ in self.tasks]
+
+        try:
+            # Equal pickles mean equal outputs; the converse can fail (e.g. 1 and 1.0), which only prunes less
+            signature = pickle.dumps(outputs)
+        except Exception:
+            # Unpicklable outputs, such as functions: can still score, but not prune
+            return likelihoods
+        best = self.signatures.get(signature)
+        if best is not None and best <= descriptionLength:
+            self.pruned += 1
+            return None
+        self.signatures[signature] = descriptionLength
+        return likelihoods
+
+
 def enumerateForTasks(g, tasks, likelihoodModel, _=None,
                       verbose=False,
                       timeout=None,
@@ -430,7 +925,16 @@ def enumerateForTasks(g, tasks, likelihoodModel, _=None,
                       evaluationTimeout=None,
                       lowerBound=0.,
                       upperBound=100.,
-                      budgetIncrement=1.0, maximumFrontiers=None,unigramGrammar=None):
+                      budgetIncrement=1.0, maximumFrontiers=None,unigramGrammar=None,
+                      enumerationState=None,
+                      observationalEquivalence=False):
+    """enumerationState: an EnumerationState for g and the tasks' request.
+    If given, enumeration continues from wherever that state stopped,
+    which may be below lowerBound if a previous call timed out in the middle of a window.
+    observationalEquivalence: skip programs that compute the same outputs on the tasks' inputs
+    as a program of no greater description length (see ObservationalEquivalence).
+    Ignored for tasks and likelihood models where that would change which tasks are solved.
+    Programs are only compared within this call, or across calls if there is an enumerationState."""
     assert timeout is not None, \
         "enumerateForTasks: You must provide a timeout."
 
@@ -445,6 +949,17 @@ def enumerateForTasks(g, tasks, likelihoodModel, _=None,
     # we will never maintain maximumFrontier best solutions
     hits = [PQ() for _ in tasks]
 
+    equivalence = None
+    if observationalEquivalence and ObservationalEquivalence.applies(tasks, likelihoodModel):
+        if enumerationState is None:
+            equivalence = ObservationalEquivalence(tasks, evaluationTimeout)
+        else:
+            # Keep the signatures of earlier windows along with the rest of the search state
+            if getattr(enumerationState, "observationalEquivalence", None) is None or \
+               enumerationState.observationalEquivalence.tasks != tasks:
+                enumerationState.observationalEquivalence = ObservationalEquivalence(tasks, evaluationTimeout)
+            equivalence = enumerationState.observationalEquivalence
+
     starting = time()
     previousBudget = lowerBound
     budget = lowerBound + budgetIncrement
@@ -455,19 +970,28 @@ def enumerateForTasks(g, tasks, likelihoodModel, _=None,
                 budget <= upperBound:
             numberOfPrograms = 0
 
-            for prior, _, p in g.enumeration(Context.EMPTY, [], request,
-                                             maximumDepth=99,
-                                             upperBound=budget,
-                                             lowerBound=previousBudget):
+            if enumerationState is None:
+                programs = g.enumeration(Context.EMPTY, [], request,
+                                         maximumDepth=99,
+                                         upperBound=budget,
+                                         lowerBound=previousBudget)
+            else:
+                programs = enumerationState.advance(budget)
+            for prior, _, p in programs:
                 descriptionLength = -prior
                 # Shouldn't see it on this iteration
                 assert descriptionLength <= budget
                 # Should already have seen it
-                assert descriptionLength > previousBudget
+                assert enumerationState is not None or descriptionLength > previousBudget
 
                 numberOfPrograms += 1
                 totalNumberOfPrograms += 1
 
+                likelihoods = None
+                if equivalence is not None:
+                    likelihoods = equivalence.score(p, descriptionLength)
+                    if likelihoods is None: continue
+
                 for n in range(len(tasks)):
                     task = tasks[n]
 
@@ -475,7 +999,11 @@ def enumerateForTasks(g, tasks, likelihoodModel, _=None,
                     #likelihood = task.logLikelihood(p, evaluationTimeout)
                     #if invalid(likelihood):
                         #continue
-                    success, likelihood = likelihoodModel.score(p, task)
+                    if likelihoods is not None and likelihoods[n] is not None:
+                        likelihood = likelihoods[n]
+                        success = valid(likelihood)
+                    else:
+                        success, likelihood = likelihoodModel.score(p, task)
                     if not success:
                         continue
                         
@@ -498,6 +1026,9 @@ def enumerateForTasks(g, tasks, likelihoodModel, _=None,
                 break
     except EnumerationTimeout:
         pass
+    if equivalence is not None:
+        eprint("(python) Observational equivalence pruned %d of %d programs (%d distinct solutions)." %
+               (equivalence.pruned, equivalence.evaluated, len(equivalence.signatures)))
     frontiers = {tasks[n]: Frontier([e for _, e in hits[n]],
                                     task=tasks[n])
                  for n in range(len(tasks))}
@@ -3,6 +3,8 @@ from dreamcoder.task import Task
 
 
 class FrontierEntry(object):
+    __slots__ = ("program", "logPrior", "logLikelihood", "logPosterior", "tokens", "_programKey")
+
     def __init__(
             self,
             program,
@@ -21,6 +23,27 @@ class FrontierEntry(object):
             else:
                 tokens = self.program.left_order_tokens(show_vars=False)
         self.tokens = tokens
+        self._programKey = None
+
+    def __getstate__(self):
+        return self.program, self.logPrior, self.logLikelihood, self.logPosterior, self.tokens
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            # backward compatibility: pickled as a dictionary before slots, and maybe before tokens
+            state = (state["program"], state["logPrior"], state["logLikelihood"], state["logPosterior"],
+                     state.get("tokens"))
+        self.program, self.logPrior, self.logLikelihood, self.logPosterior, self.tokens = state
+        self._programKey = None
+
+    @property
+    def programKey(self):
+        """str(self.program), computed once: frontiers break ties between entries with it"""
+        if self._programKey is None: self._programKey = str(self.program)
+        return self._programKey
+
+    def sortKey(self):
+        """Frontiers are sorted on this, best entry first"""
+        return (-self.logPosterior, self.programKey)
 
     def __repr__(self):
         return "FrontierEntry(program={self.program}, logPrior={self.logPrior}, logLikelihood={self.logLikelihood}".format(
@@ -28,9 +51,24 @@ class FrontierEntry(object):
 
 
 class Frontier(object):
+    # The entries, if they are known to be sorted by FrontierEntry.sortKey.
+    # topK and combine keep frontiers sorted, so that they only need to merge them.
+    sortedEntries = None
+
     def __init__(self, frontier, task):
         self.entries = frontier
         self.task = task
+        if type(frontier) is list and len(frontier) < 2: self.sortedEntries = frontier
+
+    @staticmethod
+    def fromSorted(entries, task):
+        """Frontier of entries that are already sorted by FrontierEntry.sortKey"""
+        f = Frontier(entries, task)
+        f.sortedEntries = entries
+        return f
+
+    @property
+    def isSorted(self): return self.sortedEntries is self.entries
 
     def __repr__(
         self): return "Frontier(entries={self.entries}, task={self.task})".format(self=self)
@@ -90,9 +128,9 @@ class Frontier(object):
                 e.logLikelihood -
                 z,
                 tokens=e.tokens) for e in self]
-        newEntries.sort(key=lambda e: e.logPosterior, reverse=True)
-        return Frontier(newEntries,
-                        self.task)
+        newEntries.sort(key=FrontierEntry.sortKey)
+        return Frontier.fromSorted(newEntries,
+                                   self.task)
 
     def expectedProductionUses(self, g):
         """Returns a vector of the expected number of times each production was used"""
@@ -119,9 +157,9 @@ class Frontier(object):
     def topK(self, k):
         if k == 0: return Frontier([], self.task)
         if k < 0: return self            
-        newEntries = sorted(self.entries,
-                            key=lambda e: (-e.logPosterior, str(e.program)))
-        return Frontier(newEntries[:k], self.task)
+        if self.isSorted: return Frontier.fromSorted(self.entries[:k], self.task)
+        newEntries = sorted(self.entries, key=FrontierEntry.sortKey)
+        return Frontier.fromSorted(newEntries[:k], self.task)
 
     def sample(self):
         """Samples an entry from a frontier"""
@@ -130,8 +168,8 @@ class Frontier(object):
 
     @property
     def bestPosterior(self):
-        return min(self.entries,
-                   key=lambda e: (-e.logPosterior, str(e.program)))
+        if self.isSorted and self.entries: return self.entries[0]
+        return min(self.entries, key=FrontierEntry.sortKey)
 
     def replaceWithSupervised(self, g):
         assert self.task.supervision is not None
@@ -191,45 +229,44 @@ class Frontier(object):
 
         x = {e.program: e for e in self}
         y = {e.program: e for e in other}
-        programs = set(x.keys()) | set(y.keys())
-        union = []
-        for p in programs:
-            if p in x:
-                e1 = x[p]
-                if p in y:
-                    e2 = y[p]
-                    if abs(e1.logPrior - e2.logPrior) > tolerance:
-                        eprint(
-                            "WARNING: Log priors differed during frontier combining: %f vs %f" %
-                            (e1.logPrior, e2.logPrior))
-                        eprint("WARNING: \tThe program is", p)
-                        eprint()
-                    if abs(e1.logLikelihood - e2.logLikelihood) > tolerance:
-                        foundDifference = True
-                        eprint(
-                            "WARNING: Log likelihoods deferred for %s: %f & %f" %
-                            (p, e1.logLikelihood, e2.logLikelihood))
-                        if hasattr(self.task, 'BIC'):
-                            eprint("\t%d examples, BIC=%f, parameterPenalty=%f, n parameters=%d, correct likelihood=%f" %
-                                   (len(self.task.examples),
-                                    self.task.BIC,
-                                    self.task.BIC * math.log(len(self.task.examples)),
-                                    substringOccurrences("REAL", str(p)),
-                                    substringOccurrences("REAL", str(p)) * self.task.BIC * math.log(len(self.task.examples))))
-                            e1.logLikelihood = - \
-                                substringOccurrences("REAL", str(p)) * self.task.BIC * math.log(len(self.task.examples))
-                            e2.logLikelihood = e1.logLikelihood
-
-                        e1 = FrontierEntry(
-                            program=e1.program,
-                            logLikelihood=(
-                                e1.logLikelihood +
-                                e2.logLikelihood) /
-                            2,
-                            logPrior=e1.logPrior)
-            else:
-                e1 = y[p]
-            union.append(e1)
+        # Entries we keep from self, those that we had to change, and those only in other
+        ours, changed = [], []
+        for p, e1 in x.items():
+            if p in y:
+                e2 = y[p]
+                if abs(e1.logPrior - e2.logPrior) > tolerance:
+                    eprint(
+                        "WARNING: Log priors differed during frontier combining: %f vs %f" %
+                        (e1.logPrior, e2.logPrior))
+                    eprint("WARNING: \tThe program is", p)
+                    eprint()
+                if abs(e1.logLikelihood - e2.logLikelihood) > tolerance:
+                    foundDifference = True
+                    eprint(
+                        "WARNING: Log likelihoods deferred for %s: %f & %f" %
+                        (p, e1.logLikelihood, e2.logLikelihood))
+                    if hasattr(self.task, 'BIC'):
+                        eprint("\t%d examples, BIC=%f, parameterPenalty=%f, n parameters=%d, correct likelihood=%f" %
+                               (len(self.task.examples),
+                                self.task.BIC,
+                                self.task.BIC * math.log(len(self.task.examples)),
+                                substringOccurrences("REAL", str(p)),
+                                substringOccurrences("REAL", str(p)) * self.task.BIC * math.log(len(self.task.examples))))
+                        e1.logLikelihood = - \
+                            substringOccurrences("REAL", str(p)) * self.task.BIC * math.log(len(self.task.examples))
+                        e2.logLikelihood = e1.logLikelihood
+
+                    e1 = FrontierEntry(
+                        program=e1.program,
+                        logLikelihood=(
+                            e1.logLikelihood +
+                            e2.logLikelihood) /
+                        2,
+                        logPrior=e1.logPrior)
+                    changed.append(e1)
+                    continue
+            ours.append(e1)
+        theirs = [e for p, e in y.items() if p not in x]
 
         if foundDifference:
             eprint(
@@ -237,4 +274,120 @@ class Frontier(object):
                 (self.task.name),
                 "\tThis is acceptable only if the likelihood model is stochastic. Took the geometric mean of the likelihoods.")
 
-        return Frontier(union, self.task)
+        if self.isSorted and other.isSorted and len(x) == len(self.entries) and len(y) == len(other.entries):
+            changed.sort(key=FrontierEntry.sortKey)
+            return Frontier.fromSorted(list(heapq.merge(ours, theirs, changed, key=FrontierEntry.sortKey)),
+                                       self.task)
+        return Frontier(ours + changed + theirs, self.task)
+
+
+class FrontierHistory(object):
+    """
+    Map from task to the frontiers recorded for it: history[task][k] is the frontier at the k-th record.
+    Stored compactly: each program is kept once, in a table shared by all of the tasks, and each
+    record of a task only stores the entries that changed since its previous record. Entries that
+    carried over are referred to by their position in the previous record.
+    Reads with the interface of the dictionary from task to list of frontiers that it replaces.
+    """
+
+    def __init__(self, frontiersOverTime=None):
+        # [(program, tokens)], and its inverse
+        self.programs = []
+        self.programIds = {}
+        # task -> [record], where a record is None when nothing changed, or else a list whose elements
+        # are either the position of an entry in the previous record or a new (program id, logPrior,
+        # logLikelihood, logPosterior)
+        self.versions = {}
+        # (task, k) -> Frontier, so that reading a frontier twice gives back the same object
+        self.frontiers = {}
+        for fs in (frontiersOverTime or {}).values():
+            for f in fs: self.record(f)
+
+    def __getstate__(self):
+        return self.programs, self.versions
+
+    def __setstate__(self, state):
+        self.programs, self.versions = state
+        self.programIds = None
+        self.frontiers = {}
+
+    def _programId(self, e):
+        if self.programIds is None:
+            self.programIds = {(p, tuple(tokens)): i for i, (p, tokens) in enumerate(self.programs)}
+        k = (e.program, tuple(e.tokens))
+        i = self.programIds.get(k)
+        if i is None:
+            i = len(self.programs)
+            self.programs.append((e.program, e.tokens))
+            self.programIds[k] = i
+        return i
+
+    def _entries(self, task, k):
+        """Encoded entries of the k-th record of task"""
+        entries = []
+        for record in self.versions[task][:k + 1]:
+            if record is None: continue
+            entries = [entries[x] if isinstance(x, int) else x for x in record]
+        return entries
+
+    def record(self, frontier):
+        t = frontier.task
+        versions = self.versions.setdefault(t, [])
+        entries = [(self._programId(e), e.logPrior, e.logLikelihood, e.logPosterior) for e in frontier]
+        previous = self._entries(t, len(versions) - 1) if versions else []
+        if entries == previous:
+            versions.append(None)
+        else:
+            position = {e: i for i, e in enumerate(previous)}
+            versions.append([position.get(e, e) for e in entries])
+
+    def frontierAt(self, task, k):
+        """The frontier of task at its k-th record"""
+        if k < 0: k += len(self.versions[task])
+        if not 0 <= k < len(self.versions[task]): raise IndexError(k)
+        f = self.frontiers.get((task, k))
+        if f is None:
+            f = Frontier([FrontierEntry(self.programs[p][0], logPrior=logPrior, logLikelihood=logLikelihood,
+                                        logPosterior=logPosterior, tokens=self.programs[p][1])
+                          for p, logPrior, logLikelihood, logPosterior in self._entries(task, k)],
+                         task=task)
+            self.frontiers[(task, k)] = f
+        return f
+
+    def extend(self, edit):
+        """Appends what another history recorded since it had the given number of programs and records"""
+        programs, versions = edit
+        for p, tokens in programs:
+            if self.programIds is not None: self.programIds[(p, tuple(tokens))] = len(self.programs)
+            self.programs.append((p, tokens))
+        for t, records in versions.items():
+            self.versions.setdefault(t, []).extend(records)
+
+    def size(self):
+        """Program table size and number of records of each task, to be passed to since"""
+        return len(self.programs), {t: len(v) for t, v in self.versions.items()}
+
+    def since(self, size):
+        """Edit to pass to extend, of everything recorded after size (see size)"""
+        programs, lengths = size
+        return (self.programs[programs:],
+                {t: v[lengths.get(t, 0):] for t, v in self.versions.items() if len(v) > lengths.get(t, 0)})
+
+    def __getitem__(self, task):
+        if task not in self.versions: raise KeyError(task)
+        return [self.frontierAt(task, k) for k in range(len(self.versions[task]))]
+
+    def get(self, task, default=None):
+        return self[task] if task in self.versions else default
+
+    def __contains__(self, task): return task in self.versions
+
+    def __iter__(self): return iter(self.versions)
+
+    def __len__(self): return len(self.versions)
+
+    def keys(self): return self.versions.keys()
+
+    def values(self): return [self[t] for t in self.versions]
+
+    def items(self): return [(t, self[t]) for t in self.versions]
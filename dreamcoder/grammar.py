@@ -1,4 +1,8 @@
-from collections import defaultdict, Counter
+from collections import defaultdict, Counter, OrderedDict
+import hashlib
+import json
+import os
+import pickle
 
 from dreamcoder.frontier import *
 from dreamcoder.program import *
@@ -18,12 +22,26 @@ class NoCandidates(Exception):
 
 
 class Grammar(object):
+    # How many (request, environment) pairs buildCandidates remembers; 0 turns the cache off
+    candidateCacheSize = 4096
+    # How many (program, request) likelihood summaries logLikelihood & rescoreFrontier remember; 0 turns the cache off
+    summaryCacheSize = 20000
+
     def __init__(self, logVariable, productions, continuationType=None):
         self.logVariable = logVariable
         self.productions = productions
 
         self.continuationType = continuationType
 
+        # LRU cache for buildCandidates, keyed on the canonical request & environment
+        self.candidateCache = OrderedDict()
+        self.candidateCacheHits = 0
+        self.candidateCacheMisses = 0
+        # LRU cache of closed likelihood summaries, keyed on (program, request), and the normalizing
+        # constant of each set of productions that a summary chooses between
+        self.summaryCache = OrderedDict()
+        self.normalizerCache = {}
+
         self.expression2likelihood = dict((p, l) for l, _, p in productions)
         self.expression2likelihood[Index(0)] = self.logVariable
         
@@ -90,6 +108,35 @@ class Grammar(object):
                                     for l,t,p in self.productions ],
                        continuationType=self.continuationType)
 
+    def reweighted(self, logVariable, logProductions):
+        """This grammar with another log variable and log productions (in the order of self.productions).
+        Shares the vocabularies of this grammar, which only depend on the productions."""
+        g = Grammar.__new__(Grammar)
+        g.logVariable = logVariable
+        g.productions = [(l, t, p) for l, (_, t, p) in zip(logProductions, self.productions)]
+        g.continuationType = self.continuationType
+        g.candidateCache = OrderedDict()
+        g.candidateCacheHits = 0
+        g.candidateCacheMisses = 0
+        # Summaries only depend on the productions
+        g.summaryCache = self.summaryCache
+        g.normalizerCache = {}
+        g.expression2likelihood = dict((p, l) for l, _, p in g.productions)
+        g.expression2likelihood[Index(0)] = logVariable
+        g.SPACE_ESCAPE = self.SPACE_ESCAPE
+        g.vocab = self.vocab
+        g.str_to_production = self.str_to_production
+        g.escaped_vocab = self.escaped_vocab
+        g.original_to_escaped = self.original_to_escaped
+        g.escaped_to_primitive_counts = self.escaped_to_primitive_counts
+        return g
+
+    def __getstate__(self):
+        # Everything else, including the candidate cache, is rebuilt by __setstate__
+        return {"logVariable": self.logVariable,
+                "productions": self.productions,
+                "continuationType": self.continuationType}
+
     def __setstate__(self, state):
         """
         Legacy support for loading grammar objects without the imperative type filled in
@@ -187,6 +234,33 @@ class Grammar(object):
         if returnProbabilities:
             assert normalize
 
+        if self.candidateCacheSize > 0:
+            candidates = self._cachedCandidates(request, context, environment, mustBeLeaf)
+        else:
+            candidates = self._uncachedCandidates(request, context, environment, mustBeLeaf)
+        if candidates == []:
+            raise NoCandidates()
+        #eprint("candidates inside buildCandidates before norm:")
+        #eprint(candidates)
+
+        if normalize:
+            z = lse([l for l, t, p, k in candidates])
+            if returnProbabilities:
+                candidates = [(exp(l - z), t, p, k)
+                              for l, t, p, k in candidates]
+            else:
+                candidates = [(l - z, t, p, k) for l, t, p, k in candidates]
+
+        #eprint("candidates inside buildCandidates after norm:")
+        #eprint(candidates)
+
+        if returnTable:
+            return {p: (l, t, k) for l, t, p, k in candidates}
+        else:
+            return candidates
+
+    def _uncachedCandidates(self, request, context, environment, mustBeLeaf):
+        """Unnormalized [(log likelihood, tp, primitive, context)]"""
         candidates = []
         variableCandidates = []
         for l, t, p in self.productions:
@@ -218,26 +292,62 @@ class Grammar(object):
             
         candidates += [(self.logVariable - log(len(variableCandidates)), t, p, k)
                        for t, p, k in variableCandidates]
-        if candidates == []:
-            raise NoCandidates()
-        #eprint("candidates inside buildCandidates before norm:")
-        #eprint(candidates)
+        return candidates
 
-        if normalize:
-            z = lse([l for l, t, p, k in candidates])
-            if returnProbabilities:
-                candidates = [(exp(l - z), t, p, k)
-                              for l, t, p, k in candidates]
-            else:
-                candidates = [(l - z, t, p, k) for l, t, p, k in candidates]
-
-        #eprint("candidates inside buildCandidates after norm:")
-        #eprint(candidates)
+    def _cachedCandidates(self, request, context, environment, mustBeLeaf):
+        """
+        Same as _uncachedCandidates, but memoized.
+        The candidates only depend on the request and environment up to renaming of type variables,
+        so they are computed once in a canonical context (free variables of the request & environment numbered 0..m-1)
+        and then renamed into the caller's context:
+        canonical variable i < m becomes the i-th free variable of the caller,
+        and the fresh variables m, m+1, ... that instantiation introduced become context.nextVariable, context.nextVariable+1, ...
+        """
+        request = request.apply(context)
+        environment = [t.apply(context) for t in environment]
+        bindings = {}
+        key = (request.canonical(bindings),
+               tuple(t.canonical(bindings) for t in environment),
+               mustBeLeaf)
+
+        n = context.nextVariable
+        if (bindings and max(bindings) >= n) or context.bindsVariableAtLeast(n):
+            # The caller never allocated these variables, so fresh ones would collide with them
+            return self._uncachedCandidates(request, context, environment, mustBeLeaf)
+
+        cache = self.candidateCache
+        entry = cache.get(key)
+        if entry is None:
+            self.candidateCacheMisses += 1
+            m = len(bindings)
+            canonicalContext = Context(m, [])
+            entry = []
+            for l, t, p, k in self._uncachedCandidates(key[0], canonicalContext, list(key[1]), mustBeLeaf):
+                entry.append((l, t, p, k.substitution, k.nextVariable - m))
+            cache[key] = entry
+            if len(cache) > self.candidateCacheSize:
+                cache.popitem(last=False)
+        else:
+            self.candidateCacheHits += 1
+            cache.move_to_end(key)
 
-        if returnTable:
-            return {p: (l, t, k) for l, t, p, k in candidates}
+        if not bindings:
+            # monomorphic request and environment: only fresh variables need renaming
+            renaming = {}
         else:
-            return candidates
+            renaming = {c.v: TypeVariable(v) for v, c in bindings.items()}
+        m = len(bindings)
+        candidates = []
+        for l, t, p, substitution, fresh in entry:
+            for j in range(len(renaming) - m, fresh):
+                renaming[m + j] = TypeVariable(n + j)
+            k = context
+            for v, b in substitution:
+                k = k.extend(renaming[v].v, b.canonical(renaming))
+            if fresh:
+                k = k._withNextVariable(n + fresh)
+            candidates.append((l, t.canonical(renaming), p, k))
+        return candidates
 
 
     def sample(self, request, maximumDepth=6, maxAttempts=None):
@@ -437,19 +547,45 @@ class Grammar(object):
 
         return summary
 
-    def logLikelihood(self, request, expression):
+    def cachedLikelihoodSummary(self, request, expression):
+        """closedLikelihoodSummary, memoized. Shared with the grammars made by reweighted."""
+        if self.summaryCacheSize <= 0: return self.closedLikelihoodSummary(request, expression)
+        key = (expression, request)
+        cache = self.summaryCache
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
         summary = self.closedLikelihoodSummary(request, expression)
+        cache[key] = summary
+        if len(cache) > self.summaryCacheSize:
+            cache.popitem(last=False)
+        return summary
+
+    def summaryLogLikelihood(self, summary):
+        """summary.logLikelihood(self), computing the normalizing constant of each set of productions only once"""
+        l = self.expression2likelihood
+        normalizers = self.normalizerCache
+        def z(ps):
+            if ps not in normalizers: normalizers[ps] = lse([l[p] for p in ps])
+            return normalizers[ps]
+        return summary.constant + \
+            sum(count * l[p] for p, count in summary.uses.items()) - \
+            sum(count * z(ps) for ps, count in summary.normalizers.items())
+
+    def logLikelihood(self, request, expression):
+        summary = self.cachedLikelihoodSummary(request, expression)
         if summary is None:
             eprint(
                 "FATAL: program [ %s ] does not have a likelihood summary." %
                 expression, "r = ", request, "\n", self)
             assert False
-        return summary.logLikelihood(self)
+        return self.summaryLogLikelihood(summary)
 
     def rescoreFrontier(self, frontier):
         return Frontier([FrontierEntry(e.program,
                                        logPrior=self.logLikelihood(frontier.task.request, e.program),
-                                       logLikelihood=e.logLikelihood)
+                                       logLikelihood=e.logLikelihood,
+                                       tokens=e.tokens)
                          for e in frontier],
                         frontier.task)
 
@@ -1009,6 +1145,13 @@ class ContextualGrammar:
             self.variableParent = LikelihoodSummary()
             self.library = {e: [LikelihoodSummary() for _ in gs]  for e,gs in owner.library.items() }
 
+        def __getstate__(self):
+            # What recognition.ContextualSummaryCompiler compiled this into
+            # only means something to the network that compiled it
+            state = dict(self.__dict__)
+            state.pop("compiled", None)
+            return state
+
         def record(self, parent, parentIndex, actual, possibles, constant):
             if parent is None: ls = self.noParent
             elif parent.isIndex: ls = self.variableParent
@@ -1286,6 +1429,389 @@ class ContextualGrammar:
         
 
 
+class EnumerationState(object):
+    """
+    Resumable enumeration: the same programs as Grammar.enumeration (or ContextualGrammar.enumeration),
+    but the search keeps a frontier of partial programs between calls to advance,
+    so that enumerating the window [lb, ub) does not re-walk everything below lb.
+
+    A partial program is (context, todo, values):
+    todo is a linked list (nested pairs) of the actions still to be performed
+    and values is a linked list of the subexpressions built so far.
+    Actions are (ENUMERATE, request, environment, maximumDepth, parent, parentIndex),
+    (ABSTRACT,), and (APPLY, originalFunction, argumentIndex).
+    Once a hole has been expanded, its partial program is paired with a cursor into the
+    candidates for the hole, sorted from most to least likely.
+
+    Work that fits inside of the current window is done depth first off of a stack;
+    everything else waits on the frontier, a heap keyed on MDL, until a later window reaches it.
+    """
+    ENUMERATE = 0
+    ABSTRACT = 1
+    APPLY = 2
+
+    def __init__(self, grammar, request, maximumDepth=99):
+        self.grammar = grammar
+        self.request = request
+        # Programs which have been finished but not yet handed out: [(logPrior, context, program)]
+        self.pending = []
+        # Both of these hold (MDL, counter, partial program, cursor)
+        # cursor is None, or (candidates, index of next candidate, MDL of the partial program)
+        self.stack = []
+        self.counter = 0
+        self.frontier = [(0., 0, (Context.EMPTY,
+                                  ((EnumerationState.ENUMERATE, request, [], maximumDepth, None, None), None),
+                                  None),
+                          None)]
+        # Number of holes that have been expanded, over the lifetime of the search
+        self.expansions = 0
+
+    def __len__(self): return len(self.frontier) + len(self.stack)
+
+    @property
+    def exhausted(self): return not self.frontier and not self.stack and not self.pending
+
+    def advance(self, upperBound):
+        """Yields (logPrior, context, program) for every program with MDL < upperBound
+        which has not been yielded by a previous call.
+        It is safe to stop consuming the generator at any point and call advance again later."""
+        from heapq import heappop
+        import gc
+        # The frontier is a very large number of long-lived objects,
+        # which makes every pass of the cycle collector expensive.
+        # Enumeration does not create reference cycles, so we switch it off while we are working,
+        # but never while the consumer has control: it may create cycles, or abandon us inside of one.
+        collecting = gc.isenabled()
+        try:
+            while True:
+                while self.pending:
+                    if collecting: gc.enable()
+                    yield self.pending.pop()
+                gc.disable()
+                if self.stack:
+                    mdl, _, partial, cursor = self.stack.pop()
+                elif self.frontier and self.frontier[0][0] < upperBound:
+                    mdl, _, partial, cursor = heappop(self.frontier)
+                else:
+                    return
+
+                if not (mdl < upperBound):
+                    self._schedule(mdl, partial, cursor, upperBound)
+                elif cursor is None:
+                    self._expand(mdl, partial, upperBound)
+                else:
+                    candidates, i, parentMDL = cursor
+                    if i + 1 < len(candidates):
+                        self._schedule(parentMDL - candidates[i + 1][0], partial,
+                                       (candidates, i + 1, parentMDL), upperBound)
+                    self._choose(parentMDL, partial, candidates[i], upperBound)
+        finally:
+            if collecting: gc.enable()
+
+    def _schedule(self, mdl, partial, cursor, upperBound):
+        self.counter += 1
+        if mdl < upperBound:
+            self.stack.append((mdl, self.counter, partial, cursor))
+        else:
+            from heapq import heappush
+            heappush(self.frontier, (mdl, self.counter, partial, cursor))
+
+    def _grammar(self, parent, parentIndex):
+        g = self.grammar
+        if not isinstance(g, ContextualGrammar): return g
+        if parent is None: return g.noParent
+        if parent.isIndex: return g.variableParent
+        return g.library[parent][parentIndex]
+
+    def _push(self, mdl, context, todo, values, upperBound):
+        # Perform all of the actions that do not involve a choice
+        while todo is not None and todo[0][0] != EnumerationState.ENUMERATE:
+            action, todo = todo
+            if action[0] == EnumerationState.ABSTRACT:
+                body, values = values
+                values = (Abstraction(body), values)
+            else:
+                _, originalFunction, argumentIndex = action
+                x, values = values
+                f, values = values
+                if violatesSymmetry(originalFunction, x, argumentIndex):
+                    return
+                values = (Application(f, x), values)
+
+        if todo is None:
+            # We only ever get here with mdl < upperBound
+            self.pending.append((-mdl, context, values[0]))
+        else:
+            self._expand(mdl, (context, todo, values), upperBound)
+
+    def _expand(self, mdl, partial, upperBound):
+        context, todo, values = partial
+        (_, request, environment, maximumDepth, parent, parentIndex), todo = todo
+        if maximumDepth == 1:
+            return
+        request = request.apply(context)
+
+        if request.isArrow():
+            todo = ((EnumerationState.ENUMERATE, request.arguments[1],
+                     [request.arguments[0]] + environment, maximumDepth, parent, parentIndex),
+                    ((EnumerationState.ABSTRACT,), todo))
+            self._push(mdl, context, todo, values, upperBound)
+            return
+
+        # Leaves live at maximumDepth - 1, which may not be 1
+        if maximumDepth - 1 == 1:
+            return
+        try:
+            candidates = self._grammar(parent, parentIndex).buildCandidates(request, context, environment,
+                                                                          normalize=True)
+        except NoCandidates:
+            return
+        self.expansions += 1
+
+        candidates.sort(key=lambda c: -c[0])
+        self._schedule(mdl - candidates[0][0], (environment, todo, values, maximumDepth - 1),
+                       (candidates, 0, mdl), upperBound)
+
+    def _choose(self, mdl, partial, candidate, upperBound):
+        environment, todo, values, maximumDepth = partial
+        l, t, p, newContext = candidate
+        xs = t.functionArguments()
+        for argumentIndex in reversed(range(len(xs))):
+            todo = ((EnumerationState.APPLY, p, argumentIndex), todo)
+            todo = ((EnumerationState.ENUMERATE, xs[argumentIndex], environment,
+                     maximumDepth, p, argumentIndex), todo)
+        self._push(mdl - l, newContext, todo, (p, values), upperBound)
+
+
+class SymmetryRules(object):
+    """A table of (parent, argumentIndex, child) primitive names: enumeration never builds a
+    program where argument argumentIndex of parent is headed by child, because some other
+    program that is no bigger computes the same thing. An argumentIndex of None matches every
+    argument. violatesSymmetry consults SymmetryRules.active with two set lookups.
+
+    Rules can be mined offline from a grammar and a set of tasks (SymmetryRules.mine, or
+    bin/symmetryBreaking.py) and saved as JSON, by default in data/symmetry/ under a name
+    derived from the primitive set."""
+
+    def __init__(self, rules=(), primitives=None):
+        self.rules = frozenset((f, i, x) for f, i, x in rules)
+        # Names of the primitives the rules were mined for, if they were mined
+        self.primitives = primitives
+
+    def violates(self, f, x, argumentIndex):
+        """Is a program headed by the primitive named x redundant as argument argumentIndex of f?"""
+        return (f, argumentIndex, x) in self.rules or (f, None, x) in self.rules
+
+    def __len__(self): return len(self.rules)
+
+    def __iter__(self): return iter(sorted(self.rules, key=lambda r: (r[0], -1 if r[1] is None else r[1], r[2])))
+
+    def __or__(self, other): return SymmetryRules(self.rules | other.rules)
+
+    def __str__(self):
+        return "\n".join("(%s%s %s)" % (f, "" if i is None else " #%d" % i, x) for f, i, x in self)
+
+    def install(self):
+        """Makes enumeration use these rules on top of the built-in ones"""
+        SymmetryRules.active = SymmetryRules.BUILTIN | self
+        return self
+
+    @staticmethod
+    def defaultPath(primitives):
+        names = sorted({str(p) for p in primitives if p.isPrimitive})
+        digest = hashlib.md5(" ".join(names).encode("utf-8")).hexdigest()[:16]
+        return os.path.join(get_root_dir(), "data", "symmetry", "%s.json" % digest)
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory: os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as handle:
+            json.dump({"primitives": self.primitives,
+                       "rules": [list(r) for r in self]}, handle, indent=1)
+
+    @staticmethod
+    def load(path):
+        with open(path, "r") as handle:
+            j = json.load(handle)
+        return SymmetryRules([tuple(r) for r in j["rules"]], j.get("primitives"))
+
+    @staticmethod
+    def _patterns(p):
+        """The (parent, argumentIndex, child) combinations occurring in p"""
+        patterns = set()
+        for _, e in p.walk():
+            if not e.isApplication: continue
+            f, xs = e.applicationParse()
+            if not f.isPrimitive: continue
+            for i, x in enumerate(xs):
+                while x.isApplication: x = x.f
+                if x.isPrimitive: patterns.add((f.name, i, x.name))
+        return patterns
+
+    @staticmethod
+    def _templates(f, argumentIndex, c, groundType):
+        """Most general programs where argument argumentIndex of f is headed by c, one for each
+        number of arguments c can take there: every other argument is a variable. Yields
+        (template, types of its variables, its type); type variables are set to groundType."""
+        def ground(t):
+            if isinstance(t, TypeVariable): return groundType
+            return TypeConstructor(t.name, [ground(a) for a in t.arguments])
+
+        context, ft = f.tp.instantiate(Context.EMPTY)
+        fs = ft.functionArguments()
+        if argumentIndex >= len(fs): return
+        context, ct = c.tp.instantiate(context)
+        cs = ct.functionArguments()
+        for k in range(len(cs) + 1):
+            try: k_context = context.unify(arrow(*(cs[k:] + [ct.returns()])), fs[argumentIndex])
+            except UnificationFailure: continue
+            holes = fs[:argumentIndex] + cs[:k] + fs[argumentIndex + 1:]
+            child = c
+            for j in range(k): child = Application(child, Index(argumentIndex + j))
+            template = f
+            for j in range(len(fs)):
+                if j < argumentIndex: x = Index(j)
+                elif j == argumentIndex: x = child
+                else: x = Index(j + k - 1)
+                template = Application(template, x)
+            yield template, [ground(t.apply(k_context)) for t in holes], ground(ft.returns().apply(k_context))
+
+    @staticmethod
+    def mine(grammar, tasks, upperBound=12., samples=64, evaluationTimeout=0.01, valueBound=10.):
+        """Mines rules for the primitives of grammar. For each (parent, argumentIndex, child),
+        the most general program where argument argumentIndex of parent is headed by child is run
+        on random values for its variables, and the combination becomes a rule if some program
+        over the same variables, no bigger and avoiding it, the rules kept so far and the built-in
+        rules (which install() enforces alongside the mined ones), computes the same outputs.
+        Candidate programs are enumerated up to a description length of upperBound. Values come
+        from the tasks' examples and from running closed programs enumerated up to valueBound.
+        Rules are only as sound as the sampled values are representative."""
+        # Type variables are instantiated at the most common base type of the tasks
+        bases = Counter()
+        def countBases(t):
+            if isinstance(t, TypeVariable): return
+            if not t.arguments: bases[t] += 1
+            for a in t.arguments: countBases(a)
+        for t in tasks: countBases(t.request)
+        groundType = bases.most_common(1)[0][0] if bases else tint
+
+        def run(p, environments):
+            outputs = []
+            for environment in environments:
+                try: outputs.append((True, p.evaluate(environment)))
+                except RunWithTimeout: raise
+                except Exception: outputs.append((False, None))
+            return outputs
+
+        def signature(p, environments, varying=False):
+            """Pickled outputs of p in each environment. With varying, None if they are all the
+            same: the values were then probably not diverse enough to tell programs apart"""
+            try:
+                outputs = runWithTimeout(lambda: run(p, environments), evaluationTimeout)
+                # Programs that always crash are all "equivalent", but
+                # that says nothing about the patterns they contain
+                if not any(ok for ok, _ in outputs): return None
+                outputs = [pickle.dumps(o) for o in outputs]
+                if varying and len(set(outputs)) == 1: return None
+                return pickle.dumps(outputs)
+            except Exception: return None
+
+        # Values of each type: those of closed programs, in order of description length, then
+        # those in the examples, then for lists, random lists of values of the element type
+        exampleValues = defaultdict(list)
+        def addExampleValue(tp, v):
+            exampleValues[tp].append(v)
+            if tp.name == "list" and isinstance(v, list):
+                for x in v: addExampleValue(tp.arguments[0], x)
+        for t in tasks:
+            ts = t.request.functionArguments()
+            for xs, y in t.examples:
+                for tp, x in zip(ts, xs): addExampleValue(tp, x)
+                addExampleValue(t.request.returns(), y)
+
+        values = {}
+        def valuesOf(tp):
+            if tp in values: return values[tp]
+            found = {}
+            def add(v):
+                try: key = pickle.dumps(v)
+                except Exception: key = id(v)
+                found.setdefault(key, v)
+            for _, _, p in grammar.enumeration(Context.EMPTY, [], tp, valueBound, maximumDepth=4):
+                try: add(runWithTimeout(lambda: p.evaluate([]), evaluationTimeout))
+                except Exception: pass
+            for v in exampleValues[tp]: add(v)
+            if tp.name == "list":
+                elements = valuesOf(tp.arguments[0])
+                generator = random.Random(str(tp))
+                for _ in range(samples if elements else 0):
+                    add([generator.choice(elements) for _ in range(generator.randint(1, 5))])
+            values[tp] = list(found.values())
+            return values[tp]
+
+        # (variable types, type) -> (environments, signature -> [(size, patterns)])
+        witnesses = {}
+        def witnessesOf(holes, tp):
+            key = (tuple(holes), tp)
+            if key not in witnesses:
+                pools = [valuesOf(h) for h in holes]
+                if not all(len(pool) > 1 for pool in pools):
+                    witnesses[key] = None
+                    return None
+                # Half of the environments draw from the few smallest values of each
+                # type, so that variables often coincide (as with eq? or if)
+                generator = random.Random(str(key))
+                environments = [[generator.choice(pool[:3] if n % 2 else pool) for pool in pools]
+                                for n in range(samples)]
+                programs = defaultdict(list)
+                for _, _, p in grammar.enumeration(Context.EMPTY, holes, tp, upperBound, maximumDepth=4):
+                    s = signature(p, environments)
+                    if s is not None: programs[s].append((p.size(), SymmetryRules._patterns(p)))
+                witnesses[key] = (environments, programs)
+            return witnesses[key]
+
+        primitives = [p for p in grammar.primitives if p.isPrimitive]
+        rules = set()
+        active, SymmetryRules.active = SymmetryRules.active, SymmetryRules()
+        try:
+            candidates = [(f, i, c) for f in primitives for i in range(len(f.tp.functionArguments()))
+                          for c in primitives]
+            # Between the two orientations of an associative operator
+            # prefer forbidding nesting in the last argument
+            candidates.sort(key=lambda r: (-r[1], r[0].name, r[2].name))
+            for f, i, c in candidates:
+                r = (f.name, i, c.name)
+                # Once installed, enumeration also avoids everything the built-in rules forbid
+                forbidden = SymmetryRules(SymmetryRules.BUILTIN.rules | rules | {r})
+                instances = 0
+                for template, holes, tp in SymmetryRules._templates(f, i, c, groundType):
+                    w = witnessesOf(holes, tp)
+                    s = w and signature(template, w[0], varying=bool(holes))
+                    if s is None or not any(size <= template.size() and
+                                            not any(forbidden.violates(g, x, j) for g, j, x in patterns)
+                                            for size, patterns in w[1].get(s, [])):
+                        break
+                    instances += 1
+                else:
+                    if instances: rules.add(r)
+        finally:
+            SymmetryRules.active = active
+        return SymmetryRules(rules, sorted(p.name for p in primitives))
+
+
+SymmetryRules.BUILTIN = SymmetryRules(
+    [("car", None, "cons"), ("car", None, "empty"),
+     ("cdr", None, "cons"), ("cdr", None, "empty"),
+     ("+", None, "0"), ("+", 1, "+"),
+     ("-", 1, "0"),
+     ("empty?", None, "cons"), ("empty?", None, "empty"),
+     ("zero?", None, "0"), ("zero?", None, "1"),
+     ("index", None, "empty"), ("map", None, "empty"), ("zip", None, "empty"),
+     ("range", None, "0"),
+     ("fold", 1, "empty")])
+SymmetryRules.active = SymmetryRules.BUILTIN
+
+
 def violatesSymmetry(f, x, argumentIndex):
     if not f.isPrimitive:
         return False
@@ -1293,27 +1819,7 @@ def violatesSymmetry(f, x, argumentIndex):
         x = x.f
     if not x.isPrimitive:
         return False
-    f = f.name
-    x = x.name
-    if f == "car":
-        return x == "cons" or x == "empty"
-    if f == "cdr":
-        return x == "cons" or x == "empty"
-    if f == "+":
-        return x == "0" or (argumentIndex == 1 and x == "+")
-    if f == "-":
-        return argumentIndex == 1 and x == "0"
-    if f == "empty?":
-        return x == "cons" or x == "empty"
-    if f == "zero?":
-        return x == "0" or x == "1"
-    if f == "index" or f == "map" or f == "zip":
-        return x == "empty"
-    if f == "range":
-        return x == "0"
-    if f == "fold":
-        return argumentIndex == 1 and x == "empty"
-    return False
+    return SymmetryRules.active.violates(f.name, x.name, argumentIndex)
 
 def batchLikelihood(jobs):
     """Takes as input a set of (program, request, grammar) and returns a dictionary mapping each of these to its likelihood under the grammar"""
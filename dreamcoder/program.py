@@ -5,6 +5,7 @@ from dreamcoder.utilities import *
 
 from time import time
 import math
+import weakref
 
 
 class InferenceFailure(Exception):
@@ -17,8 +18,14 @@ class ShiftFailure(Exception):
 class RunFailure(Exception):
     pass
 
+# Map from id(program) to [weak reference to the program, times it was run, its compiled function or None]
+COMPILEDPROGRAMS = {}
+
 
 class Program(object):
+    # Subclasses that come in large numbers (applications, abstractions, indices) declare their own slots
+    __slots__ = ()
+
     def __repr__(self): return str(self)
 
     def __ne__(self, o): return not (self == o)
@@ -98,8 +105,30 @@ class Program(object):
         except InferenceFailure:
             return False
 
+    # Compiling a list program costs about as much as it saves over seventy examples,
+    # so a program is only compiled the second time it is run
+    compileThreshold = 2
+
+    def compile(self):
+        """
+        A function of no arguments that returns self.evaluate([]).
+        Programs that are run repeatedly get a function compiled by ProgramCompiler, cached per program object.
+        """
+        entry = COMPILEDPROGRAMS.get(id(self))
+        if entry is None or entry[0]() is not self:
+            key = id(self)
+            entry = [weakref.ref(self, lambda _: COMPILEDPROGRAMS.pop(key, None)), 0, None]
+            COMPILEDPROGRAMS[key] = entry
+        if entry[2] is None:
+            entry[1] += 1
+            if entry[1] < Program.compileThreshold: return lambda: self.evaluate([])
+            # False marks programs that cannot be compiled: caching a closure over self would keep it alive
+            entry[2] = ProgramCompiler().function(self) or False
+        if entry[2] is False: return lambda: self.evaluate([])
+        return entry[2]
+
     def runWithArguments(self, xs):
-        f = self.evaluate([])
+        f = self.compile()()
         for x in xs:
             f = f(x)
         return f
@@ -231,6 +260,7 @@ class Program(object):
 
 class Application(Program):
     '''Function application'''
+    __slots__ = ("f", "x", "hashCode", "isConditional", "annotatedType", "__weakref__")
 
     def __init__(self, f, x):
         self.f = f
@@ -241,14 +271,16 @@ class Application(Program):
                              f.f.isApplication and \
                              f.f.f.isPrimitive and \
                              f.f.f.name == "if"
-        if self.isConditional:
-            self.falseBranch = x
-            self.trueBranch = f.x
-            self.branch = f.f.x
-        else:
-            self.falseBranch = None
-            self.trueBranch = None
-            self.branch = None
+
+    # (if branch trueBranch falseBranch)
+    @property
+    def falseBranch(self): return self.x if self.isConditional else None
+
+    @property
+    def trueBranch(self): return self.f.x if self.isConditional else None
+
+    @property
+    def branch(self): return self.f.f.x if self.isConditional else None
 
     def betaReduce(self):
         # See if either the function or the argument can be reduced
@@ -284,11 +316,12 @@ class Application(Program):
     @property
     def isApplication(self): return True
 
-    def __eq__(
-        self,
-        other): return isinstance(
-        other,
-        Application) and self.f == other.f and self.x == other.x
+    def __eq__(self, other):
+        if self is other: return True
+        # Programs whose hashes we already know to differ cannot be equal
+        return isinstance(other, Application) and \
+            (self.hashCode is None or other.hashCode is None or self.hashCode == other.hashCode) and \
+            self.f == other.f and self.x == other.x
 
     def __hash__(self):
         if self.hashCode is None:
@@ -297,33 +330,16 @@ class Application(Program):
 
     """Because Python3 randomizes the hash function, we need to never pickle the hash"""
     def __getstate__(self):
-        return self.f, self.x, self.isConditional, self.falseBranch, self.trueBranch, self.branch
+        return self.f, self.x
     def __setstate__(self, state):
-        try:
-            self.f, self.x, self.isConditional, self.falseBranch, self.trueBranch, self.branch = state
-        except ValueError:
-            # backward compatibility
+        if isinstance(state, dict):
+            # backward compatibility: pickled before applications had a state of their own
             assert 'x' in state
             assert 'f' in state
-            f = state['f']
-            x = state['x']
-            self.f = f
-            self.x = x
-            self.isConditional = (not isinstance(f,int)) and \
-                                 f.isApplication and \
-                                 f.f.isApplication and \
-                                 f.f.f.isPrimitive and \
-                                 f.f.f.name == "if"
-            if self.isConditional:
-                self.falseBranch = x
-                self.trueBranch = f.x
-                self.branch = f.f.x
-            else:
-                self.falseBranch = None
-                self.trueBranch = None
-                self.branch = None
-
-        self.hashCode = None
+            self.__init__(state['f'], state['x'])
+        else:
+            # backward compatibility: (f, x, isConditional, falseBranch, trueBranch, branch) from before slots
+            self.__init__(state[0], state[1])
 
     def visit(self,
               visitor,
@@ -340,10 +356,10 @@ class Application(Program):
 
     def evaluate(self, environment):
         if self.isConditional:
-            if self.branch.evaluate(environment):
-                return self.trueBranch.evaluate(environment)
+            if self.f.f.x.evaluate(environment):
+                return self.f.x.evaluate(environment)
             else:
-                return self.falseBranch.evaluate(environment)
+                return self.x.evaluate(environment)
         else:
             return self.f.evaluate(environment)(self.x.evaluate(environment))
 
@@ -416,10 +432,16 @@ class Index(Program):
     deBruijn index: https://en.wikipedia.org/wiki/De_Bruijn_index
     These indices encode variables.
     '''
+    __slots__ = ("i", "annotatedType", "__weakref__")
 
     def __init__(self, i):
         self.i = i
 
+    def __getstate__(self): return self.i
+    def __setstate__(self, state):
+        # backward compatibility: pickled as a dictionary before slots
+        self.i = state['i'] if isinstance(state, dict) else state
+
     def show(self, isFunction): return "$%d" % self.i
 
     def __eq__(self, o): return isinstance(o, Index) and o.i == self.i
@@ -508,6 +530,7 @@ class Index(Program):
 
 class Abstraction(Program):
     '''Lambda abstraction. Creates a new function.'''
+    __slots__ = ("body", "hashCode", "annotatedType", "__weakref__")
 
     def __init__(self, body):
         self.body = body
@@ -516,8 +539,11 @@ class Abstraction(Program):
     @property
     def isAbstraction(self): return True
 
-    def __eq__(self, o): return isinstance(
-        o, Abstraction) and o.body == self.body
+    def __eq__(self, o):
+        if self is o: return True
+        return isinstance(o, Abstraction) and \
+            (self.hashCode is None or o.hashCode is None or self.hashCode == o.hashCode) and \
+            o.body == self.body
 
     def __hash__(self):
         if self.hashCode is None:
@@ -528,7 +554,8 @@ class Abstraction(Program):
     def __getstate__(self):
         return self.body
     def __setstate__(self, state):
-        self.body = state
+        # backward compatibility: pickled as a dictionary before slots
+        self.body = state['body'] if isinstance(state, dict) else state
         self.hashCode = None
 
     def isBetaLong(self): return self.body.isBetaLong()
@@ -701,7 +728,7 @@ class Invented(Program):
                                                    *arguments,
                                                    **keywords)
 
-    def __eq__(self, o): return isinstance(o, Invented) and o.body == self.body
+    def __eq__(self, o): return self is o or (isinstance(o, Invented) and o.body == self.body)
 
     def __hash__(self):
         if self.hashCode is None:
@@ -912,6 +939,129 @@ class ShareVisitor(object):
         return e.visit(self)
 
 
+class ProgramInterner(object):
+    """
+    Hash-consing factory for programs.
+    Building a program out of interned parts gives back the existing node if there already is one,
+    so identical subprograms are the same object, comparing them is a pointer comparison,
+    and every hash is computed once, when the node is built.
+    The table only holds its nodes weakly: nodes that nobody else refers to are freed as usual.
+    Interned nodes are shared, so they should not be mutated (for instance by annotateTypes).
+    """
+    def __init__(self):
+        self.table = weakref.WeakValueDictionary()
+
+    def __len__(self): return len(self.table)
+
+    # Children are interned, so they are alive as long as their parent is and their ids can stand in for them.
+    # Keys pack the ids of the children and the kind of node into one integer, which is smaller than a tuple.
+    def application(self, f, x):
+        key = id(f) << 66 | id(x) << 2
+        e = self.table.get(key)
+        if e is None:
+            e = Application(f, x)
+            hash(e)
+            self.table[key] = e
+        return e
+
+    def abstraction(self, body):
+        key = id(body) << 2 | 1
+        e = self.table.get(key)
+        if e is None:
+            e = Abstraction(body)
+            hash(e)
+            self.table[key] = e
+        return e
+
+    def index(self, i):
+        key = i << 2 | 2
+        e = self.table.get(key)
+        if e is None:
+            e = Index(i)
+            self.table[key] = e
+        return e
+
+    def invented(self, body):
+        key = id(body) << 2 | 3
+        e = self.table.get(key)
+        if e is None:
+            e = Invented(body)
+            hash(e)
+            self.table[key] = e
+        return e
+
+    def intern(self, e):
+        """The interned version of an arbitrary program"""
+        if e.isApplication: return self.application(self.intern(e.f), self.intern(e.x))
+        if e.isAbstraction: return self.abstraction(self.intern(e.body))
+        if e.isIndex: return self.index(e.i)
+        if e.isInvented: return self.invented(self.intern(e.body))
+        # primitives are already unique
+        return e
+
+    def parse(self, s): return self.intern(Program.parse(s))
+
+
+class ProgramCompiler(object):
+    """
+    Compiles a program into Python code computing the same value as program.evaluate([]).
+    Each abstraction becomes a Python lambda with its own parameter, so de Bruijn indices are resolved to
+    a variable when compiling instead of being looked up in an environment list copied on every call,
+    and primitives are bound to their values once.
+    Conditionals stay lazy; anything else (holes, fragment variables) falls back to its evaluate method.
+    """
+    def __init__(self):
+        self.constants = {}
+
+    def constant(self, value):
+        name = "c%d" % len(self.constants)
+        self.constants[name] = value
+        return name
+
+    # Variable x<j> is bound by the j-th enclosing lambda, counting from the outside;
+    # variables below base belong to an enclosing program, and invented bodies cannot see them.
+    def expression(self, e, depth, base):
+        if isinstance(e, Application):
+            if e.isConditional:
+                return "(%s if %s else %s)" % (self.expression(e.f.x, depth, base),
+                                               self.expression(e.f.f.x, depth, base),
+                                               self.expression(e.x, depth, base))
+            return "%s(%s)" % (self.expression(e.f, depth, base), self.expression(e.x, depth, base))
+        if isinstance(e, Abstraction):
+            return "(lambda x%d: %s)" % (depth, self.expression(e.body, depth + 1, base))
+        if isinstance(e, Index):
+            j = depth - 1 - e.i
+            if j < base: return "freeVariable(%d)" % e.i
+            return "x%d" % j
+        if isinstance(e, Primitive):
+            return self.constant(e.value)
+        if isinstance(e, Invented):
+            return self.expression(e.body, depth, depth)
+        environment = ", ".join("x%d" % j for j in reversed(range(base, depth)))
+        return "%s.evaluate([%s])" % (self.constant(e), environment)
+
+    @staticmethod
+    def freeVariable(i):
+        raise IndexError("free variable $%d" % i)
+
+    def function(self, e):
+        """A function of no arguments that evaluates e, or None if e cannot be compiled"""
+        # The compiled function must not refer to e itself, so that it can be cached alongside e
+        if not isinstance(e, (Application, Abstraction, Index, Primitive, Invented)): return None
+        try:
+            source = "lambda: " + self.expression(e, 0, 0)
+            return eval(source, dict(self.constants, freeVariable=ProgramCompiler.freeVariable))
+        except (SyntaxError, RecursionError, MemoryError):
+            # Too deeply nested for the Python parser, or for expression itself
+            return None
+
+    def compile(self, e):
+        """A function of no arguments that evaluates e"""
+        f = self.function(e)
+        if f is None: return lambda: e.evaluate([])
+        return f
+
+
 class Mutator:
     """Perform local mutations to an expr, yielding the expr and the
     description length distance from the original program"""
@@ -5,6 +5,7 @@ from dreamcoder.utilities import RunWithTimeout
 
 
 import gc
+import itertools
 
 import torch
 import torch.nn as nn
@@ -33,6 +34,93 @@ def maybe_cuda(x, use_cuda):
         return x
 
 
+class TaskCache(object):
+    """
+    Least recently used cache of values computed from tasks, keyed on the task objects themselves
+    (tasks compare by name, which is not enough to tell dreams apart). The cache empties itself
+    whenever get is called with a different version, and is never pickled.
+    """
+    def __init__(self, maximumSize=1000):
+        self.maximumSize = maximumSize
+        self.version = None
+        self.entries = OrderedDict() # id(task) -> (task, value)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self): return len(self.entries)
+
+    def __getstate__(self): return {"maximumSize": self.maximumSize}
+    def __setstate__(self, state): self.__init__(state["maximumSize"])
+
+    def lookup(self, task, version=None):
+        """The cached value for task, or None"""
+        if version != self.version:
+            self.entries.clear()
+            self.version = version
+        entry = self.entries.get(id(task))
+        if entry is None or entry[0] is not task:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(id(task))
+        return entry[1]
+
+    def store(self, task, value):
+        # Holding on to the task keeps its id from being reused while it is cached
+        self.entries[id(task)] = (task, value)
+        self.entries.move_to_end(id(task))
+        while len(self.entries) > self.maximumSize:
+            self.entries.popitem(last=False)
+        return value
+
+    def get(self, task, compute, version=None):
+        value = self.lookup(task, version)
+        if value is None:
+            value = self.store(task, compute())
+        return value
+
+def frozenFeatureVersion(extractor):
+    """
+    Identifies the current parameters of a feature extractor whose features can be cached, or
+    returns None if they cannot: its parameters are being trained, or its features are random.
+    """
+    if not isinstance(extractor, nn.Module) or not getattr(extractor, 'deterministicFeatures', True):
+        return None
+    version = []
+    for parameter in extractor.parameters():
+        if parameter.requires_grad: return None
+        # Bumped by in-place updates such as load_state_dict
+        version.append((id(parameter), parameter._version))
+    return tuple(version)
+
+def cachedFeaturesOfTasks(extractor, tasks):
+    """
+    extractor's features of each of the tasks (None where it has none). The features of a frozen
+    extractor are remembered across calls, and only the tasks it has not seen are encoded.
+    """
+    version = frozenFeatureVersion(extractor)
+    if version is None:
+        cached = [None]*len(tasks)
+    else:
+        cache = extractor.__dict__.get('featureCache')
+        if cache is None:
+            cache = extractor.featureCache = TaskCache(10000)
+        cached = [cache.lookup(task, version) for task in tasks]
+    missing = [b for b, features in enumerate(cached) if features is None]
+    # Extractors can also have features that are random for some tasks only
+    deterministic = getattr(extractor, 'deterministicFeaturesOf', lambda task: True)
+    if missing:
+        if hasattr(extractor, 'featuresOfTasks') and len(missing) > 1:
+            computed = list(extractor.featuresOfTasks([tasks[b] for b in missing]))
+        else:
+            computed = [extractor.featuresOfTask(tasks[b]) for b in missing]
+        for b, features in zip(missing, computed):
+            cached[b] = features
+            # Tasks without features are asked again next time, which is cheap
+            if version is not None and features is not None and deterministic(tasks[b]):
+                cache.store(tasks[b], features.detach())
+    return cached
+
 def is_torch_not_a_number(v):
     """checks whether a tortured variable is nan"""
     v = v.data
@@ -60,6 +148,17 @@ class Entropy(nn.Module):
         b = -1.0 * b.sum()
         return b
 
+def grammarFromList(grammar, logProductions):
+    """Grammar with the productions of grammar and the given list of log productions (log variable last)"""
+    return grammar.reweighted(logProductions[-1], logProductions)
+
+def untorchedContextualGrammars(network, transitionMatrices):
+    """Splits B x n_grammars x G transition matrices into B (untorched) contextual grammars"""
+    return [ContextualGrammar(grammarFromList(network.grammar, m[-1]), grammarFromList(network.grammar, m[-2]),
+                              {prim: [grammarFromList(network.grammar, m[j]) for j in js]
+                               for prim, js in network.library.items()})
+            for m in transitionMatrices.tolist()]
+
 class GrammarNetwork(nn.Module):
     """Neural network that outputs a grammar"""
     def __init__(self, inputDimensionality, grammar):
@@ -76,6 +175,10 @@ class GrammarNetwork(nn.Module):
                         for k, (_, t, program) in enumerate(self.grammar.productions)],
                        continuationType=self.grammar.continuationType)
 
+    def untorchedGrammars(self, xs):
+        """Takes as input BxinputDimensionality vector; returns the B corresponding untorched grammars"""
+        return [grammarFromList(self.grammar, l) for l in self.logProductions(xs).tolist()]
+
     def batchedLogLikelihoods(self, xs, summaries):
         """Takes as input BxinputDimensionality vector & B likelihood summaries;
         returns B-dimensional vector containing log likelihood of each summary"""
@@ -125,6 +228,128 @@ class GrammarNetwork(nn.Module):
 
         
 
+class ContextualSummaryCompiler(object):
+    """Compiles the likelihood summaries of a ContextualGrammar, once, into sparse indices into the
+    n_grammars x G output of a contextual grammar network: the (parent, production) entries each
+    summary uses, and the (parent, set of alternatives) pairs it normalizes over. Sets of
+    alternatives are deduplicated into a table of columns, so that the normalizers of a whole
+    batch are a gather followed by a logsumexp."""
+
+    def __init__(self, grammar, library, n_grammars):
+        self.G = len(grammar) + 1
+        self.n_grammars = n_grammars
+        self.library = library
+        self.columns = {p: c for c, p in enumerate(grammar.primitives)}
+        self.columns[Index(0)] = self.G - 1
+        # frozenset of alternatives -> row of the alternative table
+        self.alternativeIds = {}
+        self.alternativeColumns = []
+        self.table = None
+
+    def __getstate__(self):
+        # Summaries compiled by another compiler are compiled again, so the table need not be saved
+        return self.G, self.n_grammars, self.library, self.columns
+
+    def __setstate__(self, state):
+        self.G, self.n_grammars, self.library, self.columns = state
+        self.alternativeIds = {}
+        self.alternativeColumns = []
+        self.table = None
+
+    def alternative(self, alternatives):
+        i = self.alternativeIds.get(alternatives)
+        if i is None:
+            i = len(self.alternativeColumns)
+            self.alternativeIds[alternatives] = i
+            # Alternatives missing from the grammar do not count; column G is -inf
+            self.alternativeColumns.append([self.columns[p] for p in alternatives if p in self.columns]
+                                           or [self.G])
+        return i
+
+    def alternativeTable(self, device):
+        """Columns of every set of alternatives, padded with column G"""
+        if self.table is None or self.table.size(0) < len(self.alternativeColumns):
+            width = max(len(cs) for cs in self.alternativeColumns)
+            self.table = torch.tensor([cs + [self.G] * (width - len(cs)) for cs in self.alternativeColumns],
+                                      dtype=torch.long)
+        return self.table.to(device)
+
+    def compile(self, summary):
+        """(flat indices of uses, their counts, constant, rows of normalizers, their alternative sets, their counts)"""
+        compiled = getattr(summary, "compiled", None)
+        if compiled is not None and compiled[0] is self: return compiled[1]
+
+        useIndex, useCount, normalizerRow, normalizerSet, normalizerCount = [], [], [], [], []
+        constant = 0.
+        def add(g, s):
+            for p, count in s.uses.items():
+                c = self.columns.get(p)
+                if c is not None:
+                    useIndex.append(g * self.G + c)
+                    useCount.append(count)
+            for alternatives, count in s.normalizers.items():
+                normalizerRow.append(g)
+                normalizerSet.append(self.alternative(alternatives))
+                normalizerCount.append(count)
+            return s.constant
+        # noParent is the last network output and variableParent the penultimate one
+        constant += add(self.n_grammars - 1, summary.noParent)
+        constant += add(self.n_grammars - 2, summary.variableParent)
+        for e, ss in summary.library.items():
+            for g, s in zip(self.library[e], ss):
+                constant += add(g, s)
+
+        compiled = (useIndex, useCount, constant, normalizerRow, normalizerSet, normalizerCount)
+        summary.compiled = (self, compiled)
+        return compiled
+
+    def logLikelihoods(self, logProductions, summaries):
+        """Takes as input B x n_grammars x G log productions & B likelihood summaries;
+        returns B-dimensional vector containing log likelihood of each summary"""
+        B = logProductions.size(0)
+        assert len(summaries) == B
+        device, dtype = logProductions.device, logProductions.dtype
+
+        useBatch, useIndex, useCount, constants = [], [], [], []
+        normalizerBatch, normalizerRow, normalizerSet, normalizerCount = [], [], [], []
+        for b, summary in enumerate(summaries):
+            ui, uc, constant, nr, ns, nc = self.compile(summary)
+            useBatch.extend([b] * len(ui))
+            useIndex.extend(ui)
+            useCount.extend(uc)
+            constants.append(constant)
+            normalizerBatch.extend([b * self.n_grammars] * len(nr))
+            normalizerRow.extend(nr)
+            normalizerSet.extend(ns)
+            normalizerCount.extend(nc)
+
+        def tensor(xs, dtype=torch.long): return torch.tensor(xs, dtype=dtype, device=device)
+
+        useBatch = tensor(useBatch)
+        numerator = torch.zeros(B, dtype=dtype, device=device).index_add(
+            0, useBatch, logProductions.reshape(B, -1)[useBatch, tensor(useIndex)] * tensor(useCount, dtype))
+        numerator = numerator + tensor(constants, dtype)
+
+        padded = torch.cat([logProductions,
+                            logProductions.new_full((B, self.n_grammars, 1), NEGATIVEINFINITY)], 2)
+        padded = padded.reshape(B * self.n_grammars, self.G + 1)
+        rows = tensor(normalizerBatch) + tensor(normalizerRow)
+        z = torch.logsumexp(padded[rows.unsqueeze(1), self.alternativeTable(device)[tensor(normalizerSet)]], 1)
+        denominator = torch.zeros(B, dtype=dtype, device=device).index_add(
+            0, rows // self.n_grammars, z * tensor(normalizerCount, dtype))
+        return numerator - denominator
+
+
+def summaryCompiler(network):
+    """The ContextualSummaryCompiler of a contextual grammar network, made when first needed
+    so that networks pickled before it existed get one too"""
+    compiler = network.__dict__.get("summaryCompiler")
+    if compiler is None:
+        compiler = ContextualSummaryCompiler(network.grammar, network.library, network.n_grammars)
+        network.summaryCompiler = compiler
+    return compiler
+
+
 class ContextualGrammarNetwork_LowRank(nn.Module):
     def __init__(self, inputDimensionality, grammar, R=16):
         """Low-rank approximation to bigram model. Parameters is linear in number of primitives.
@@ -164,6 +389,10 @@ class ContextualGrammarNetwork_LowRank(nn.Module):
         return ContextualGrammar(self.grammarFromVector(transitionMatrix[-1]), self.grammarFromVector(transitionMatrix[-2]),
                 {prim: [self.grammarFromVector(transitionMatrix[j]) for j in js]
                  for prim, js in self.library.items()} )
+
+    def untorchedGrammars(self, xs):
+        """Takes as input BxinputDimensionality vector; returns the B corresponding untorched contextual grammars"""
+        return untorchedContextualGrammars(self, self.transitionMatrix(xs))
         
     def vectorizedLogLikelihoods(self, x, summaries):
         B = len(summaries)
@@ -250,95 +479,12 @@ class ContextualGrammarNetwork_LowRank(nn.Module):
     def batchedLogLikelihoods(self, xs, summaries):
         """Takes as input BxinputDimensionality vector & B likelihood summaries;
         returns B-dimensional vector containing log likelihood of each summary"""
-        use_cuda = xs.device.type == 'cuda'
-        
-        B = xs.shape[0]
-        G = len(self.grammar) + 1
-        assert len(summaries) == B
-
         # logProductions: Bx n_grammars x G
         logProductions = self.transitionMatrix(xs)
-        # uses[b][g][p] is # uses of primitive p by summary b for parent g
-        uses = np.zeros((B,self.n_grammars,len(self.grammar)+1))
-        for b,summary in enumerate(summaries):
-            for e, ss in summary.library.items():
-                for g,s in zip(self.library[e], ss):
-                    assert g < self.n_grammars - 2
-                    for p, production in enumerate(self.grammar.primitives):
-                        uses[b,g,p] = s.uses.get(production, 0.)
-                    uses[b,g,len(self.grammar)] = s.uses.get(Index(0), 0)
-                    
-            # noParent: this is the last network output
-            for p, production in enumerate(self.grammar.primitives):            
-                uses[b, self.n_grammars - 1, p] = summary.noParent.uses.get(production, 0.)
-            uses[b, self.n_grammars - 1, G - 1] = summary.noParent.uses.get(Index(0), 0.)
-
-            # variableParent: this is the penultimate network output
-            for p, production in enumerate(self.grammar.primitives):            
-                uses[b, self.n_grammars - 2, p] = summary.variableParent.uses.get(production, 0.)
-            uses[b, self.n_grammars - 2, G - 1] = summary.variableParent.uses.get(Index(0), 0.)
-            
-        numerator = (logProductions*maybe_cuda(torch.tensor(uses).float(),use_cuda)).view(B,-1).sum(1)
-
-        constant = np.zeros(B)
-        for b,summary in enumerate(summaries):
-            constant[b] += summary.noParent.constant + summary.variableParent.constant
-            for ss in summary.library.values():
-                for s in ss:
-                    constant[b] += s.constant
-            
-        numerator += maybe_cuda(torch.tensor(constant).float(),use_cuda)
-        
-        if True:
-
-            # Calculate the god-awful denominator
-            alternativeSet = set()
-            for summary in summaries:
-                for normalizer in summary.noParent.normalizers: alternativeSet.add(normalizer)
-                for normalizer in summary.variableParent.normalizers: alternativeSet.add(normalizer)
-                for ss in summary.library.values():
-                    for s in ss:
-                        for normalizer in s.normalizers: alternativeSet.add(normalizer)
-            alternativeSet = list(alternativeSet)
-
-            mask = np.zeros((len(alternativeSet), G))
-            for tau in range(len(alternativeSet)):
-                for p, production in enumerate(self.grammar.primitives):
-                    mask[tau,p] = 0. if production in alternativeSet[tau] else NEGATIVEINFINITY
-                mask[tau, G - 1] = 0. if Index(0) in alternativeSet[tau] else NEGATIVEINFINITY
-            mask = maybe_cuda(torch.tensor(mask).float(), use_cuda)
-
-            z = mask.repeat(self.n_grammars,1,1).repeat(B,1,1,1) + \
-                logProductions.repeat(len(alternativeSet),1,1,1).transpose(0,1).transpose(1,2)
-            z = torch.logsumexp(z, 3) # pytorch 1.0 dependency
-
-            N = np.zeros((B, self.n_grammars, len(alternativeSet)))
-            for b, summary in enumerate(summaries):
-                for e, ss in summary.library.items():
-                    for g,s in zip(self.library[e], ss):
-                        assert g < self.n_grammars - 2
-                        for r, alternatives in enumerate(alternativeSet):                
-                            N[b,g,r] = s.normalizers.get(alternatives, 0.)
-                # noParent: this is the last network output
-                for r, alternatives in enumerate(alternativeSet):
-                    N[b,self.n_grammars - 1,r] = summary.noParent.normalizers.get(alternatives, 0.)
-                # variableParent: this is the penultimate network output
-                for r, alternatives in enumerate(alternativeSet):
-                    N[b,self.n_grammars - 2,r] = summary.variableParent.normalizers.get(alternatives, 0.)
-            N = maybe_cuda(torch.tensor(N).float(), use_cuda)
-            denominator = (N*z).sum(1).sum(1)
-        else:
-            gs = [ self(xs[b]) for b in range(B) ]
-            denominator = torch.cat([ summary.denominator(g) for summary,g in zip(summaries, gs) ])
-            
-            
-
-        
-        
-        ll = numerator - denominator 
+        ll = summaryCompiler(self).logLikelihoods(logProductions, summaries)
 
         if False: # verifying that batching works correctly
-            gs = [ self(xs[b]) for b in range(B) ]
+            gs = [ self(xs[b]) for b in range(xs.shape[0]) ]
             _l = torch.cat([ summary.logLikelihood(g) for summary,g in zip(summaries, gs) ])
             assert torch.all((ll - _l).abs() < 0.0001)
         return ll
@@ -392,98 +538,19 @@ class ContextualGrammarNetwork_Mask(nn.Module):
                 {prim: [self.grammarFromVector(transitionMatrix[j]) for j in js]
                  for prim, js in self.library.items()} )
         
+    def untorchedGrammars(self, xs):
+        """Takes as input BxinputDimensionality vector; returns the B corresponding untorched contextual grammars"""
+        return untorchedContextualGrammars(self, self.transitionMatrix(xs))
+
     def batchedLogLikelihoods(self, xs, summaries):
         """Takes as input BxinputDimensionality vector & B likelihood summaries;
         returns B-dimensional vector containing log likelihood of each summary"""
-        use_cuda = xs.device.type == 'cuda'
-        
-        B = xs.shape[0]
-        G = len(self.grammar) + 1
-        assert len(summaries) == B
-
         # logProductions: Bx n_grammars x G
         logProductions = self.transitionMatrix(xs)
-        # uses[b][g][p] is # uses of primitive p by summary b for parent g
-        uses = np.zeros((B,self.n_grammars,len(self.grammar)+1))
-        for b,summary in enumerate(summaries):
-            for e, ss in summary.library.items():
-                for g,s in zip(self.library[e], ss):
-                    assert g < self.n_grammars - 2
-                    for p, production in enumerate(self.grammar.primitives):
-                        uses[b,g,p] = s.uses.get(production, 0.)
-                    uses[b,g,len(self.grammar)] = s.uses.get(Index(0), 0)
-                    
-            # noParent: this is the last network output
-            for p, production in enumerate(self.grammar.primitives):            
-                uses[b, self.n_grammars - 1, p] = summary.noParent.uses.get(production, 0.)
-            uses[b, self.n_grammars - 1, G - 1] = summary.noParent.uses.get(Index(0), 0.)
-
-            # variableParent: this is the penultimate network output
-            for p, production in enumerate(self.grammar.primitives):            
-                uses[b, self.n_grammars - 2, p] = summary.variableParent.uses.get(production, 0.)
-            uses[b, self.n_grammars - 2, G - 1] = summary.variableParent.uses.get(Index(0), 0.)
-            
-        numerator = (logProductions*maybe_cuda(torch.tensor(uses).float(),use_cuda)).view(B,-1).sum(1)
-
-        constant = np.zeros(B)
-        for b,summary in enumerate(summaries):
-            constant[b] += summary.noParent.constant + summary.variableParent.constant
-            for ss in summary.library.values():
-                for s in ss:
-                    constant[b] += s.constant
-            
-        numerator += maybe_cuda(torch.tensor(constant).float(),use_cuda)
-        
-        if True:
-
-            # Calculate the god-awful denominator
-            alternativeSet = set()
-            for summary in summaries:
-                for normalizer in summary.noParent.normalizers: alternativeSet.add(normalizer)
-                for normalizer in summary.variableParent.normalizers: alternativeSet.add(normalizer)
-                for ss in summary.library.values():
-                    for s in ss:
-                        for normalizer in s.normalizers: alternativeSet.add(normalizer)
-            alternativeSet = list(alternativeSet)
-
-            mask = np.zeros((len(alternativeSet), G))
-            for tau in range(len(alternativeSet)):
-                for p, production in enumerate(self.grammar.primitives):
-                    mask[tau,p] = 0. if production in alternativeSet[tau] else NEGATIVEINFINITY
-                mask[tau, G - 1] = 0. if Index(0) in alternativeSet[tau] else NEGATIVEINFINITY
-            mask = maybe_cuda(torch.tensor(mask).float(), use_cuda)
-
-            z = mask.repeat(self.n_grammars,1,1).repeat(B,1,1,1) + \
-                logProductions.repeat(len(alternativeSet),1,1,1).transpose(0,1).transpose(1,2)
-            z = torch.logsumexp(z, 3) # pytorch 1.0 dependency
-
-            N = np.zeros((B, self.n_grammars, len(alternativeSet)))
-            for b, summary in enumerate(summaries):
-                for e, ss in summary.library.items():
-                    for g,s in zip(self.library[e], ss):
-                        assert g < self.n_grammars - 2
-                        for r, alternatives in enumerate(alternativeSet):                
-                            N[b,g,r] = s.normalizers.get(alternatives, 0.)
-                # noParent: this is the last network output
-                for r, alternatives in enumerate(alternativeSet):
-                    N[b,self.n_grammars - 1,r] = summary.noParent.normalizers.get(alternatives, 0.)
-                # variableParent: this is the penultimate network output
-                for r, alternatives in enumerate(alternativeSet):
-                    N[b,self.n_grammars - 2,r] = summary.variableParent.normalizers.get(alternatives, 0.)
-            N = maybe_cuda(torch.tensor(N).float(), use_cuda)
-            denominator = (N*z).sum(1).sum(1)
-        else:
-            gs = [ self(xs[b]) for b in range(B) ]
-            denominator = torch.cat([ summary.denominator(g) for summary,g in zip(summaries, gs) ])
-            
-            
-
-        
-        
-        ll = numerator - denominator
+        ll = summaryCompiler(self).logLikelihoods(logProductions, summaries)
 
         if False: # verifying that batching works correctly
-            gs = [ self(xs[b]) for b in range(B) ]
+            gs = [ self(xs[b]) for b in range(xs.shape[0]) ]
             _l = torch.cat([ summary.logLikelihood(g) for summary,g in zip(summaries, gs) ])
             assert torch.all((ll - _l).abs() < 0.0001)
         return ll
@@ -523,88 +590,19 @@ class ContextualGrammarNetwork(nn.Module):
                 {prim: [self.grammarFromVector(allVars[j]) for j in js]
                  for prim, js in self.library.items()} )
 
+    def untorchedGrammars(self, xs):
+        """Takes as input BxinputDimensionality vector; returns the B corresponding untorched contextual grammars"""
+        return untorchedContextualGrammars(self, self.network(xs).view(xs.shape[0], self.n_grammars, -1))
+
     def batchedLogLikelihoods(self, xs, summaries):
-        use_cuda = xs.device.type == 'cuda'
         """Takes as input BxinputDimensionality vector & B likelihood summaries;
         returns B-dimensional vector containing log likelihood of each summary"""
-
         B = xs.shape[0]
         G = len(self.grammar) + 1
-        assert len(summaries) == B
 
         # logProductions: Bx n_grammars x G
         logProductions = self.network(xs).view(B, self.n_grammars, G)
-        # uses[b][g][p] is # uses of primitive p by summary b for parent g
-        uses = np.zeros((B,self.n_grammars,len(self.grammar)+1))
-        for b,summary in enumerate(summaries):
-            for e, ss in summary.library.items():
-                for g,s in zip(self.library[e], ss):
-                    assert g < self.n_grammars - 2
-                    for p, production in enumerate(self.grammar.primitives):
-                        uses[b,g,p] = s.uses.get(production, 0.)
-                    uses[b,g,len(self.grammar)] = s.uses.get(Index(0), 0)
-                    
-            # noParent: this is the last network output
-            for p, production in enumerate(self.grammar.primitives):            
-                uses[b, self.n_grammars - 1, p] = summary.noParent.uses.get(production, 0.)
-            uses[b, self.n_grammars - 1, G - 1] = summary.noParent.uses.get(Index(0), 0.)
-
-            # variableParent: this is the penultimate network output
-            for p, production in enumerate(self.grammar.primitives):            
-                uses[b, self.n_grammars - 2, p] = summary.variableParent.uses.get(production, 0.)
-            uses[b, self.n_grammars - 2, G - 1] = summary.variableParent.uses.get(Index(0), 0.)
-            
-        numerator = (logProductions*maybe_cuda(torch.tensor(uses).float(),use_cuda)).view(B,-1).sum(1)
-
-        constant = np.zeros(B)
-        for b,summary in enumerate(summaries):
-            constant[b] += summary.noParent.constant + summary.variableParent.constant
-            for ss in summary.library.values():
-                for s in ss:
-                    constant[b] += s.constant
-            
-        numerator += maybe_cuda(torch.tensor(constant).float(),use_cuda)
-
-        # Calculate the god-awful denominator
-        alternativeSet = set()
-        for summary in summaries:
-            for normalizer in summary.noParent.normalizers: alternativeSet.add(normalizer)
-            for normalizer in summary.variableParent.normalizers: alternativeSet.add(normalizer)
-            for ss in summary.library.values():
-                for s in ss:
-                    for normalizer in s.normalizers: alternativeSet.add(normalizer)
-        alternativeSet = list(alternativeSet)
-
-        mask = np.zeros((len(alternativeSet), G))
-        for tau in range(len(alternativeSet)):
-            for p, production in enumerate(self.grammar.primitives):
-                mask[tau,p] = 0. if production in alternativeSet[tau] else NEGATIVEINFINITY
-            mask[tau, G - 1] = 0. if Index(0) in alternativeSet[tau] else NEGATIVEINFINITY
-        mask = maybe_cuda(torch.tensor(mask).float(), use_cuda)
-
-        z = mask.repeat(self.n_grammars,1,1).repeat(B,1,1,1) + \
-            logProductions.repeat(len(alternativeSet),1,1,1).transpose(0,1).transpose(1,2)
-        z = torch.logsumexp(z, 3) # pytorch 1.0 dependency
-
-        N = np.zeros((B, self.n_grammars, len(alternativeSet)))
-        for b, summary in enumerate(summaries):
-            for e, ss in summary.library.items():
-                for g,s in zip(self.library[e], ss):
-                    assert g < self.n_grammars - 2
-                    for r, alternatives in enumerate(alternativeSet):                
-                        N[b,g,r] = s.normalizers.get(alternatives, 0.)
-            # noParent: this is the last network output
-            for r, alternatives in enumerate(alternativeSet):
-                N[b,self.n_grammars - 1,r] = summary.noParent.normalizers.get(alternatives, 0.)
-            # variableParent: this is the penultimate network output
-            for r, alternatives in enumerate(alternativeSet):
-                N[b,self.n_grammars - 2,r] = summary.variableParent.normalizers.get(alternatives, 0.)
-        N = maybe_cuda(torch.tensor(N).float(), use_cuda)
-        
-
-        
-        denominator = (N*z).sum(1).sum(1)
-        ll = numerator - denominator
+        ll = summaryCompiler(self).logLikelihoods(logProductions, summaries)
 
         if False: # verifying that batching works correctly
             gs = [ self(xs[b]) for b in range(B) ]
@@ -746,21 +744,23 @@ class RecognitionModel(nn.Module):
         self.nearest_encoder = nearest_encoder
         self.nearest_encoder.requires_grad = False
 
-    def auxiliaryLoss(self, frontier, features):
-        # Compute a vector of uses
+    def primitiveUses(self, frontier):
+        """Vector whose p-th entry is 1 if the best program in the frontier uses primitive p, and 0 otherwise"""
         ls = frontier.bestPosterior.program
-        def uses(summary):
-            if hasattr(summary, 'uses'): 
-                return torch.tensor([ float(int(p in summary.uses))
-                                      for p in self.generativeModel.primitives ])
-            assert hasattr(summary, 'noParent')
-            u = uses(summary.noParent) + uses(summary.variableParent)
-            for ss in summary.library.values():
+        if hasattr(ls, 'uses'):
+            used = ls.uses
+        else:
+            assert hasattr(ls, 'noParent')
+            used = set(ls.noParent.uses)
+            used.update(ls.variableParent.uses)
+            for ss in ls.library.values():
                 for s in ss:
-                    u += uses(s)
-            return u
-        u = uses(ls)
-        u[u > 1.] = 1.
+                    used.update(s.uses)
+        return torch.tensor([ float(p in used) for p in self.generativeModel.primitives ])
+
+    def auxiliaryLoss(self, frontier, features):
+        # Compute a vector of uses
+        u = self.primitiveUses(frontier)
         if self.use_cuda: u = u.cuda()
         al = self._auxiliaryLoss(self._auxiliaryPrediction(features), u)
         return al
@@ -773,13 +773,29 @@ class RecognitionModel(nn.Module):
         """Encodes sorted batch of tasks, returns n_tasks x n_encoding_dim tensor."""
         print(f"Encoding batch of n={len(tasks)} tasks for lookup only.")
         start = time.time()
-        # Naive implementation: encoding them all one by one.
-        encoded = torch.stack([
-            self.encode_features(task).detach()
-            for task in tasks
-        ], dim=0)
+        with torch.no_grad():
+            encoded, kept = self.encode_features_batch(tasks)
+        assert len(kept) == len(tasks), "Some of the tasks to look up have no features"
         eprint(f"Finished encoding batch of n={len(tasks)} tasks in {time.time() - start} seconds.")
         return encoded
+
+    def encode_features_batch(self, tasks):
+        """
+        Like encode_features, for a list of tasks. Feature extractors with a featuresOfTasks
+        method encode all of them in one forward pass. Returns the stacked features of the tasks
+        which have some, and their indices in tasks.
+        """
+        extracted = [cachedFeaturesOfTasks(extractor, tasks)
+                     for extractor in [self.featureExtractor, self.language_encoder]
+                     if extractor is not None]
+        features, kept = [], []
+        for b in range(len(tasks)):
+            fs = [f[b] for f in extracted if f[b] is not None]
+            if fs:
+                features.append(torch.cat(fs))
+                kept.append(b)
+        if not kept: return None, kept
+        return torch.stack(features), kept
         
     def encode_features(self, task):
         """
@@ -787,11 +803,11 @@ class RecognitionModel(nn.Module):
         """
         features = []
         if self.featureExtractor is not None:
-            example_features = self.featureExtractor.featuresOfTask(task)
+            example_features = cachedFeaturesOfTasks(self.featureExtractor, [task])[0]
             if example_features is not None:
                 features += [example_features]
         if self.language_encoder is not None:
-            language_features = self.language_encoder.featuresOfTask(task)
+            language_features = cachedFeaturesOfTasks(self.language_encoder, [task])[0]
             if language_features is not None:
                 features += [language_features]
         if len(features) < 1: return None
@@ -815,6 +831,19 @@ class RecognitionModel(nn.Module):
         if features is None: return None
         return self(features)
 
+    def untorchedGrammarsOfTasks(self, tasks, batchSize=256):
+        """{task: grammarOfTask(task).untorch()} for the tasks with features, computed batchSize tasks
+        at a time with one pass through the feature extractors, the MLP and the grammar network"""
+        grammars = {}
+        with torch.no_grad():
+            for start in range(0, len(tasks), batchSize):
+                batch = tasks[start:start + batchSize]
+                features, kept = self.encode_features_batch(batch)
+                if not kept: continue
+                for b, g in zip(kept, self.grammarBuilder.untorchedGrammars(self._MLP(features))):
+                    grammars[batch[b]] = g
+        return grammars
+
     def grammarLogProductionsOfTask(self, task):
         """Returns the grammar logits from non-contextual models."""
         features = self.encode_features(task)
@@ -934,6 +963,42 @@ class RecognitionModel(nn.Module):
         ml = -lls.max() #Beware that inputs to max change output type
         return ml, al
 
+    def frontiersBatchLoss(self, frontiers, biasOptimal, auxiliary=False):
+        """
+        Losses for a minibatch of frontiers, which share one pass through the MLP and the grammar network.
+        Returns (B-vector of losses, auxiliary classification loss, indices of the frontiers whose features we could extract);
+        the losses are only for the frontiers with features, and are (None, None, []) if there are none.
+        """
+        features, kept = [], []
+        for b, frontier in enumerate(frontiers):
+            f = self.encode_features(frontier.task)
+            if f is not None:
+                features.append(f)
+                kept.append(b)
+        if len(kept) == 0: return None, None, kept
+        frontiers = [frontiers[b] for b in kept]
+        features = torch.stack(features)
+
+        uses = torch.stack([self.primitiveUses(frontier) for frontier in frontiers])
+        al = self._auxiliaryLoss(self._auxiliaryPrediction(features if auxiliary else features.detach()),
+                                 maybe_cuda(uses, self.use_cuda))
+
+        features = self._MLP(features)
+        if not biasOptimal:
+            # Monte Carlo estimate of the KL: draw a sample from each frontier
+            summaries = [frontier.sample().program for frontier in frontiers]
+            return -self.grammarBuilder.batchedLogLikelihoods(features, summaries).view(-1), al, kept
+
+        # Every entry of every frontier goes through the grammar network in one batch,
+        # and then each frontier takes the best of its own entries
+        sizes = [len(frontier.entries) for frontier in frontiers]
+        owners = maybe_cuda(torch.tensor([b for b, n in enumerate(sizes) for _ in range(n)]), self.use_cuda)
+        lls = self.grammarBuilder.batchedLogLikelihoods(features[owners],
+                                                        [entry.program for frontier in frontiers for entry in frontier])
+        actual_ll = torch.tensor([entry.logLikelihood for frontier in frontiers for entry in frontier]).float()
+        lls = lls + maybe_cuda(actual_ll, self.use_cuda)
+        return -torch.stack([l.max() for l in torch.split(lls, sizes)]), al, kept
+
     def replaceProgramsWithLikelihoodSummaries(self, frontier):
         def make_entry(e):
             if e.tokens is None:
@@ -991,11 +1056,13 @@ class RecognitionModel(nn.Module):
               timeout=None, evaluationTimeout=0.001,
               helmholtzFrontiers=[], helmholtzRatio=0., helmholtzBatch=500,
               biasOptimal=None, defaultRequest=None, auxLoss=False, vectorized=True,
-              epochs=None):
+              epochs=None, batchSize=1):
         """
         helmholtzRatio: What fraction of the training data should be forward samples from the generative model?
         helmholtzFrontiers: Frontiers from programs enumerated from generative model (optional)
         If helmholtzFrontiers is not provided then we will sample programs during training
+        batchSize: How many frontiers go into each gradient step. Real and Helmholtz frontiers are mixed within a batch,
+        and the loss of a batch is the mean loss of its frontiers.
         """
         assert (steps is not None) or (timeout is not None)  or (epochs is not None), \
             "Cannot train recognition model without either a bound on the number of gradient steps, bound on the training time, or number of epochs"
@@ -1080,6 +1147,8 @@ class RecognitionModel(nn.Module):
         ## Helper methods for getting Helmholtz entries in the training loop, which can involve
         # sampling new entries if we run out.
         helmholtzIndex = [0]
+        # With several CPUs, random Helmholtz samples come from worker processes that keep sampling during training
+        dreamStream = self.streamHelmholtz(requests, CPUs) if randomHelmholtz and CPUs > 1 else None
         def getHelmholtz(max_tries=0):
             """Helper method to get the Helmholtz frontiers we have generated, or sample new ones if we ran out."""
             switchToRandom = False
@@ -1125,7 +1194,11 @@ class RecognitionModel(nn.Module):
                                       "while using",getThisMemoryUsage(),"memory")
             
             if randomHelmholtz or switchToRandom:
-                newFrontiers = self.sampleManyHelmholtz(requests, helmholtzBatch, CPUs)
+                if dreamStream is not None:
+                    newFrontiers = [f for f in itertools.islice(dreamStream, helmholtzBatch) if f is not None]
+                    eprint("Got %d/%d valid samples." % (len(newFrontiers), helmholtzBatch))
+                else:
+                    newFrontiers = self.sampleManyHelmholtz(requests, helmholtzBatch, CPUs)
                 newEntries = []
                 for f in newFrontiers:
                     e = HelmholtzEntry(f,self)
@@ -1151,16 +1224,18 @@ class RecognitionModel(nn.Module):
                     [hf.request
                      for hf in helmholtzFrontiers[helmholtzIndex[0]:helmholtzIndex[0] + helmholtzBatch] ])
             else:
-                newTasks = [hf.calculateTask() 
-                            for hf in helmholtzFrontiers[helmholtzIndex[0]:helmholtzIndex[0] + helmholtzBatch]]
-                """
-                # catwong: Disabled for ensemble training.
-                newTasks = \
-                           parallelMap(updateCPUs,
-                                       lambda f: f.calculateTask(),
-                                       helmholtzFrontiers[helmholtzIndex[0]:helmholtzIndex[0] + helmholtzBatch],
-                                       seedRandom=True)
-                """
+                batch = helmholtzFrontiers[helmholtzIndex[0]:helmholtzIndex[0] + helmholtzBatch]
+                if updateCPUs > 1:
+                    # Otherwise every worker would start out from the same random state
+                    seed = random.random()
+                    def calculateTask(j):
+                        random.seed(seed + j)
+                        return batch[j].calculateTask()
+                else:
+                    calculateTask = lambda j: batch[j].calculateTask()
+                newTasks = [None] * len(batch)
+                for j, task in parallelStream(updateCPUs, calculateTask, len(batch)):
+                    newTasks[j] = task
             badIndices = []
             endingIndex = min(helmholtzIndex[0] + helmholtzBatch, len(helmholtzFrontiers))
             for i in range(helmholtzIndex[0], endingIndex):
@@ -1190,6 +1265,7 @@ class RecognitionModel(nn.Module):
         eprint("(ID=%d): Contextual? %s" % (self.id, str(self.contextual)))
         eprint("(ID=%d): Bias optimal? %s" % (self.id, str(biasOptimal)))
         eprint(f"(ID={self.id}): Aux loss? {auxLoss} (n.b. we train a 'auxiliary' classifier anyway - this controls if gradients propagate back to the future extractor)")
+        eprint("(ID=%d): Batch size %d" % (self.id, batchSize))
 
         # The number of Helmholtz samples that we generate at once
         # Should only affect performance and shouldn't affect anything else
@@ -1200,6 +1276,52 @@ class RecognitionModel(nn.Module):
         losses, descriptionLengths, realLosses, dreamLosses, realMDL, dreamMDL = [], [], [], [], [], []
         classificationLosses = []
         totalGradientSteps = 0
+        totalFrontiers = 0
+
+        def gradientStep(batch):
+            """Takes a gradient step on a list of (frontier, dreaming)"""
+            nonlocal totalGradientSteps, totalFrontiers
+            self.zero_grad()
+            if batchSize == 1:
+                (frontier, dreaming), = batch
+                loss, classificationLoss = \
+                        self.frontierBiasOptimal(frontier, auxiliary=auxLoss, vectorized=vectorized) if biasOptimal \
+                        else self.frontierKL(frontier, auxiliary=auxLoss, vectorized=vectorized)
+                kept = [] if loss is None else [0]
+                batchLosses = None if loss is None else loss.view(-1)
+            else:
+                batchLosses, classificationLoss, kept = \
+                        self.frontiersBatchLoss([frontier for frontier, _ in batch], biasOptimal, auxiliary=auxLoss)
+            if len(kept) < len(batch):
+                for b, (frontier, dreaming) in enumerate(batch):
+                    if b in kept: continue
+                    if not dreaming:
+                        eprint("ERROR: Could not extract features during experience replay.")
+                        eprint("Task is:",frontier.task)
+                        eprint("Aborting - we need to be able to extract features of every actual task.")
+                        assert False
+                batch = [batch[b] for b in kept]
+            if len(batch) == 0:
+                return
+            loss = batchLosses.mean()
+            if is_torch_invalid(loss):
+                eprint("Invalid real-data loss!")
+                return
+            (loss + classificationLoss).backward()
+            classificationLosses.append(classificationLoss.data.item())
+            optimizer.step()
+            totalGradientSteps += 1
+            totalFrontiers += len(batch)
+            for (frontier, dreaming), l in zip(batch, batchLosses.data.tolist()):
+                losses.append(l)
+                descriptionLengths.append(min(-e.logPrior for e in frontier))
+                if dreaming:
+                    dreamLosses.append(losses[-1])
+                    dreamMDL.append(descriptionLengths[-1])
+                else:
+                    realLosses.append(losses[-1])
+                    realMDL.append(descriptionLengths[-1])
+
         for i in range(1, epochs + 1):
             if timeout and time.time() - start > timeout:
                 break
@@ -1211,43 +1333,21 @@ class RecognitionModel(nn.Module):
                 permutedFrontiers = list(frontiers)
                 random.shuffle(permutedFrontiers)
             else:
-                permutedFrontiers = [None]
+                permutedFrontiers = [None] * batchSize
 
-            finishedSteps = False
-            for frontier in permutedFrontiers:
+            batch = []
+            for n, frontier in enumerate(permutedFrontiers):
                 # Randomly decide whether to sample from the generative model
                 dreaming = random.random() < helmholtzRatio
                 if dreaming: 
                     frontier = getHelmholtz()
-                self.zero_grad()
-                loss, classificationLoss = \
-                        self.frontierBiasOptimal(frontier, auxiliary=auxLoss, vectorized=vectorized) if biasOptimal \
-                        else self.frontierKL(frontier, auxiliary=auxLoss, vectorized=vectorized)
-                if loss is None:
-                    if not dreaming:
-                        eprint("ERROR: Could not extract features during experience replay.")
-                        eprint("Task is:",frontier.task)
-                        eprint("Aborting - we need to be able to extract features of every actual task.")
-                        assert False
-                    else:
-                        continue
-                if is_torch_invalid(loss):
-                    eprint("Invalid real-data loss!")
-                else:
-                    (loss + classificationLoss).backward()
-                    classificationLosses.append(classificationLoss.data.item())
-                    optimizer.step()
-                    totalGradientSteps += 1
-                    losses.append(loss.data.item())
-                    descriptionLengths.append(min(-e.logPrior for e in frontier))
-                    if dreaming:
-                        dreamLosses.append(losses[-1])
-                        dreamMDL.append(descriptionLengths[-1])
-                    else:
-                        realLosses.append(losses[-1])
-                        realMDL.append(descriptionLengths[-1])
-                    if totalGradientSteps > steps:
-                        break # Stop iterating, then print epoch and loss, then break to finish.
+                batch.append((frontier, dreaming))
+                if len(batch) < batchSize and n < len(permutedFrontiers) - 1:
+                    continue
+                gradientStep(batch)
+                batch = []
+                if totalGradientSteps > steps:
+                    break # Stop iterating, then print epoch and loss, then break to finish.
                         
             if (i == 1 or i % 10 == 0) or (totalGradientSteps %10 == 0) and losses:
                 eprint("(ID=%d): " % self.id, "Epoch", i, "Loss", mean(losses))
@@ -1256,13 +1356,15 @@ class RecognitionModel(nn.Module):
                 eprint("(ID=%d): " % self.id, "\tvs MDL (w/o neural net)", mean(descriptionLengths))
                 if realMDL and dreamMDL:
                     eprint("\t\t(real MDL): ", mean(realMDL), "\t(dream MDL):", mean(dreamMDL))
-                eprint("(ID=%d): " % self.id, "\t%d cumulative gradient steps. %f steps/sec"%(totalGradientSteps,
-                                                                       totalGradientSteps/(time.time() - start)))
+                eprint("(ID=%d): " % self.id, "\t%d cumulative gradient steps. %f steps/sec, %f frontiers/sec"%(totalGradientSteps,
+                                                                       totalGradientSteps/(time.time() - start),
+                                                                       totalFrontiers/(time.time() - start)))
                 eprint("(ID=%d): " % self.id, "\t%d-way auxiliary classification loss"%len(self.grammar.primitives),sum(classificationLosses)/len(classificationLosses))
                 losses, descriptionLengths, realLosses, dreamLosses, realMDL, dreamMDL = [], [], [], [], [], []
                 classificationLosses = []
                 gc.collect()
         
+        if dreamStream is not None: dreamStream.close()
         eprint("(ID=%d): " % self.id, " Trained recognition model in",time.time() - start,"seconds")
         self.trained=True
         return self
@@ -1302,18 +1404,15 @@ class RecognitionModel(nn.Module):
         frequency = N / 50
         startingSeed = random.random()
 
-        # Sequentially for ensemble training.
-        samples = [self.sampleHelmholtz(requests,
-                                           statusUpdate='.' if n % frequency == 0 else None,
-                                           seed=startingSeed + n) for n in range(N)]
-
-        # (cathywong) Disabled for ensemble training. 
-        # samples = parallelMap(
-        #     1,
-        #     lambda n: self.sampleHelmholtz(requests,
-        #                                    statusUpdate='.' if n % frequency == 0 else None,
-        #                                    seed=startingSeed + n),
-        #     range(N))
+        # Every sample has its own seed, so we get the same samples however many CPUs there are.
+        # parallelStream rather than parallelMap, which cannot be used inside of ensemble training.
+        samples = [None] * N
+        for n, sample in parallelStream(CPUs,
+                                        lambda n: self.sampleHelmholtz(requests,
+                                                                       statusUpdate='.' if n % frequency == 0 else None,
+                                                                       seed=startingSeed + n),
+                                        N):
+            samples[n] = sample
         eprint()
         flushEverything()
         samples = [z for z in samples if z is not None]
@@ -1323,6 +1422,14 @@ class RecognitionModel(nn.Module):
 
         return samples
 
+    def streamHelmholtz(self, requests, CPUs):
+        """Endless stream of Helmholtz samples (None for failed samples) from CPUs worker processes,
+        which keep sampling in the background while the caller consumes them"""
+        startingSeed = random.random()
+        for _, sample in parallelStream(CPUs,
+                                        lambda n: self.sampleHelmholtz(requests, seed=startingSeed + n)):
+            yield sample
+
     def enumerateFrontiers(self,
                            tasks,
                            enumerationTimeout=None,
@@ -1332,12 +1439,12 @@ class RecognitionModel(nn.Module):
                            frontierSize=None,
                            maximumFrontier=None,
                            evaluationTimeout=None,
-                           max_mem_per_enumeration_thread=1000000):
+                           max_mem_per_enumeration_thread=1000000,
+                           persistentSolvers=False,
+                           resumableEnumeration=False,
+                           observationalEquivalence=False):
         with timing("Evaluated recognition model"):
-            grammars = {task: self.grammarOfTask(task)
-                        for task in tasks}
-            #untorch seperately to make sure you filter out None grammars
-            grammars = {task: grammar.untorch() for task, grammar in grammars.items() if grammar is not None}
+            grammars = self.untorchedGrammarsOfTasks(list(tasks))
 
         return multicoreEnumeration(grammars, tasks,
                                     testing=testing,
@@ -1346,7 +1453,43 @@ class RecognitionModel(nn.Module):
                                     CPUs=CPUs, maximumFrontier=maximumFrontier,
                                     evaluationTimeout=evaluationTimeout,
                                     unigramGrammar=self.generativeModel,
-                                    max_mem_per_enumeration_thread=max_mem_per_enumeration_thread)
+                                    max_mem_per_enumeration_thread=max_mem_per_enumeration_thread,
+                                    persistentSolvers=persistentSolvers,
+                                    resumableEnumeration=resumableEnumeration,
+                                    observationalEquivalence=observationalEquivalence)
+
+    @staticmethod
+    def enumerateEnsembleFrontiers(recognizers,
+                                   tasks,
+                                   enumerationTimeout=None,
+                                   testing=False,
+                                   solver=None,
+                                   CPUs=1,
+                                   maximumFrontier=None,
+                                   evaluationTimeout=None,
+                                   max_mem_per_enumeration_thread=1000000,
+                                   persistentSolvers=False,
+                                   resumableEnumeration=False,
+                                   observationalEquivalence=False):
+        """Enumerates from the grammars of all of the recognizers at once, sharing the CPUs and the frontiers.
+        Returns (list-of-frontiers, map-from-task-to-search-time, [map-from-task-to-search-time for each recognizer])"""
+        with timing("Evaluated %d recognition models" % len(recognizers)):
+            grammars = [r.untorchedGrammarsOfTasks(list(tasks)) for r in recognizers]
+
+        memberSearchTimes = []
+        frontiers, times = multicoreEnumeration(grammars, tasks,
+                                                testing=testing,
+                                                solver=solver,
+                                                enumerationTimeout=enumerationTimeout,
+                                                CPUs=CPUs, maximumFrontier=maximumFrontier,
+                                                evaluationTimeout=evaluationTimeout,
+                                                unigramGrammar=recognizers[0].generativeModel,
+                                                max_mem_per_enumeration_thread=max_mem_per_enumeration_thread,
+                                                persistentSolvers=persistentSolvers,
+                                                resumableEnumeration=resumableEnumeration,
+                                                observationalEquivalence=observationalEquivalence,
+                                                memberSearchTimes=memberSearchTimes)
+        return frontiers, times, memberSearchTimes
 
 
 class RecurrentFeatureExtractor(nn.Module):
@@ -1489,9 +1632,11 @@ class RecurrentFeatureExtractor(nn.Module):
         x = pack_padded_sequence(x, sizes)
         return x, sizes
 
+    @staticmethod
+    def exampleSize(xs_y): return sum(len(z) + 1 for z in xs_y[0]) + len(xs_y[1])
+
     def examplesEncoding(self, examples):
-        examples = sorted(examples, key=lambda xs_y: sum(
-            len(z) + 1 for z in xs_y[0]) + len(xs_y[1]), reverse=True)
+        examples = sorted(examples, key=self.exampleSize, reverse=True)
         x, sizes = self.packExamples(examples)
         outputs, hidden = self.model(x)
         # outputs, sizes = pad_packed_sequence(outputs)
@@ -1499,6 +1644,14 @@ class RecurrentFeatureExtractor(nn.Module):
         # activations...
         return hidden[0, :, :] + hidden[1, :, :]
 
+    def sampleExamples(self, tokenized):
+        """At most MAXINPUTS of the tokenized examples, sampled afresh on every call"""
+        if hasattr(self, 'MAXINPUTS') and len(tokenized) > self.MAXINPUTS:
+            tokenized = list(tokenized)
+            random.shuffle(tokenized)
+            tokenized = tokenized[:self.MAXINPUTS]
+        return tokenized
+
     def forward(self, examples_or_task):
         # Takes either the examples themselves, or the task, depending on the tokenization function.
         # If the self.useTask == True, this is a task.
@@ -1506,10 +1659,7 @@ class RecurrentFeatureExtractor(nn.Module):
         if not tokenized:
             return None
 
-        if hasattr(self, 'MAXINPUTS') and len(tokenized) > self.MAXINPUTS:
-            tokenized = list(tokenized)
-            random.shuffle(tokenized)
-            tokenized = tokenized[:self.MAXINPUTS]
+        tokenized = self.sampleExamples(tokenized)
         e = self.examplesEncoding(tokenized)
         # max pool
         # e,_ = e.max(dim = 0)
@@ -1520,15 +1670,47 @@ class RecurrentFeatureExtractor(nn.Module):
         e = e.mean(dim=0)
         return e
 
-    def featuresOfTask(self, t):
+    def inputOfTask(self, t):
         if hasattr(self, 'useFeatures'):
-            f = self(t.features)
+            return t.features
         elif hasattr(self, 'useTask'):
-            f = self(t)
+            return t
         else:
             # Featurize the examples directly.
-            f = self(t.examples)
-        return f
+            return t.examples
+
+    def featuresOfTask(self, t):
+        return self(self.inputOfTask(t))
+
+    def featuresOfTasks(self, ts):
+        """
+        featuresOfTask of each of ts, running the examples of all of them through the GRU as one batch.
+        """
+        if type(self).featuresOfTask is not RecurrentFeatureExtractor.featuresOfTask or \
+           type(self).forward is not RecurrentFeatureExtractor.forward:
+            return [self.featuresOfTask(t) for t in ts]
+        examples = []
+        for b, t in enumerate(ts):
+            tokenized = self.tokenize(self.inputOfTask(t))
+            if tokenized:
+                examples += [(e, b) for e in self.sampleExamples(tokenized)]
+        features = [None]*len(ts)
+        if not examples: return features
+        # examplesEncoding sorts the examples in this order too, and the sort is stable
+        examples.sort(key=lambda e_b: self.exampleSize(e_b[0]), reverse=True)
+        e = self.examplesEncoding([e for e, _ in examples])
+        owners = variable([b for _, b in examples], cuda=self.use_cuda).long()
+        for b in {b for _, b in examples}:
+            features[b] = e[owners == b].mean(dim=0)
+        return features
+
+    def deterministicFeaturesOf(self, t):
+        """Whether the features of t come out the same on every call: forward subsamples the examples of t if
+        there are more than MAXINPUTS of them"""
+        if not hasattr(self, 'MAXINPUTS') or type(self).featuresOfTask is not RecurrentFeatureExtractor.featuresOfTask:
+            return True
+        tokenized = self.tokenize(self.inputOfTask(t))
+        return not tokenized or len(tokenized) <= self.MAXINPUTS
 
     def taskOfProgram(self, p, tp):
         # TODO -- remove this
@@ -1653,6 +1835,7 @@ class DummyFeatureExtractor(nn.Module):
         return Task("dummy task", t, [])
 
 class RandomFeatureExtractor(nn.Module):
+    deterministicFeatures = False
     def __init__(self, tasks):
         super(RandomFeatureExtractor, self).__init__()
         self.outputDimensionality = 1
@@ -1,7 +1,6 @@
 from dreamcoder.program import *
 from dreamcoder.differentiation import *
-
-import signal
+from dreamcoder.utilities import CPUTimeLimit
 
 
 class EvaluationTimeout(Exception):
@@ -71,37 +70,34 @@ class Task(object):
             return self.use_supervised
 
     def check(self, e, timeout=None):
-        if timeout is not None:
-            def timeoutCallBack(_1, _2): raise EvaluationTimeout()
         try:
-            signal.signal(signal.SIGVTALRM, timeoutCallBack)
-            signal.setitimer(signal.ITIMER_VIRTUAL, timeout)
-
-            try:
-                f = e.evaluate([])
-            except IndexError:
-                # free variable
-                return False
-            except Exception as e:
-                eprint("Exception during evaluation:", e)
-                return False
-
-            for x, y in self.examples:
-                if self.cache and (x, e) in EVALUATIONTABLE:
-                    p = EVALUATIONTABLE[(x, e)]
-                else:
-                    try:
-                        p = self.predict(f, x)
-                    except BaseException as err:
-                        print("Err during evaluation" + str(err))
-                        p = None
-                    if self.cache:
-                        EVALUATIONTABLE[(x, e)] = p
-                if p != y:
-                    if timeout is not None:
-                        signal.signal(signal.SIGVTALRM, lambda *_: None)
-                        signal.setitimer(signal.ITIMER_VIRTUAL, 0)
+            with CPUTimeLimit(timeout, EvaluationTimeout):
+                try:
+                    f = e.compile()()
+                except IndexError:
+                    # free variable
                     return False
+                except EvaluationTimeout:
+                    raise
+                except Exception as e:
+                    eprint("Exception during evaluation:", e)
+                    return False
+
+                for x, y in self.examples:
+                    if self.cache and (x, e) in EVALUATIONTABLE:
+                        p = EVALUATIONTABLE[(x, e)]
+                    else:
+                        try:
+                            p = self.predict(f, x)
+                        except EvaluationTimeout:
+                            raise
+                        except BaseException as err:
+                            print("Err during evaluation" + str(err))
+                            p = None
+                        if self.cache:
+                            EVALUATIONTABLE[(x, e)] = p
+                    if p != y:
+                        return False
 
             return True
         # except e:
@@ -110,10 +106,6 @@ class Task(object):
         except EvaluationTimeout:
             eprint("Timed out while evaluating", e)
             return False
-        finally:
-            if timeout is not None:
-                signal.signal(signal.SIGVTALRM, lambda *_: None)
-                signal.setitimer(signal.ITIMER_VIRTUAL, 0)
 
     def logLikelihood(self, e, timeout=None):
         if self.check(e, timeout):
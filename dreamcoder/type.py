@@ -7,6 +7,8 @@ class Occurs(UnificationFailure):
 
 
 class Type(object):
+    __slots__ = ()
+
     def __str__(self): return self.show(True)
 
     def __repr__(self): return str(self)
@@ -20,10 +22,16 @@ class Type(object):
 
 
 class TypeConstructor(Type):
+    __slots__ = ("name", "arguments", "isPolymorphic")
+
     def __init__(self, name, arguments):
         self.name = name
         self.arguments = arguments
-        self.isPolymorphic = any(a.isPolymorphic for a in arguments)
+        self.isPolymorphic = False
+        for a in arguments:
+            if a.isPolymorphic:
+                self.isPolymorphic = True
+                break
 
     def makeDummyMonomorphic(self, mapping=None):
         mapping = mapping if mapping is not None else {}
@@ -37,6 +45,12 @@ class TypeConstructor(Type):
 
     def __hash__(self): return hash((self.name,) + tuple(self.arguments))
 
+    def __getstate__(self): return self.name, self.arguments
+    def __setstate__(self, state):
+        # backward compatibility: pickled as a dictionary before slots
+        if isinstance(state, dict): state = state["name"], state["arguments"]
+        self.__init__(*state)
+
     def __ne__(self, other):
         return not (self == other)
 
@@ -76,8 +90,12 @@ class TypeConstructor(Type):
     def apply(self, context):
         if not self.isPolymorphic:
             return self
-        return TypeConstructor(self.name,
-                               [x.apply(context) for x in self.arguments])
+        arguments = [x.apply(context) for x in self.arguments]
+        # Share this type if the context did not touch any of its variables
+        for x, y in zip(arguments, self.arguments):
+            if x is not y:
+                return TypeConstructor(self.name, arguments)
+        return self
 
     def applyMutable(self, context):
         if not self.isPolymorphic:
@@ -125,6 +143,8 @@ class TypeConstructor(Type):
 
 
 class TypeVariable(Type):
+    __slots__ = ("v", "isPolymorphic")
+
     def __init__(self, j):
         assert isinstance(j, int)
         self.v = j
@@ -144,6 +164,12 @@ class TypeVariable(Type):
 
     def __hash__(self): return self.v
 
+    def __getstate__(self): return self.v
+    def __setstate__(self, state):
+        # backward compatibility: pickled as a dictionary before slots
+        self.v = state["v"] if isinstance(state, dict) else state
+        self.isPolymorphic = True
+
     def show(self, _): return "t%d" % self.v
 
     def json(self):
@@ -156,10 +182,10 @@ class TypeVariable(Type):
     def functionArguments(self): return []
 
     def apply(self, context):
-        for v, t in context.substitution:
-            if v == self.v:
-                return t.apply(context)
-        return self
+        t = context.lookup(self.v)
+        if t is None:
+            return self
+        return t.apply(context)
 
     def applyMutable(self, context):
         s = context.substitution[self.v]
@@ -177,7 +203,7 @@ class TypeVariable(Type):
             return (context, bindings[self.v])
         new = TypeVariable(context.nextVariable)
         bindings[self.v] = new
-        context = Context(context.nextVariable + 1, context.substitution)
+        context = context._withNextVariable(context.nextVariable + 1)
         return (context, new)
 
     def instantiateMutable(self, context, bindings=None):
@@ -201,15 +227,133 @@ class TypeVariable(Type):
 
 
 class Context(object):
+    """
+    Immutable type context: the next fresh type variable, and a substitution from type variables to types.
+    The substitution is a persistent 16-way trie keyed on the type variable,
+    so extend copies one small node per level of the trie and lookup is a couple of indexing operations,
+    rather than both being linear in the size of the substitution.
+    Contexts share every node of the trie that they have in common, and nodes are never mutated once built.
+    In practice substitutions are small, and the trie has a single level.
+    """
+    __slots__ = ("nextVariable", "_root", "_shift")
+
+    BITS = 4
+    WIDTH = 1 << BITS
+    MASK = WIDTH - 1
+
     def __init__(self, nextVariable=0, substitution=[]):
         self.nextVariable = nextVariable
-        self.substitution = substitution
+        # _root is None or a list of WIDTH children; the leaves of the trie are types
+        # _shift is BITS * (height of the trie - 1)
+        self._root = None
+        self._shift = 0
+        for j, t in reversed(list(substitution)):
+            self._root, self._shift = self._insert(j, t)
+
+    def _insert(self, j, t):
+        """Returns (root, shift) of the trie with j bound to t"""
+        # type variables are usually small and nonnegative, but negateVariables makes negative ones
+        k = j + j if j >= 0 else -j - j - 1
+        root, shift = self._root, self._shift
+        if root is None:
+            root = [None] * Context.WIDTH
+        # grow the trie until it is tall enough to hold k
+        while k >> (shift + Context.BITS):
+            root = [root] + [None] * (Context.WIDTH - 1)
+            shift += Context.BITS
+
+        newRoot = node = root[:]
+        s = shift
+        while s > 0:
+            i = (k >> s) & Context.MASK
+            child = node[i]
+            child = [None] * Context.WIDTH if child is None else child[:]
+            node[i] = child
+            node = child
+            s -= Context.BITS
+        node[k & Context.MASK] = t
+        return newRoot, shift
+
+    def lookup(self, j):
+        """The type bound to type variable j, or None if j is unbound"""
+        k = j + j if j >= 0 else -j - j - 1
+        shift = self._shift
+        if k >> (shift + Context.BITS):
+            return None
+        node = self._root
+        while shift > 0:
+            if node is None:
+                return None
+            node = node[(k >> shift) & Context.MASK]
+            shift -= Context.BITS
+        if node is None:
+            return None
+        return node[k & Context.MASK]
+
+    def __len__(self): return len(self.substitution)
+
+    def bindsVariableAtLeast(self, j):
+        """Is some type variable >= j bound? (j >= 0)"""
+        root = self._root
+        if root is None:
+            return False
+        if self._shift == 0:
+            # nonnegative variables have even keys
+            return any(t is not None for t in root[j + j::2])
+        return any(v >= j for v, _ in self.substitution)
+
+    def _withNextVariable(self, nextVariable):
+        c = Context.__new__(Context)
+        c.nextVariable = nextVariable
+        c._root = self._root
+        c._shift = self._shift
+        return c
+
+    @property
+    def substitution(self):
+        """[(type variable, type)], for code that wants to look at the whole substitution"""
+        bindings = []
+
+        def walk(node, shift, prefix):
+            if node is None:
+                return
+            for i, child in enumerate(node):
+                if child is None:
+                    continue
+                k = prefix | (i << shift)
+                if shift == 0:
+                    bindings.append((k >> 1 if k % 2 == 0 else -((k + 1) >> 1), child))
+                else:
+                    walk(child, shift - Context.BITS, k)
+
+        walk(self._root, self._shift, 0)
+        return bindings
+
+    def __getstate__(self):
+        return self.nextVariable, self.substitution
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):  # pickled before the substitution was a trie
+            state = state["nextVariable"], state["substitution"]
+        self.__init__(*state)
 
     def extend(self, j, t):
-        return Context(self.nextVariable, [(j, t)] + self.substitution)
+        c = Context.__new__(Context)
+        c.nextVariable = self.nextVariable
+        k = j + j if j >= 0 else -j - j - 1
+        if self._shift == 0 and k < Context.WIDTH:
+            # Fast path: the trie is a single node
+            root = self._root
+            root = [None] * Context.WIDTH if root is None else root[:]
+            root[k] = t
+            c._root = root
+            c._shift = 0
+        else:
+            c._root, c._shift = self._insert(j, t)
+        return c
 
     def makeVariable(self):
-        return (Context(self.nextVariable + 1, self.substitution),
+        return (self._withNextVariable(self.nextVariable + 1),
                 TypeVariable(self.nextVariable))
 
     def unify(self, t1, t2):
@@ -1,5 +1,8 @@
+import atexit
+import ctypes
 import inspect
 import signal
+import threading
 import random
 import time
 import datetime
@@ -231,14 +234,41 @@ POSITIVEINFINITY = float('inf')
 
 PARALLELMAPDATA = None
 PARALLELBASESEED = None
+# Functions and data that pickle to more than this many bytes are not sent to the worker pool,
+# because each of its workers would receive its own copy. They are inherited through a fork instead.
+PARALLELMAPSTATELIMIT = 16 * 10**6
 
 
 def parallelMap(numberOfCPUs, f, *xs, chunksize=None, maxtasksperchild=None, memorySensitive=False,
                 seedRandom=False):
-    """seedRandom: Should each parallel worker be given a different random seed?"""
-    global PARALLELMAPDATA
-    global PARALLELBASESEED
-
+    """seedRandom: Should each parallel worker be given a different random seed?
+    Runs on the long-lived workers of WorkerPool.shared(), which are reused across calls,
+    unless maxtasksperchild or memorySensitive is given, or f and xs cannot be pickled or are
+    bigger than PARALLELMAPSTATELIMIT: then this forks a fresh pool, whose workers share the
+    memory of this process copy-on-write. Use Broadcast for large read-only data that many calls share."""
+    n = len(xs[0])
+    ys = [None] * n
+    for j, y in _parallelMapUnordered(numberOfCPUs, f, xs, chunksize, maxtasksperchild, memorySensitive,
+                                      seedRandom):
+        ys[j] = y
+    return ys
+
+
+def parallelIMap(numberOfCPUs, f, *xs, chunksize=1, memorySensitive=False, seedRandom=False):
+    """Like parallelMap, but yields each f(x) as soon as it and everything before it are computed"""
+    pending = {}
+    nextIndex = 0
+    for j, y in _parallelMapUnordered(numberOfCPUs, f, xs, chunksize, None, memorySensitive, seedRandom,
+                                      shuffle=False):
+        pending[j] = y
+        while nextIndex in pending:
+            yield pending.pop(nextIndex)
+            nextIndex += 1
+
+
+def _parallelMapUnordered(numberOfCPUs, f, xs, chunksize, maxtasksperchild, memorySensitive, seedRandom,
+                          shuffle=True):
+    """Yields (j, f(*[x[j] for x in xs])) in whatever order they are computed"""
     if memorySensitive:
         memoryUsage = getMemoryUsageFraction()/100.
         correctedCPUs = max(1,
@@ -248,39 +278,63 @@ def parallelMap(numberOfCPUs, f, *xs, chunksize=None, maxtasksperchild=None, mem
         if correctedCPUs < numberOfCPUs:
             eprint("In order to not use all of the memory on the machine (%f gb), we are limiting this parallel map to only use %d CPUs"%(howManyGigabytesOfMemory(),correctedCPUs))
         numberOfCPUs = correctedCPUs
-        
 
     if numberOfCPUs == 1:
-        return list(map(f, *xs))
+        yield from enumerate(map(f, *xs))
+        return
 
     n = len(xs[0])
     for x in xs:
         assert len(x) == n
 
-    assert PARALLELMAPDATA is None    
-    PARALLELMAPDATA = (f, xs)
-    assert PARALLELBASESEED is None
-    if seedRandom:
-        PARALLELBASESEED = random.random()
-
-    from multiprocessing import Pool
+    baseSeed = random.random() if seedRandom else None
 
     # Randomize the order in case easier ones come earlier or later
     permutation = list(range(n))
-    random.shuffle(permutation)
-    inversePermutation = dict(zip(permutation, range(n)))
+    if shuffle: random.shuffle(permutation)
 
     # Batch size of jobs as they are sent to processes
     if chunksize is None:
         chunksize = max(1, n // (numberOfCPUs * 2))
-    pool = Pool(numberOfCPUs, maxtasksperchild=maxtasksperchild)
-    ys = pool.map(parallelMapCallBack, permutation,
-                  chunksize=chunksize)
-    pool.terminate()
 
-    PARALLELMAPDATA = None
-    PARALLELBASESEED = None
-    return [ys[inversePermutation[j]] for j in range(n)]
+    state = None
+    if maxtasksperchild is None and not memorySensitive:
+        import dill
+        try:
+            state = dill.dumps((f, xs, baseSeed), recurse=True)
+        except Exception as e:
+            eprint("parallelMap: cannot send the function to the worker pool (%s), forking a new pool instead." % e)
+        if state is not None and len(state) > PARALLELMAPSTATELIMIT:
+            state = None
+    if state is None:
+        ys = _forkedParallelMap(numberOfCPUs, f, xs, permutation, chunksize, maxtasksperchild, baseSeed)
+        yield from zip(permutation, ys)
+        return
+
+    chunks = [permutation[i:i + chunksize] for i in range(0, n, chunksize)]
+    yield from WorkerPool.shared().run(numberOfCPUs, state, chunks)
+
+
+def _forkedParallelMap(numberOfCPUs, f, xs, permutation, chunksize, maxtasksperchild, baseSeed):
+    """f(*[x[j] for x in xs]) for each j in permutation, on a pool forked just for this call"""
+    global PARALLELMAPDATA
+    global PARALLELBASESEED
+
+    assert PARALLELMAPDATA is None    
+    PARALLELMAPDATA = (f, xs)
+    assert PARALLELBASESEED is None
+    PARALLELBASESEED = baseSeed
+
+    from multiprocessing import Pool
+
+    pool = Pool(numberOfCPUs, maxtasksperchild=maxtasksperchild)
+    try:
+        return pool.map(parallelMapCallBack, permutation,
+                        chunksize=chunksize)
+    finally:
+        pool.terminate()
+        PARALLELMAPDATA = None
+        PARALLELBASESEED = None
 
 
 def parallelMapCallBack(j):
@@ -298,6 +352,285 @@ def parallelMapCallBack(j):
         raise e
 
 
+def parallelStream(numberOfCPUs, f, n=None):
+    """
+    Yields (j, f(j)) for j in range(n), or for every j if n is None, as soon as each one is computed.
+    Unlike parallelMap the workers are forked directly, rather than through multiprocessing,
+    so this also works inside of a parallelMap worker (which is daemonic, and so may not have children),
+    and nothing is kept in global state.
+    Worker w computes j = w, w + numberOfCPUs, ... and blocks when nobody is reading its results,
+    so an endless stream only runs a little ahead of the consumer.
+    Closing the generator kills the workers.
+    """
+    import dill
+    import select
+
+    if numberOfCPUs == 1:
+        j = 0
+        while n is None or j < n:
+            yield j, f(j)
+            j += 1
+        return
+
+    workers = {}  # read end of the pipe -> process ID of the worker
+    try:
+        for w in range(numberOfCPUs if n is None else min(numberOfCPUs, n)):
+            r, wr = os.pipe()
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    os.close(r)
+                    for fd in workers:
+                        os.close(fd)
+                    j = w
+                    while n is None or j < n:
+                        try:
+                            message = dill.dumps((j, f(j), None))
+                        except Exception:
+                            message = dill.dumps((j, None, traceback.format_exc()))
+                        message = len(message).to_bytes(8, "little") + message
+                        while message:
+                            message = message[os.write(wr, message):]
+                        j += numberOfCPUs
+                finally:
+                    os._exit(0)
+            os.close(wr)
+            workers[r] = pid
+
+        while workers:
+            ready, _, _ = select.select(list(workers), [], [])
+            for r in ready:
+                header = readExactly(r, 8)
+                if header is None:
+                    os.close(r)
+                    os.waitpid(workers.pop(r), 0)
+                    continue
+                j, y, failure = dill.loads(readExactly(r, int.from_bytes(header, "little")))
+                if failure is not None:
+                    eprint("Exception in worker during parallel stream:\n%s" % failure)
+                    raise Exception("parallelStream: worker failed on %d" % j)
+                yield j, y
+    finally:
+        for r, pid in workers.items():
+            os.close(r)
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            os.waitpid(pid, 0)
+
+
+def readExactly(fd, size):
+    """Reads size bytes from the file descriptor, or returns None if it is closed first"""
+    chunks = []
+    while size > 0:
+        chunk = os.read(fd, size)
+        if len(chunk) == 0:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def sendMessage(fd, message):
+    """Writes a dill-pickled message, preceded by its length"""
+    import dill
+    message = dill.dumps(message)
+    message = len(message).to_bytes(8, "little") + message
+    while message:
+        message = message[os.write(fd, message):]
+
+
+def receiveMessage(fd):
+    """Reads a message written by sendMessage, or returns None if the file descriptor is closed first"""
+    import dill
+    header = readExactly(fd, 8)
+    if header is None: return None
+    message = readExactly(fd, int.from_bytes(header, "little"))
+    if message is None: return None
+    return dill.loads(message)
+
+
+class WorkerPool(object):
+    """
+    Long-lived worker processes, forked as they are needed and shared by every parallelMap of a process.
+    Each call pickles its function and data once, and sends that to each worker it uses before any of
+    the work, which is then sent as lists of indices. Broadcasts are sent to each worker only once.
+    The workers of a call may together grow by half of the memory that was available when it started;
+    a worker past its share retires after finishing its current chunk, and is replaced by a new fork.
+    Workers exit when the pool closes, or when the process that owns the pool goes away.
+    """
+    _shared = None
+    # Inside of a worker: key -> value of each Broadcast that the worker has received
+    received = {}
+
+    @staticmethod
+    def shared():
+        """The pool of this process. Forked processes get a new one, rather than the pool of their parent"""
+        if WorkerPool._shared is None or WorkerPool._shared.owner != os.getpid():
+            WorkerPool._shared = WorkerPool()
+        return WorkerPool._shared
+
+    def __init__(self):
+        self.owner = os.getpid()
+        # Each worker is a dict with its pid, the file descriptors to and from it,
+        # and the ID of the call whose function and data it holds
+        self.workers = []
+        self.calls = 0
+        # key -> pickled value of each Broadcast that has not yet been released
+        self.broadcasts = {}
+        atexit.register(self.close)
+
+    def spawn(self):
+        fromParent, toWorker = os.pipe()
+        fromWorker, toParent = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(toWorker)
+                os.close(fromWorker)
+                for w in self.workers:
+                    os.close(w["send"])
+                    os.close(w["receive"])
+                WorkerPool._serve(fromParent, toParent)
+            finally:
+                os._exit(0)
+        os.close(fromParent)
+        os.close(toParent)
+        worker = {"pid": pid, "send": toWorker, "receive": fromWorker, "call": None, "broadcasts": set()}
+        self.workers.append(worker)
+        return worker
+
+    @staticmethod
+    def _serve(receive, send):
+        import dill
+        startingMemory = getThisMemoryUsage()
+        f, xs, baseSeed = None, None, None
+        while True:
+            message = receiveMessage(receive)
+            if message is None: return
+            if message[0] == "broadcast":
+                WorkerPool.received[message[1]] = dill.loads(message[2])
+                continue
+            if message[0] == "forget":
+                WorkerPool.received.pop(message[1], None)
+                continue
+            if message[0] == "state":
+                f, xs, baseSeed = dill.loads(message[1])
+                continue
+            _, chunk, memoryLimit = message
+            ys = []
+            try:
+                for j in chunk:
+                    if baseSeed is not None:
+                        random.seed(baseSeed + j)
+                    ys.append((j, f(*[x[j] for x in xs])))
+                failure = None
+            except Exception:
+                failure = (j, traceback.format_exc())
+            retiring = getThisMemoryUsage() - startingMemory > memoryLimit
+            sendMessage(send, (ys, failure, retiring))
+            if retiring: return
+
+    def register(self, handle):
+        """Makes sure that every worker of later calls receives the value of the Broadcast"""
+        if handle.key not in self.broadcasts:
+            import dill
+            self.broadcasts[handle.key] = dill.dumps(handle.value, recurse=True)
+
+    def forget(self, key):
+        """Drops a Broadcast from this pool and from the workers that received it"""
+        self.broadcasts.pop(key, None)
+        for worker in self.workers:
+            if key in worker["broadcasts"]:
+                sendMessage(worker["send"], ("forget", key))
+                worker["broadcasts"].discard(key)
+
+    def retire(self, worker, kill=False):
+        self.workers.remove(worker)
+        os.close(worker["send"])
+        os.close(worker["receive"])
+        if kill:
+            try:
+                os.kill(worker["pid"], signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        os.waitpid(worker["pid"], 0)
+
+    def run(self, numberOfCPUs, state, chunks):
+        """
+        state: dill pickle of (f, xs, base random seed or None). chunks: lists of indices into xs.
+        Yields (j, f(*[x[j] for x in xs])) for every index, as they are computed, using numberOfCPUs workers.
+        """
+        import select
+        self.calls += 1
+        call = self.calls
+        memoryLimit = 0.5 * psutil.virtual_memory().available / numberOfCPUs
+        chunks = list(reversed(chunks))
+        busy = {} # file descriptor from a worker -> that worker
+        try:
+            while chunks or busy:
+                while chunks and len(busy) < numberOfCPUs:
+                    idle = [w for w in self.workers if w["receive"] not in busy]
+                    worker = idle[0] if idle else self.spawn()
+                    if worker["call"] != call:
+                        for key, value in self.broadcasts.items():
+                            if key not in worker["broadcasts"]:
+                                sendMessage(worker["send"], ("broadcast", key, value))
+                                worker["broadcasts"].add(key)
+                        sendMessage(worker["send"], ("state", state))
+                        worker["call"] = call
+                    sendMessage(worker["send"], ("run", chunks.pop(), memoryLimit))
+                    busy[worker["receive"]] = worker
+                ready, _, _ = select.select(list(busy), [], [])
+                for r in ready:
+                    worker = busy.pop(r)
+                    message = receiveMessage(r)
+                    if message is None:
+                        self.retire(worker)
+                        raise Exception("parallelMap: worker %d exited unexpectedly" % worker["pid"])
+                    ys, failure, retiring = message
+                    if retiring: self.retire(worker)
+                    if failure is not None:
+                        eprint("Exception in worker during parallel map:\n%s" % failure[1])
+                        raise Exception("parallelMap: worker failed on %d" % failure[0])
+                    yield from ys
+        finally:
+            # Workers still busy with an abandoned call are in no state to be reused
+            for worker in busy.values():
+                self.retire(worker, kill=True)
+
+    def close(self):
+        for worker in list(self.workers):
+            self.retire(worker, kill=True)
+
+
+class Broadcast(object):
+    """
+    Read-only data shared by the parallel maps of an iteration, which functions read as handle.value.
+    Pickling the handle only pickles its key: the value is sent to each worker of WorkerPool.shared()
+    once, rather than along with every call. release() the handle once the iteration is over.
+    """
+    count = 0
+
+    def __init__(self, value):
+        Broadcast.count += 1
+        self.key = (os.getpid(), Broadcast.count)
+        self.value = value
+
+    def __getstate__(self):
+        WorkerPool.shared().register(self)
+        return {"key": self.key}
+
+    def __setstate__(self, state):
+        self.key = state["key"]
+        self.value = WorkerPool.received[self.key]
+
+    def release(self):
+        WorkerPool.shared().forget(self.key)
+        self.value = None
+
+
 def log(x):
     t = type(x)
     if t == int or t == float:
@@ -378,16 +711,34 @@ def forkCallBack(x):
 
 
 def callFork(f, *arguments, **kw):
-    """Forks a new process to execute the call. Blocks until the call completes."""
-    global FORKPARAMETERS
-
-    from multiprocessing import Pool
-
-    workers = Pool(1)
-    ys = workers.map(forkCallBack, [[f, arguments, kw]])
-    workers.terminate()
-    assert len(ys) == 1
-    return ys[0]
+    """Forks a new process to execute the call. Blocks until the call completes.
+    The call sees the memory of this process as it is now, and nothing it does survives it.
+    Like parallelStream this forks directly, so it also works inside of a parallelMap worker."""
+    receive, send = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(receive)
+            try:
+                message = (f(*arguments, **kw), None)
+            except Exception:
+                message = (None, traceback.format_exc())
+            sendMessage(send, message)
+        finally:
+            os._exit(0)
+    os.close(send)
+    try:
+        message = receiveMessage(receive)
+    finally:
+        os.close(receive)
+        os.waitpid(pid, 0)
+    if message is None:
+        raise Exception("callFork: process %d exited without returning" % pid)
+    y, failure = message
+    if failure is not None:
+        eprint("Exception in worker during forking:\n%s" % failure)
+        raise Exception("callFork: the forked call failed")
+    return y
 
 PARALLELPROCESSDATA = None
 
@@ -797,26 +1148,151 @@ class RunWithTimeout(Exception):
     pass
 
 
+class EvaluationWatchdog(object):
+    """
+    Enforces the CPU time limits of evaluations (see CPUTimeLimit) without a syscall per evaluation.
+    Entering a limit only records a deadline on the CPU clock of the thread. On the main thread, one
+    periodic SIGVTALRM timer, armed by the first limit and disarmed once the process has gone a while
+    without any, checks the deadlines every `resolution` seconds and raises in the evaluation which
+    overran. Other threads cannot take signals, so a daemon thread checks their deadlines instead and
+    raises in them asynchronously.
+    A limit which fires is removed right away, along with the limits nested in it: the exception can
+    arrive in CPUTimeLimit.__exit__ before it gets to remove the limit itself.
+    """
+    # Seconds of CPU time between checks; itimers are not much finer than this anyway
+    resolution = 0.001
+    # Checks without any limit before the timer is disarmed
+    idleChecks = 100
+
+    def __init__(self):
+        self.limits = [] # active on the main thread, innermost last
+        self.armed = False
+        self.idle = 0
+        self.threadLimits = {} # thread ident -> active limits of that thread
+        self.watcher = None
+        self.lock = threading.Lock()
+        self.mainThread = threading.main_thread().ident
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.afterFork)
+        # Once the interpreter has restored the default action of SIGVTALRM, the timer would kill the process
+        atexit.register(self.disarm)
+
+    def afterFork(self):
+        # Interval timers and threads do not survive fork
+        self.armed = False
+        self.threadLimits = {}
+        self.watcher = None
+        self.lock = threading.Lock()
+        self.mainThread = threading.main_thread().ident
+
+    def disarm(self):
+        if self.armed and threading.get_ident() == self.mainThread:
+            signal.setitimer(signal.ITIMER_VIRTUAL, 0)
+            self.armed = False
+        self.idle = 0
+
+    def enter(self, limit):
+        ident = threading.get_ident()
+        limit.fired = False
+        limit.deadline = time.thread_time() + limit.timeout
+        if ident == self.mainThread:
+            self.limits.append(limit)
+            if not self.armed:
+                signal.signal(signal.SIGVTALRM, self.check)
+                signal.setitimer(signal.ITIMER_VIRTUAL, self.resolution, self.resolution)
+                self.armed = True
+        else:
+            with self.lock:
+                self.threadLimits.setdefault(ident, []).append(limit)
+                if self.watcher is None:
+                    self.watcher = threading.Thread(target=self.watch, daemon=True)
+                    self.watcher.start()
+
+    def exit(self, limit):
+        ident = threading.get_ident()
+        if ident == self.mainThread:
+            if self.limits and self.limits[-1] is limit: self.limits.pop()
+        else:
+            with self.lock:
+                limits = self.threadLimits.get(ident)
+                if limits and limits[-1] is limit:
+                    limits.pop()
+                    if not limits: del self.threadLimits[ident]
+                if limit.fired:
+                    # Cancels the exception if the evaluation finished before it arrived
+                    ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(ident), None)
+
+    def check(self, _1, _2):
+        """SIGVTALRM handler"""
+        if not self.limits:
+            self.idle += 1
+            if self.idle >= self.idleChecks: self.disarm()
+            return
+        self.idle = 0
+        now = time.thread_time()
+        for k, limit in enumerate(self.limits):
+            if now >= limit.deadline:
+                # Raised once, so that handlers of the exception are not interrupted in turn
+                limit.fired = True
+                del self.limits[k:]
+                raise limit.exception()
+
+    def watch(self):
+        """Body of the thread which checks the deadlines of limits off the main thread"""
+        idle = 0
+        while True:
+            time.sleep(self.resolution)
+            with self.lock:
+                if self.watcher is not threading.current_thread(): return
+                if not self.threadLimits:
+                    idle += 1
+                    if idle >= self.idleChecks:
+                        self.watcher = None
+                        return
+                    continue
+                idle = 0
+                for ident, limits in list(self.threadLimits.items()):
+                    try:
+                        now = time.clock_gettime(time.pthread_getcpuclockid(ident))
+                    except OSError:
+                        continue
+                    for k, limit in enumerate(limits):
+                        if now >= limit.deadline:
+                            limit.fired = True
+                            del limits[k:]
+                            if not limits: del self.threadLimits[ident]
+                            ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(ident),
+                                                                       ctypes.py_object(limit.exception))
+                            break
+
+EVALUATIONWATCHDOG = EvaluationWatchdog()
+
+
+class CPUTimeLimit(object):
+    """
+    with CPUTimeLimit(timeout, exception): ...
+    raises exception() inside the block once it has used more than timeout seconds of CPU time
+    (give or take EvaluationWatchdog.resolution). A timeout of None means no limit.
+    """
+    __slots__ = ["timeout", "exception", "deadline", "fired"]
+
+    def __init__(self, timeout, exception=RunWithTimeout):
+        self.timeout = timeout
+        self.exception = exception
+
+    def __enter__(self):
+        if self.timeout is not None: EVALUATIONWATCHDOG.enter(self)
+        return self
+
+    def __exit__(self, *_):
+        if self.timeout is not None: EVALUATIONWATCHDOG.exit(self)
+        return False
+
+
 def runWithTimeout(k, timeout):
     if timeout is None: return k()
-    def timeoutCallBack(_1,_2):
-        raise RunWithTimeout()
-    signal.signal(signal.SIGPROF, timeoutCallBack)
-    signal.setitimer(signal.ITIMER_PROF, timeout)
-    
-    try:
-        result = k()
-        signal.signal(signal.SIGPROF, lambda *_:None)
-        signal.setitimer(signal.ITIMER_PROF, 0)
-        return result
-    except RunWithTimeout:
-        signal.signal(signal.SIGPROF, lambda *_:None)
-        signal.setitimer(signal.ITIMER_PROF, 0)
-        raise RunWithTimeout()
-    except Exception as e:
-        signal.signal(signal.SIGPROF, lambda *_:None)
-        signal.setitimer(signal.ITIMER_PROF, 0)
-        raise
+    with CPUTimeLimit(timeout, RunWithTimeout):
+        return k()
 
 
 def crossProduct(a, b):
@@ -17,9 +17,8 @@ open Yojson.Basic
 
 
 
-let run_job channel =
+let run_job j =
   let open Yojson.Basic.Util in
-  let j = Yojson.Basic.from_channel channel in
   let request = j |> member "request" |> deserialize_type in
   let timeout = j |> member "timeout" |> to_float in
   let evaluationTimeout =
@@ -56,24 +55,38 @@ let run_job channel =
 
   helmholtz_enumeration ~nc:nc (k ~timeout:evaluationTimeout request (j |> member "extras")) g request ~timeout ~maximumSize
 
+let subsample_job ?maxExamples:(maxExamples=50000) result =
+  let l = List.length result in
+  if l < maxExamples then result else
+    let p = (maxExamples |> Float.of_int)/.(l |> Float.of_int) in
+    result |> List.filter ~f:(fun _ -> Random.float 1. < p)
+
+let job_record ?show_vars:(show_vars=false) (_behavior, (l,ps)) : t =
+  `Assoc([(* "behavior", behavior; *)
+          "ll", `Float(l);
+          "programs", `List(ps |> List.map ~f:(fun p -> `String(p |> string_of_program)));
+          "tokens", `List(ps |> List.map ~f:(fun p -> `String(p |> string_of_tokens show_vars)));
+         ])
+
 let output_job ?maxExamples:(maxExamples=50000) ?show_vars:(show_vars=false) result =
-  let open Yojson.Basic.Util in
-  (* let result = Hashtbl.to_alist result in *)
-  let results =
-    let l = List.length result in
-    if l < maxExamples then result else
-      let p = (maxExamples |> Float.of_int)/.(l |> Float.of_int) in
-      result |> List.filter ~f:(fun _ -> Random.float 1. < p)
-  in
   let message : t =
-    `List(results |> List.map ~f:(fun (behavior, (l,ps)) ->
-        `Assoc([(* "behavior", behavior; *)
-                "ll", `Float(l);
-                "programs", `List(ps |> List.map ~f:(fun p -> `String(p |> string_of_program)));
-                "tokens", `List(ps |> List.map ~f:(fun p -> `String(p |> string_of_tokens show_vars)));
-                ])))
+    `List(subsample_job ~maxExamples result |> List.map ~f:(job_record ~show_vars))
   in
   message
 
+(* One frontier per line, so that the caller can consume them as they come *)
+let stream_job ?maxExamples:(maxExamples=50000) ?show_vars:(show_vars=false) result =
+  subsample_job ~maxExamples result |> List.iter ~f:(fun r ->
+      Out_channel.output_string stdout (job_record ~show_vars r |> to_string);
+      Out_channel.newline stdout);
+  Out_channel.flush stdout
+
 let _ =
-  run_job Pervasives.stdin |> remove_bad_dreams |> output_job |> to_channel Pervasives.stdout
+  let j = Yojson.Basic.from_channel Pervasives.stdin in
+  let stream =
+    try j |> Yojson.Basic.Util.member "stream" |> Yojson.Basic.Util.to_bool
+    with _ -> false
+  in
+  let result = run_job j |> remove_bad_dreams in
+  if stream then stream_job result else
+    result |> output_job |> to_channel Pervasives.stdout
@@ -15,71 +15,60 @@ open Grammar
 open Task
 open FastType
 
-let load_problems channel =
-  let open Yojson.Basic.Util in
-  let j = Yojson.Basic.from_channel channel in
-  let g = j |> member "DSL" in
-  let g =
-    try deserialize_grammar g |> make_dummy_contextual
-    with _ -> deserialize_contextual_grammar g
-  in
-
-  let timeout = try
-      j |> member "programTimeout" |> to_float
-    with _ ->
-      begin
-        let defaultTimeout = 0.1 in
-        Printf.eprintf
-          "\t(ocaml) WARNING: programTimeout not set. Defaulting to %f.\n"
-          defaultTimeout ;
-        defaultTimeout
-      end
-  in
+let load_grammar g =
+  try deserialize_grammar g |> make_dummy_contextual
+  with _ -> deserialize_contextual_grammar g
 
+let load_program_timeout j =
+  let open Yojson.Basic.Util in
+  try
+    j |> member "programTimeout" |> to_float
+  with _ ->
+    begin
+      let defaultTimeout = 0.1 in
+      Printf.eprintf
+        "\t(ocaml) WARNING: programTimeout not set. Defaulting to %f.\n"
+        defaultTimeout ;
+      defaultTimeout
+    end
+
+let rec unpack x =
+  let open Yojson.Basic.Util in
+  try magical (x |> to_int) with _ ->
+  try magical (x |> to_float) with _ ->
+  try magical (x |> to_bool) with _ ->
+  try
+    let v = x |> to_string in
+    if String.length v = 1 then magical v.[0] else magical v
+  with _ ->
+  try
+    x |> to_list |> List.map ~f:unpack |> magical
+  with _ -> raise (Failure "could not unpack")
+
+let load_task ~timeout j =
+  let open Yojson.Basic.Util in
+  let e = j |> member "examples" |> to_list in
+  let task_type = j |> member "request" |> deserialize_type in
+  let examples = e |> List.map ~f:(fun ex -> (ex |> member "inputs" |> to_list |> List.map ~f:unpack,
+                                              ex |> member "output" |> unpack)) in
+  let name = j |> member "name" |> to_string in
+  (try
+     let special = j |> member "specialTask" |> to_string in
+     match special |> Hashtbl.find task_handler with
+     | Some(handler) -> handler (j |> member "extras")
+     | None -> (Printf.eprintf " (ocaml) FATAL: Could not find handler for %s\n" special;
+                exit 1)
+   with _ -> supervised_task) ~timeout:timeout name task_type examples
+
+(* Everything in a request besides the grammar and the tasks *)
+let load_search_parameters j =
+  let open Yojson.Basic.Util in
   (* Automatic differentiation parameters *)
   let maxParameters =
     try j |> member "maxParameters" |> to_int
     with _ -> 99
   in
 
-
-  let rec unpack x =
-    try magical (x |> to_int) with _ ->
-    try magical (x |> to_float) with _ ->
-    try magical (x |> to_bool) with _ ->
-    try
-      let v = x |> to_string in
-      if String.length v = 1 then magical v.[0] else magical v
-    with _ ->
-    try
-      x |> to_list |> List.map ~f:unpack |> magical
-    with _ -> raise (Failure "could not unpack")
-  in
-
-  let tf = j |> member "tasks" |> to_list |> List.map ~f:(fun j ->
-      let e = j |> member "examples" |> to_list in
-      let task_type = j |> member "request" |> deserialize_type in
-      let examples = e |> List.map ~f:(fun ex -> (ex |> member "inputs" |> to_list |> List.map ~f:unpack,
-                                                  ex |> member "output" |> unpack)) in
-      let maximum_frontier = j |> member "maximumFrontier" |> to_int in
-      let name = j |> member "name" |> to_string in
-
-      let task =
-        (try
-           let special = j |> member "specialTask" |> to_string in
-           match special |> Hashtbl.find task_handler with
-           | Some(handler) -> handler (j |> member "extras")
-           | None -> (Printf.eprintf " (ocaml) FATAL: Could not find handler for %s\n" special;
-                      exit 1)
-         with _ -> supervised_task) ~timeout:timeout name task_type examples
-      in
-      (task, maximum_frontier))
-  in
-
-  (* Ensure that all of the tasks have the same type *)
-  (* let most_specific_type = unify_many_types (tf |> List.map ~f:(fun (t,_) -> t.task_type)) in
-   * let tf = tf |> List.map ~f:(fun (t,f) -> ({t with task_type=most_specific_type},f)) in *)
-
   let verbose = try j |> member "verbose" |> to_bool
     with _ -> false
   in
@@ -111,6 +100,28 @@ let load_problems channel =
       j |> member "nc" |> to_int
     with _ -> 1
   in
+  (lowerBound,upperBound,budgetIncrement,
+   maxParameters,
+   nc,timeout,verbose)
+
+let load_problems channel =
+  let open Yojson.Basic.Util in
+  let j = Yojson.Basic.from_channel channel in
+  let g = j |> member "DSL" |> load_grammar in
+  let timeout = load_program_timeout j in
+
+  let tf = j |> member "tasks" |> to_list |> List.map ~f:(fun j ->
+      let maximum_frontier = j |> member "maximumFrontier" |> to_int in
+      (load_task ~timeout:timeout j, maximum_frontier))
+  in
+
+  (* Ensure that all of the tasks have the same type *)
+  (* let most_specific_type = unify_many_types (tf |> List.map ~f:(fun (t,_) -> t.task_type)) in
+   * let tf = tf |> List.map ~f:(fun (t,f) -> ({t with task_type=most_specific_type},f)) in *)
+
+  let (lowerBound,upperBound,budgetIncrement,
+       maxParameters,
+       nc,timeout,verbose) = load_search_parameters j in
   (tf,g,
    lowerBound,upperBound,budgetIncrement,
    maxParameters,
@@ -132,7 +143,59 @@ let export_frontiers number_enumerated tf solutions: string =
 ;;
 
 
+(* Worker mode: one long-lived process answers many enumeration requests.
+   Every message, in either direction, is a decimal byte count on its own line
+   followed by that many bytes of JSON. Grammars and tasks are registered once
+   ({"registerGrammar": id, "DSL": ...} and {"registerTask": id, "task": ..., "programTimeout": ...})
+   and enumeration requests then refer to them by id
+   ({"grammar": id, "tasks": [id...], "maximumFrontiers": [...], ...search parameters}).
+   Only enumeration requests get a response, which is the same JSON as in one-shot mode.
+   The worker exits when its input is closed. *)
+let read_frame () =
+  match Stdlib.input_line Stdlib.stdin with
+  | exception End_of_file -> None
+  | header ->
+    let n = Int.of_string (String.strip header) in
+    Some(Stdlib.really_input_string Stdlib.stdin n |> Yojson.Basic.from_string)
+
+let write_frame s =
+  Printf.printf "%d\n%s" (String.length s) s;
+  Out_channel.flush stdout
+
+let serve_worker () =
+  let open Yojson.Basic.Util in
+  let grammars = Hashtbl.Poly.create() in
+  let tasks = Hashtbl.Poly.create() in
+  let rec loop () =
+    match read_frame () with
+    | None -> ()
+    | Some(j) ->
+      (match (j |> member "registerGrammar", j |> member "registerTask") with
+       | (`Int(i), _) ->
+         Hashtbl.set grammars ~key:i ~data:(j |> member "DSL" |> load_grammar)
+       | (_, `Int(i)) ->
+         let timeout = load_program_timeout j in
+         Hashtbl.set tasks ~key:i ~data:(j |> member "task" |> load_task ~timeout:timeout)
+       | _ ->
+         let g = Hashtbl.find_exn grammars (j |> member "grammar" |> to_int) in
+         let tf = List.map2_exn (j |> member "tasks" |> to_list) (j |> member "maximumFrontiers" |> to_list)
+             ~f:(fun i f -> (Hashtbl.find_exn tasks (i |> to_int), f |> to_int)) in
+         let (lowerBound,upperBound,budgetIncrement,
+              mfp,
+              nc,timeout,verbose) = load_search_parameters j in
+         let solutions, number_enumerated =
+           enumerate_for_tasks ~maxFreeParameters:mfp ~lowerBound:lowerBound ~upperBound:upperBound ~budgetIncrement:budgetIncrement
+             ~verbose:verbose ~nc:nc ~timeout:timeout g tf
+         in
+         export_frontiers number_enumerated tf solutions |> write_frame);
+      loop ()
+  in
+  loop ()
+;;
+
+
 let _ =
+  if Array.exists Sys.argv ~f:(String.equal "--worker") then serve_worker () else
 
   let (tf,g,
        lowerBound,upperBound,budgetIncrement,
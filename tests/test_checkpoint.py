@@ -0,0 +1,128 @@
+import os
+import tempfile
+import unittest
+
+import dill
+import torch
+
+from dreamcoder.checkpoint import CheckpointStore
+from dreamcoder.domains.arithmetic.arithmeticPrimitives import addition, k0, k1
+from dreamcoder.dreamcoder import ECResult, LazyECResult
+from dreamcoder.frontier import Frontier, FrontierEntry, FrontierHistory
+from dreamcoder.grammar import Grammar
+from dreamcoder.program import Program
+from dreamcoder.task import Task
+from dreamcoder.type import arrow, tint
+
+
+class TestCheckpointStore(unittest.TestCase):
+
+    def setUp(self):
+        self.grammar = Grammar.uniform([k0, k1, addition])
+        self.tasks = [Task("t%d" % n, arrow(tint, tint), [((x,), x + n) for x in range(3)])
+                      for n in range(3)]
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "store")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def frontier(self, task, source):
+        return Frontier([FrontierEntry(Program.parse(source), logPrior=-1., logLikelihood=0.)], task=task)
+
+    def iterate(self, result, j):
+        """Mimics what an ecIterator iteration does to an ECResult"""
+        task = self.tasks[j]
+        f = self.frontier(task, "(lambda (+ $0 %s))" % ("1" if j else "0"))
+        result.allFrontiers[task] = f
+        result.recordFrontier(f)
+        result.taskSolutions[task] = f
+        result.tasksAttempted.update(self.tasks[:j + 1])
+        result.searchTimes.append([float(j)])
+        result.grammars.append(self.grammar)
+        result.models = [torch.nn.Linear(2, 2)]
+
+    def test_reconstructs_every_iteration(self):
+        store = CheckpointStore(self.path)
+        result = ECResult(parameters={"iterations": 3})
+        snapshots = []
+        for j in range(3):
+            self.iterate(result, j)
+            store.commit(result, j + 1)
+            snapshots.append((dict(result.allFrontiers), list(result.searchTimes),
+                              result.models[0].weight.detach().clone()))
+
+        # Later iterations do not rewrite what was already stored
+        self.assertFalse(os.path.exists(os.path.join(store.iterationPath(2), "parameters.pickle")))
+        with open(os.path.join(store.iterationPath(3), CheckpointStore.TASKS), "rb") as handle:
+            self.assertEqual(list(dill.load(handle).values()), [self.tasks[2]])
+
+        for j, (allFrontiers, searchTimes, weight) in enumerate(snapshots):
+            loaded = CheckpointStore(self.path).load(j + 1)
+            self.assertIsInstance(loaded, ECResult)
+            self.assertEqual(loaded.searchTimes, searchTimes)
+            self.assertEqual(len(loaded.grammars), j + 1)
+            self.assertEqual(set(loaded.allFrontiers), set(allFrontiers))
+            for t, f in allFrontiers.items():
+                self.assertEqual([e.program for e in loaded.allFrontiers[t]], [e.program for e in f])
+            self.assertEqual(loaded.tasksAttempted, set(self.tasks[:j + 1]))
+            self.assertTrue(torch.equal(loaded.models[0].weight, weight))
+            # Tasks are shared, not copied, between the fields
+            t = self.tasks[0]
+            key = next(k for k in loaded.frontiersOverTime if k == t)
+            self.assertIs(loaded.allFrontiers[key].task, key)
+
+    def test_resume_and_lazy(self):
+        store = CheckpointStore(self.path)
+        result = ECResult()
+        self.iterate(result, 0)
+        store.commit(result, 1)
+
+        store = CheckpointStore(self.path)
+        result = store.load()
+        self.iterate(result, 1)
+        store.commit(result, 2)
+        self.assertEqual(sorted(os.listdir(store.iterationPath(2))),
+                         sorted(["allFrontiers.pickle", "frontiersOverTime.pickle", "grammars.pickle",
+                                 "models.pickle", "recognition.pt", "searchTimes.pickle",
+                                 "taskSolutions.pickle", "tasksAttempted.pickle", "tasks.pickle"]))
+
+        lazy = LazyECResult(self.path)
+        self.assertEqual(lazy.searchTimes, [[0.], [1.]])
+        self.assertNotIn("models", lazy.__dict__)
+        self.assertEqual(sorted(t.name for t in lazy.frontiersOverTime), ["t0", "t1"])
+        self.assertEqual(LazyECResult(self.path, 1).searchTimes, [[0.]])
+        with self.assertRaises(AttributeError): lazy.notAField
+
+
+class TestFrontierHistory(unittest.TestCase):
+
+    def test_records_read_back(self):
+        task = Task("t", arrow(tint, tint), [((1,), 1)])
+        entries = [FrontierEntry(Program.parse(source), logPrior=-float(n), logLikelihood=0.)
+                   for n, source in enumerate(["(lambda $0)", "(lambda (+ $0 0))", "(lambda (+ 0 $0))"])]
+        recorded = [entries[:1], entries[:1], entries[:2], [entries[2], entries[0]], []]
+        history = FrontierHistory()
+        for es in recorded: history.record(Frontier(list(es), task=task))
+        self.assertEqual(len(history.programs), 3)
+        self.assertEqual(history.versions[task][1], None)
+        self.assertEqual(history.versions[task][3][1], 0)
+
+        copy = dill.loads(dill.dumps(history))
+        for h in [history, copy]:
+            self.assertEqual(list(h), [task])
+            self.assertEqual([[(e.program, e.logPrior) for e in f] for f in h[task]],
+                             [[(e.program, e.logPrior) for e in es] for es in recorded])
+            self.assertIs(h[task][2], h.frontierAt(task, 2))
+            self.assertIs(h.frontierAt(task, -1).task, task)
+
+        # Only what was recorded since is written to the next checkpoint
+        size = history.size()
+        history.record(Frontier(entries[1:], task=task))
+        copy.extend(history.since(size))
+        self.assertEqual([e.program for e in copy[task][-1]], [e.program for e in entries[1:]])
+        self.assertEqual(len(copy.programs), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
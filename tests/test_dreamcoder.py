@@ -1,5 +1,8 @@
+import time
 import unittest
 
+from dreamcoder.dreamcoder import ECResult, PhaseTimeline
+
 
 class TestEcModule(unittest.TestCase):
 
@@ -17,5 +20,28 @@ class TestEcModule(unittest.TestCase):
             self.fail('Unable to import ec module')
 
 
+class TestPhaseTimeline(unittest.TestCase):
+
+    def test_background_phases_share_the_budget(self):
+        result = ECResult()
+        timeline = PhaseTimeline(result, 4)
+        returned = []
+        timeline.launch("testing", 0, 3, lambda: (time.sleep(0.2), "done")[1], returned.append)
+        self.assertEqual(timeline.available(), 1)
+        phase = timeline.begin("wake", 0, timeline.available())
+        timeline.end(phase)
+        self.assertEqual(returned, [])
+        timeline.join()
+        self.assertEqual(returned, ["done"])
+        self.assertEqual(timeline.available(), 4)
+        self.assertEqual([(p["phase"], p["CPUs"]) for p in result.phaseTimeline], [("testing", 3), ("wake", 1)])
+        testing, wake = result.phaseTimeline
+        self.assertLess(wake["end"], testing["end"])
+        self.assertGreaterEqual(testing["end"] - testing["start"], 0.2)
+
+        timeline.launch("testing", 1, 1, lambda: 1 // 0, returned.append)
+        with self.assertRaises(ZeroDivisionError): timeline.join()
+
+
 if __name__ == '__main__':
     unittest.main()
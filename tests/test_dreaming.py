@@ -1,5 +1,43 @@
+import json
+import os
+import stat
+import sys
+import tempfile
 import unittest
 
+from dreamcoder.domains.arithmetic.arithmeticPrimitives import addition, k0, k1
+from dreamcoder.grammar import Grammar
+from dreamcoder.task import Task
+from dreamcoder.type import arrow, tint
+
+# Stands in for the helmholtz binary: writes one frontier per line
+FAKE_HELMHOLTZ = """#!%s
+import json, sys
+assert json.load(sys.stdin)["stream"]
+for j in range(50):
+    print(json.dumps({"ll": -float(j), "programs": ["(lambda (+ $0 1))", "(lambda (+ 1 $0))"], "tokens": ["+ $0 1", "+ 1 $0"]}))
+"""
+
+# Stands in for a helmholtz binary built before streaming: writes all of the frontiers as one list
+LEGACY_HELMHOLTZ = """#!%s
+import json, sys
+json.load(sys.stdin)
+print(json.dumps([{"ll": -float(j), "programs": ["(lambda (+ $0 1))"], "tokens": ["+ $0 1"]} for j in range(50)]))
+"""
+
+
+def dream(source, maximum_size):
+    from dreamcoder.dreaming import backgroundHelmholtzEnumeration
+    with tempfile.TemporaryDirectory() as d:
+        executable = os.path.join(d, "helmholtz")
+        with open(executable, "w") as handle:
+            handle.write(source % sys.executable)
+        os.chmod(executable, os.stat(executable).st_mode | stat.S_IEXEC)
+        g = Grammar.uniform([addition, k0, k1])
+        tasks = [Task("t", arrow(tint, tint), [((1,), 2)])]
+        return backgroundHelmholtzEnumeration(tasks, g, 1, executable=executable,
+                                              maximum_size=maximum_size, stream=True)()
+
 
 class TestDreaming(unittest.TestCase):
 
@@ -10,6 +48,19 @@ class TestDreaming(unittest.TestCase):
         except Exception:
             self.fail('Unable to import from dreaming module')
 
+    def test_streaming_reservoir(self):
+        frontiers = dream(FAKE_HELMHOLTZ, 10)
+        self.assertEqual(len(frontiers), 10)
+        self.assertEqual(len({f.task.name for f in frontiers}), 10)
+        # Programs share their common subtrees
+        self.assertEqual(len({id(f.entries[0].program) for f in frontiers}), 1)
+
+    def test_binary_that_does_not_stream(self):
+        frontiers = dream(LEGACY_HELMHOLTZ, 10)
+        self.assertEqual(len(frontiers), 10)
+        self.assertEqual(len({f.task.name for f in frontiers}), 10)
+        self.assertTrue(all(str(f.entries[0].program) == "(lambda (+ $0 1))" for f in frontiers))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,12 +1,20 @@
+import gc
+import io
+import json
+import math
 import random
 import unittest
 from unittest import mock
 
-from dreamcoder.enumeration import multicoreEnumeration
-from dreamcoder.frontier import Frontier
-from dreamcoder.grammar import Grammar
+from dreamcoder.enumeration import multicoreEnumeration, enumerateForTasks, SolverPool, \
+    encodeSearchResult, decodeSearchFrontier, JobSchedule, ResumableEnumerationProcess
+from dreamcoder.frontier import Frontier, FrontierEntry
+from dreamcoder.grammar import EnumerationState, Grammar
+from dreamcoder.likelihoodModel import AllOrNothingLikelihoodModel
+from dreamcoder.domains.arithmetic.arithmeticPrimitives import addition, multiplication, k0, k1
+from dreamcoder.domains.list.listPrimitives import bootstrapTarget
 from dreamcoder.task import Task
-from dreamcoder.type import arrow, tint
+from dreamcoder.type import Context, arrow, tint, tlist, t0
 
 
 def add1():
@@ -57,8 +65,9 @@ class TestEnumerationMain(unittest.TestCase):
         self.assertEqual(frontiers, [])
         self.assertEqual(best_search_time, {})
 
+    @mock.patch('dreamcoder.enumeration.limit_virtual_memory_with_psutil_if_possible')
     @mock.patch('dreamcoder.enumeration.subprocess')
-    def test_multicore_enumeration_single_task(self, mock_subprocess):
+    def test_multicore_enumeration_single_task(self, mock_subprocess, mock_limit_memory):
         mock_process = mock.MagicMock()
         response = '{"add1": []}'.encode('utf-8')
         mock_process.communicate.return_value = (response, None)
@@ -77,8 +86,9 @@ class TestEnumerationMain(unittest.TestCase):
         self.assertIsInstance(best_search_time, dict)
         self.assertEqual([t.name for t in best_search_time.keys()], ['add1'])
 
+    @mock.patch('dreamcoder.enumeration.limit_virtual_memory_with_psutil_if_possible')
     @mock.patch('dreamcoder.enumeration.subprocess')
-    def test_multicore_enumeration_multiple_tasks(self, mock_subprocess):
+    def test_multicore_enumeration_multiple_tasks(self, mock_subprocess, mock_limit_memory):
         mock_process = mock.MagicMock()
         response = '{"add1": [], "add2": []}'.encode('utf-8')
         mock_process.communicate.return_value = (response, None)
@@ -102,8 +112,9 @@ class TestEnumerationMain(unittest.TestCase):
         self.assertIsInstance(best_search_time, dict)
         self.assertEqual([t.name for t in best_search_time.keys()], ['add1', 'add2'])
 
+    @mock.patch('dreamcoder.enumeration.limit_virtual_memory_with_psutil_if_possible')
     @mock.patch('dreamcoder.enumeration.subprocess')
-    def test_multicore_enumeration_invalid_response_error(self, mock_subprocess):
+    def test_multicore_enumeration_invalid_response_error(self, mock_subprocess, mock_limit_memory):
         mock_process = mock.MagicMock()
         response = '{"OOPS": []}'.encode('utf-8')
         mock_process.communicate.return_value = (response, None)
@@ -116,5 +127,259 @@ class TestEnumerationMain(unittest.TestCase):
                 grammar, tasks, maximumFrontier=1, enumerationTimeout=1)
 
 
+class TestSolverPool(unittest.TestCase):
+
+    @mock.patch('dreamcoder.enumeration.limit_virtual_memory_with_psutil_if_possible')
+    @mock.patch('dreamcoder.enumeration.subprocess')
+    def test_solver_pool_registers_once(self, mock_subprocess, mock_limit_memory):
+        response = json.dumps({"add1": [], "number_enumerated": 7}).encode('utf-8')
+        mock_process = mock.MagicMock()
+        mock_process.stdout = io.BytesIO((b"%d\n" % len(response) + response) * 2)
+        mock_process.stdin = io.BytesIO()
+        mock_process.stdin.close = lambda: None
+        mock_subprocess.Popen.return_value = mock_process
+        grammar = Grammar.uniform([])
+        task = get_add1_task()
+        pool = SolverPool()
+        for _ in range(2):
+            frontiers, search_times, pc = pool.solve(
+                g=grammar, tasks=[task], maximumFrontiers={task: 1},
+                lowerBound=0., upperBound=1.5, budgetIncrement=1.5, timeout=1)
+            self.assertTrue(frontiers[task].empty)
+            self.assertIsNone(search_times[task])
+            self.assertEqual(pc, 7)
+        self.assertEqual(mock_subprocess.Popen.call_count, 1)
+        sent = io.BytesIO(mock_process.stdin.getvalue())
+        messages = []
+        for header in iter(sent.readline, b""):
+            messages.append(json.loads(sent.read(int(header))))
+        self.assertEqual(len(messages), 4)
+        self.assertIn("registerGrammar", messages[0])
+        self.assertIn("registerTask", messages[1])
+        self.assertEqual(messages[2]["tasks"], messages[3]["tasks"])
+        pool.close()
+
+
+class TestEnumerationState(unittest.TestCase):
+
+    def test_windows_match_enumeration(self):
+        grammar = Grammar.uniform([addition, multiplication, k0, k1])
+        request = arrow(tint, tint, tint)
+        state = EnumerationState(grammar, request)
+        lowerBound = 0.
+        for upperBound in [1.5, 3., 4.5, 6., 7.5, 9.]:
+            expected = sorted((round(l, 6), str(p)) for l, _, p in grammar.enumeration(
+                Context.EMPTY, [], request, maximumDepth=99,
+                upperBound=upperBound, lowerBound=lowerBound))
+            actual = sorted((round(l, 6), str(p))
+                            for l, _, p in state.advance(upperBound))
+            self.assertEqual(actual, expected)
+            lowerBound = upperBound
+
+    def test_stopping_early_loses_nothing(self):
+        grammar = Grammar.uniform([addition, multiplication, k0, k1])
+        request = arrow(tint, tint)
+        expected = sorted(str(p) for _, _, p in grammar.enumeration(
+            Context.EMPTY, [], request, maximumDepth=99, upperBound=8.))
+        state = EnumerationState(grammar, request)
+        actual = []
+        for l, _, p in state.advance(8.):
+            actual.append(str(p))
+            if len(actual) == 5:
+                break
+        actual += [str(p) for _, _, p in state.advance(8.)]
+        self.assertEqual(sorted(actual), expected)
+
+    def test_collector_runs_while_consuming(self):
+        state = EnumerationState(Grammar.uniform([addition, multiplication, k0, k1]), arrow(tint, tint))
+        self.assertEqual({gc.isenabled() for _ in state.advance(6.)}, {True})
+        programs = state.advance(12.)
+        next(programs)
+        self.assertTrue(gc.isenabled())
+        del programs
+        self.assertTrue(gc.isenabled())
+
+
+class TestCandidateCache(unittest.TestCase):
+
+    def test_cached_candidates_match_uncached(self):
+        grammar = Grammar.uniform(bootstrapTarget())
+        uncached = Grammar.uniform(bootstrapTarget())
+        uncached.candidateCacheSize = 0
+        for request in [arrow(tlist(tint), tlist(tint)), arrow(t0, tlist(t0))]:
+            context, request = request.instantiate(Context.EMPTY)
+            expected = [(l, str(t), str(p)) for l, t, p in uncached.enumeration(
+                context, [], request, maximumDepth=99, upperBound=9.)]
+            actual = [(l, str(t), str(p)) for l, t, p in grammar.enumeration(
+                context, [], request, maximumDepth=99, upperBound=9.)]
+            self.assertEqual(actual, expected)
+        self.assertGreater(grammar.candidateCacheHits, grammar.candidateCacheMisses)
+
+
+class TestLikelihoodSummaryCache(unittest.TestCase):
+
+    def test_cached_summaries_match_uncached(self):
+        random.seed(0)
+        grammar = Grammar.uniform(bootstrapTarget()).randomWeights(lambda l: -3 * random.random())
+        uncached = Grammar(grammar.logVariable, grammar.productions)
+        uncached.summaryCacheSize = 0
+        request = arrow(tlist(tint), tlist(tint))
+        task = Task("t", request, [])
+        programs = [p for p in (grammar.sample(request, maximumDepth=5) for _ in range(50)) if p is not None]
+        frontier = Frontier([FrontierEntry(p, logPrior=0., logLikelihood=0.) for p in programs], task=task)
+        # What logLikelihood computed before summaries were cached
+        expected = {p: grammar.closedLikelihoodSummary(request, p).logLikelihood(grammar) for p in programs}
+        for _ in range(2):
+            for actual in [grammar.rescoreFrontier(frontier), uncached.rescoreFrontier(frontier)]:
+                self.assertEqual(len(actual), len(frontier))
+                for e in actual:
+                    self.assertAlmostEqual(e.logPrior, expected[e.program])
+        self.assertEqual(len(grammar.summaryCache), len(set(programs)))
+        # Grammars that only differ in their weights share the summaries
+        reweighted = grammar.reweighted(0., [0.] * len(grammar.productions))
+        self.assertIs(reweighted.summaryCache, grammar.summaryCache)
+        uniform = Grammar.uniform(bootstrapTarget())
+        for p in programs:
+            self.assertAlmostEqual(reweighted.logLikelihood(request, p),
+                                   uniform.closedLikelihoodSummary(request, p).logLikelihood(uniform))
+
+
+class TestObservationalEquivalence(unittest.TestCase):
+
+    def enumerate(self, tasks, **keywords):
+        grammar = Grammar.uniform(bootstrapTarget())
+        frontiers, _, programs = enumerateForTasks(grammar, tasks, AllOrNothingLikelihoodModel(timeout=1.),
+                                                   timeout=60, evaluationTimeout=1.,
+                                                   lowerBound=0., upperBound=12., budgetIncrement=1.5,
+                                                   maximumFrontiers={t: 10 for t in tasks}, **keywords)
+        return frontiers, programs
+
+    def test_pruning_keeps_best_programs(self):
+        inputs = [[3, 1, 4], [1, 5], [9, 2, 6, 5], [3]]
+        tasks = [Task(name, arrow(tlist(tint), tint), [((x,), f(x)) for x in inputs])
+                 for name, f in [("head", lambda x: x[0]),
+                                 ("head+1", lambda x: x[0] + 1),
+                                 ("length", len)]]
+        expected, _ = self.enumerate(tasks)
+        state = EnumerationState(Grammar.uniform(bootstrapTarget()), tasks[0].request)
+        actual, _ = self.enumerate(tasks, observationalEquivalence=True, enumerationState=state)
+        equivalence = state.observationalEquivalence
+        self.assertGreater(equivalence.pruned, 0)
+        self.assertEqual(len(equivalence.signatures), len(tasks))
+        for t in tasks:
+            self.assertFalse(expected[t].empty)
+            self.assertAlmostEqual(actual[t].bestPosterior.logPosterior, expected[t].bestPosterior.logPosterior)
+            # Every solution to these tasks computes the same thing on their inputs
+            self.assertEqual(len(actual[t]), 1)
+
+
+class TestSearchResultEncoding(unittest.TestCase):
+
+    def test_encoded_results_round_trip(self):
+        tasks = [get_add1_task(), get_add2_task()]
+        frontiers, searchTimes, programs = enumerateForTasks(
+            Grammar.uniform(bootstrapTarget()), tasks, AllOrNothingLikelihoodModel(timeout=1.),
+            timeout=60, upperBound=10., maximumFrontiers={t: 3 for t in tasks})
+        entries, times, count = encodeSearchResult(tasks, (frontiers, searchTimes, programs))
+        self.assertEqual(count, programs)
+        self.assertEqual(times, [searchTimes[t] for t in tasks])
+        parsed = {}
+        for t, e in zip(tasks, entries):
+            decoded = decodeSearchFrontier(t, e, parsed)
+            self.assertIs(decoded.task, t)
+            self.assertEqual([(x.program, x.logPrior, x.logLikelihood, x.tokens) for x in decoded],
+                             [(x.program, x.logPrior, x.logLikelihood, x.tokens) for x in frontiers[t]])
+
+
+class TestJobSchedule(unittest.TestCase):
+
+    @mock.patch("dreamcoder.enumeration.time.time")
+    def test_job_schedule_sizes_windows(self, clock):
+        schedule = JobSchedule()
+        clock.return_value = 0.
+        self.assertEqual(schedule.increment(1, 10.), JobSchedule.initialIncrement)
+        schedule.launched(0, 2., 1)
+        schedule.launched(1, 4., 1, stolen=True)
+        self.assertEqual(schedule.lowerBound, 4.)
+        clock.return_value = 1.
+        schedule.finished(0, 100)
+        # Up to MDL 2 took a second, so up to MDL 6.5 should take about exp(4.5) seconds
+        self.assertAlmostEqual(schedule.increment(1, math.exp(4.5)), 2.5)
+        self.assertEqual(schedule.increment(1, 1e-3), JobSchedule.smallestIncrement)
+        self.assertEqual(schedule.increment(64, 1e3), JobSchedule.largestIncrement)
+        clock.return_value = 2.
+        schedule.finished(1, 300)
+        metrics = schedule.metrics(2., 2)
+        self.assertEqual((metrics["windows"], metrics["stolen"], metrics["programs"]), (2, 1, 400))
+        self.assertAlmostEqual(metrics["utilization"], 0.75)
+
+    @mock.patch("dreamcoder.enumeration.time.time")
+    def test_stolen_windows_stay_within_reach(self, clock):
+        schedule = JobSchedule()
+        clock.return_value = 0.
+        # Nothing is known about how long windows take
+        self.assertFalse(schedule.canSteal(1e9))
+        schedule.launched(0, 2., 1)
+        clock.return_value = 1.
+        schedule.finished(0, 10)
+        # A window from MDL 2 to 2 + w takes about exp(w) seconds
+        self.assertTrue(schedule.canSteal(math.exp(1.5)))
+        self.assertFalse(schedule.canSteal(math.exp(0.5)))
+        self.assertEqual(schedule.increment(1, math.exp(0.5)), JobSchedule.smallestIncrement)
+        for ID in range(1, JobSchedule.maximumRunning + 1):
+            schedule.launched(ID, schedule.lowerBound + 1., 1, stolen=True)
+        self.assertFalse(schedule.canSteal(1e9))
+
+    def test_single_job_is_timed(self):
+        # With one job each window runs before launch returns
+        task = Task("unsolvable", arrow(tint, tint), [((x,), -7) for x in range(4)])
+        jobMetrics = {}
+        multicoreEnumeration(Grammar.uniform([addition, multiplication, k0, k1]), [task], solver="python",
+                             CPUs=1, enumerationTimeout=2, evaluationTimeout=1., maximumFrontier=1,
+                             jobMetrics=jobMetrics)
+        metrics, = jobMetrics.values()
+        self.assertGreater(metrics["windows"], 1)
+        self.assertGreater(metrics["CPUSeconds"], 1.)
+        self.assertGreater(metrics["utilization"], 0.5)
+
+    def test_finished_jobs_release_their_search_state(self):
+        tasks = [Task("unsolvable", arrow(tint, tint, tint), [((x, y), -7) for x in range(2) for y in range(2)]),
+                 Task("plus", arrow(tint, tint), [((x,), x + 1) for x in range(4)])]
+        closed = []
+        close = ResumableEnumerationProcess.close
+        def record(process):
+            closed.append(process.request)
+            close(process)
+        with mock.patch.object(ResumableEnumerationProcess, "close", autospec=True, side_effect=record):
+            multicoreEnumeration(Grammar.uniform([addition, k0, k1]), tasks, solver="python", CPUs=2,
+                                 enumerationTimeout=3, evaluationTimeout=1., maximumFrontier=1,
+                                 resumableEnumeration=True)
+        # The solved job lets go of its process without waiting for the other one to time out
+        self.assertEqual(closed, [tasks[1].request, tasks[0].request])
+
+
+class TestEnsembleEnumeration(unittest.TestCase):
+
+    def test_ensemble_shares_frontiers(self):
+        tasks = [Task("plus", arrow(tint, tint), [((x,), x + 1) for x in range(4)]),
+                 Task("square", arrow(tint, tint), [((x,), x * x) for x in range(4)])]
+        members = [Grammar.uniform([addition, k0, k1]), Grammar.uniform([multiplication, k0, k1])]
+        memberSearchTimes = []
+        jobMetrics = {}
+        frontiers, searchTimes = multicoreEnumeration(members, tasks, solver="python", CPUs=2,
+                                                      enumerationTimeout=30, evaluationTimeout=1.,
+                                                      maximumFrontier=1, memberSearchTimes=memberSearchTimes,
+                                                      jobMetrics=jobMetrics)
+        self.assertTrue(all(not f.empty for f in frontiers))
+        self.assertTrue(all(searchTimes[t] is not None for t in tasks))
+        self.assertEqual([[m[t] is not None for t in tasks] for m in memberSearchTimes], [[True, False], [False, True]])
+        # One job per member, and neither keeps searching for the task that the other one solved:
+        # on its own, the addition grammar would search for square up to an MDL of about 25 in this time
+        self.assertEqual(set(jobMetrics), {(g, tasks[0].request) for g in members})
+        for metrics in jobMetrics.values():
+            self.assertLessEqual(metrics["windows"], 4)
+            self.assertLess(metrics["lowerBound"], 12.)
+
+
 if __name__ == '__main__':
     unittest.main()
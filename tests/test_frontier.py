@@ -0,0 +1,47 @@
+import random
+import unittest
+
+from dreamcoder.domains.list.listPrimitives import bootstrapTarget_extra
+from dreamcoder.frontier import Frontier, FrontierEntry
+from dreamcoder.grammar import Grammar
+from dreamcoder.task import Task
+from dreamcoder.type import arrow, tint, tlist
+
+
+class TestFrontier(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(0)
+        grammar = Grammar.uniform(bootstrapTarget_extra())
+        self.request = arrow(tlist(tint), tlist(tint))
+        programs = {str(p): p for p in (grammar.sample(self.request, maximumDepth=5) for _ in range(300))
+                    if p is not None}
+        self.priors = {p: -float(random.randint(1, 10)) for p in programs.values()}
+        self.task = Task("t", self.request, [])
+
+    def frontier(self):
+        programs = random.sample(list(self.priors), random.randint(0, 6))
+        return Frontier([FrontierEntry(p, logPrior=self.priors[p], logLikelihood=0.) for p in programs],
+                        task=self.task)
+
+    def test_combine_and_topK_stay_sorted(self):
+        def key(e): return (-e.logPosterior, str(e.program))
+        kept = Frontier([], task=self.task)
+        for _ in range(200):
+            new = self.frontier()
+            expected = sorted({str(e.program): e for f in [kept, new] for e in f}.values(), key=key)[:4]
+            kept = kept.combine(new).topK(4)
+            self.assertTrue(kept.isSorted)
+            self.assertEqual([key(e) for e in kept], [key(e) for e in expected])
+            if expected: self.assertIs(kept.bestPosterior, kept.entries[0])
+        # Frontiers that are not sorted still combine into the same programs
+        unsorted = Frontier(list(reversed(kept.entries)), task=self.task)
+        self.assertFalse(unsorted.isSorted)
+        self.assertEqual(unsorted.bestPosterior, kept.bestPosterior)
+        new = self.frontier()
+        self.assertEqual(sorted(str(e.program) for e in unsorted.combine(new)),
+                         sorted(str(e.program) for e in kept.combine(new)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -19,6 +19,27 @@ class TestLogoMain(unittest.TestCase):
         except Exception:
             self.fail('Unable to import logo module')
 
+    def test_batched_features_match_single_task_features(self):
+        import numpy as np
+        import torch
+        from dreamcoder.domains.logo.logoPrimitives import turtle
+        from dreamcoder.domains.logo.main import LogoFeatureCNN
+        from dreamcoder.task import Task
+        from dreamcoder.type import arrow
+
+        torch.manual_seed(0)
+        np.random.seed(0)
+        extractor = LogoFeatureCNN([])
+        tasks = []
+        for n in range(3):
+            t = Task("image %d" % n, arrow(turtle, turtle), [])
+            t.highresolution = list(np.random.randint(0, 256, 128*128))
+            tasks.append(t)
+        features = extractor.featuresOfTasks(tasks)
+        self.assertEqual(tuple(features.shape), (len(tasks), extractor.outputDimensionality))
+        for t, f in zip(tasks, features):
+            self.assertTrue(torch.allclose(f, extractor.featuresOfTask(t), atol=1e-5))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,110 @@
+import gc
+import random
+import unittest
+import weakref
+
+from dreamcoder.domains.list.listPrimitives import bootstrapTarget_extra
+from dreamcoder.grammar import Grammar
+from dreamcoder.program import Program, ProgramCompiler, ProgramInterner, COMPILEDPROGRAMS
+from dreamcoder.type import arrow, tint, tlist
+
+
+class TestProgramCompiler(unittest.TestCase):
+
+    def setUp(self):
+        self.grammar = Grammar.uniform(bootstrapTarget_extra())
+
+    def apply(self, f, xs):
+        try:
+            for x in xs: f = f(x)
+            return f
+        except Exception as e:
+            return type(e)
+
+    def test_compiled_programs_agree_with_evaluate(self):
+        random.seed(0)
+        request = arrow(tlist(tint), tint, tlist(tint))
+        inputs = [([random.randint(0, 9) for _ in range(random.randint(0, 6))], random.randint(0, 4))
+                  for _ in range(5)]
+        for _ in range(300):
+            p = self.grammar.sample(request, maximumDepth=6)
+            if p is None: continue
+            compiled = ProgramCompiler().compile(p)
+            for xs in inputs:
+                self.assertEqual(self.apply(compiled(), xs), self.apply(p.evaluate([]), xs), str(p))
+
+    def test_free_variables_and_inventions(self):
+        double = Program.parse("#(lambda (+ $0 $0))")
+        p = Program.parse("(lambda (map #(lambda (+ $0 $0)) $0))")
+        self.assertEqual(p.runWithArguments([[1, 2]]), [2, 4])
+        self.assertEqual(ProgramCompiler().compile(double)()(3), 6)
+        with self.assertRaises(IndexError): ProgramCompiler().compile(Program.parse("(+ $0 1)"))()
+        # Too deep for the Python parser: falls back to evaluate
+        deep = Program.parse("(lambda %s$0%s)" % ("(+ 1 " * 300, ")" * 300))
+        self.assertEqual(ProgramCompiler().compile(deep)()(0), 300)
+
+    def test_compiled_once_run_repeatedly(self):
+        p = Program.parse("(lambda (if (empty? $0) 0 (car $0)))")
+        first = p.compile()
+        self.assertIs(p.compile(), p.compile())
+        self.assertIsNot(first, p.compile())
+        self.assertEqual(p.runWithArguments([[]]), 0)
+        self.assertEqual(p.runWithArguments([[5, 6]]), 5)
+
+    def test_uncompilable_programs_are_freed(self):
+        deep = Program.parse("(lambda %s$0%s)" % ("(+ 1 " * 300, ")" * 300))
+        for _ in range(Program.compileThreshold + 1):
+            self.assertEqual(deep.runWithArguments([0]), 300)
+        self.assertIn(id(deep), COMPILEDPROGRAMS)
+        dead = weakref.ref(deep)
+        key = id(deep)
+        del deep
+        gc.collect()
+        self.assertIsNone(dead())
+        self.assertNotIn(key, COMPILEDPROGRAMS)
+
+
+
+class TestProgramInterner(unittest.TestCase):
+
+    def setUp(self):
+        bootstrapTarget_extra()
+        self.interner = ProgramInterner()
+
+    def test_equal_subtrees_are_shared(self):
+        p = self.interner.parse("(lambda (+ (car $0) (car $0)))")
+        q = self.interner.parse("(lambda (cons (car $0) empty))")
+        self.assertIs(p.body.f.x, p.body.x)
+        self.assertIs(p.body.x, q.body.f.x)
+        self.assertIs(self.interner.parse("(lambda (+ (car $0) (car $0)))"), p)
+
+    def test_interned_programs_equal_parsed_programs(self):
+        for s in ["(lambda (+ (car $0) (car $0)))", "(lambda (lambda (map (lambda (+ $0 $1)) $1)))",
+                  "(lambda (#(lambda (+ $0 1)) (length $0)))", "$2"]:
+            p = self.interner.parse(s)
+            self.assertEqual(p, Program.parse(s))
+            self.assertEqual(hash(p), hash(Program.parse(s)))
+            self.assertEqual(str(p), s)
+
+    def test_kinds_of_node_do_not_collide(self):
+        body = self.interner.parse("(+ $0 1)")
+        nodes = [self.interner.abstraction(body), self.interner.invented(body),
+                 self.interner.index(0), self.interner.index(1),
+                 self.interner.application(body, body), self.interner.application(body.f, body.x),
+                 self.interner.application(body.x, body.f)]
+        self.assertEqual([str(n) for n in nodes],
+                         ["(lambda (+ $0 1))", "#(+ $0 1)", "$0", "$1", "(+ $0 1 (+ $0 1))", "(+ $0 1)",
+                          "(1 (+ $0))"])
+        self.assertIs(nodes[5], body)
+        self.assertEqual(len({id(n) for n in nodes}), len(nodes))
+
+    def test_unused_nodes_are_freed(self):
+        p = self.interner.parse("(lambda (lambda (map (lambda (+ $0 $1)) $1)))")
+        self.assertGreater(len(self.interner), 0)
+        del p
+        gc.collect()
+        self.assertEqual(len(self.interner), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
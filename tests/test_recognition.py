@@ -1,5 +1,14 @@
 import unittest
 
+import torch
+
+from dreamcoder.frontier import Frontier, FrontierEntry
+from dreamcoder.grammar import Grammar
+from dreamcoder.domains.arithmetic.arithmeticPrimitives import addition, multiplication, k0, k1
+from dreamcoder.program import Program
+from dreamcoder.task import Task
+from dreamcoder.type import arrow, tint
+
 
 class TestRecognition(unittest.TestCase):
 
@@ -9,6 +18,149 @@ class TestRecognition(unittest.TestCase):
         except Exception:
             self.fail('Unable to import from recognition module')
 
+    def test_batch_loss_matches_single_frontier_loss(self):
+        from dreamcoder.recognition import RecognitionModel, RandomFeatureExtractor
+
+        grammar = Grammar.uniform([addition, multiplication, k0, k1])
+        request = arrow(tint, tint)
+        programs = ["(lambda (+ $0 1))", "(lambda (* $0 $0))", "(lambda (+ (* $0 1) 0))"]
+        torch.manual_seed(0)
+        for contextual in [False, True]:
+            model = RecognitionModel(example_encoder=RandomFeatureExtractor([]), grammar=grammar,
+                                     contextual=contextual, rank=4)
+            features = {}
+            model.encode_features = lambda t: features.setdefault(t.name, torch.randn(1))
+            frontiers = [model.replaceProgramsWithLikelihoodSummaries(
+                Frontier([FrontierEntry(Program.parse(p), logPrior=0., logLikelihood=-float(i))
+                          for i, p in enumerate(programs[:n])],
+                         task=Task("task %d" % n, request, []))) for n in range(1, len(programs) + 1)]
+            losses, _, kept = model.frontiersBatchLoss(frontiers, biasOptimal=True)
+            self.assertEqual(kept, [0, 1, 2])
+            for frontier, loss in zip(frontiers, losses):
+                expected, _ = model.frontierBiasOptimal(frontier)
+                self.assertAlmostEqual(loss.item(), expected.item(), places=4)
+
+    def test_contextual_batched_log_likelihoods(self):
+        from dreamcoder.recognition import ContextualGrammarNetwork, ContextualGrammarNetwork_LowRank, \
+            ContextualGrammarNetwork_Mask
+        from dreamcoder.grammar import ContextualGrammar
+
+        grammar = Grammar.uniform([addition, multiplication, k0, k1])
+        request = arrow(tint, tint)
+        programs = ["(lambda (+ $0 1))", "(lambda (* $0 (+ 1 0)))", "(lambda $0)", "(lambda (+ (* $0 1) $0))"]
+        summaries = [ContextualGrammar.fromGrammar(grammar).closedLikelihoodSummary(request, Program.parse(p))
+                     for p in programs]
+        torch.manual_seed(0)
+        for network in [ContextualGrammarNetwork(3, grammar), ContextualGrammarNetwork_LowRank(3, grammar, 4),
+                        ContextualGrammarNetwork_Mask(3, grammar)]:
+            xs = torch.randn(len(programs), 3)
+            for _ in range(2): # the second time round uses the compiled summaries
+                lls = network.batchedLogLikelihoods(xs, summaries)
+                for b, summary in enumerate(summaries):
+                    self.assertAlmostEqual(lls[b].item(), summary.logLikelihood(network(xs[b])).item(), places=4)
+            lls.sum().backward()
+
+    def test_batched_grammars_of_tasks(self):
+        from dreamcoder.recognition import RecognitionModel, DummyFeatureExtractor
+
+        class NameFeatureExtractor(DummyFeatureExtractor):
+            """Fixed features for each task, one task at a time"""
+            def featuresOfTask(self, t):
+                return None if t.name == "none" else torch.tensor([float(len(t.name)), 1.])
+            featuresOfTasks = property() # hides the batched version
+
+        grammar = Grammar.uniform([addition, multiplication, k0, k1])
+        tasks = [Task(n, arrow(tint, tint), []) for n in ["a", "bb", "none", "dddd"]]
+        extractor = NameFeatureExtractor([])
+        extractor.outputDimensionality = 2
+        for contextual in [False, True]:
+            for mask in [False, True]:
+                model = RecognitionModel(example_encoder=extractor, grammar=grammar, contextual=contextual,
+                                         mask=mask, hidden=[4])
+                grammars = model.untorchedGrammarsOfTasks(tasks, batchSize=2)
+                self.assertEqual([t.name for t in grammars], ["a", "bb", "dddd"])
+                for t, g in grammars.items():
+                    self.assertEqual(str(g), str(model.grammarOfTask(t).untorch()))
+
+    def test_frozen_features_are_cached(self):
+        from dreamcoder.recognition import RecognitionModel
+
+        class CountingExtractor(torch.nn.Module):
+            def __init__(self):
+                super(CountingExtractor, self).__init__()
+                self.linear = torch.nn.Linear(1, 2)
+                self.outputDimensionality = 2
+                self.calls = 0
+            def featuresOfTask(self, t):
+                self.calls += 1
+                return self.linear(torch.tensor([float(len(t.name))]))
+
+        grammar = Grammar.uniform([addition, multiplication, k0, k1])
+        tasks = [Task(n, arrow(tint, tint), []) for n in ["a", "bb"]]
+        extractor = CountingExtractor()
+        model = RecognitionModel(example_encoder=extractor, grammar=grammar, hidden=[4])
+        model.encode_features(tasks[0]); model.encode_features(tasks[0])
+        self.assertEqual(extractor.calls, 2) # trainable: never cached
+
+        for parameter in extractor.parameters(): parameter.requires_grad = False
+        for _ in range(3):
+            features, kept = model.encode_features_batch(tasks)
+            first = model.encode_features(tasks[0])
+        self.assertEqual(extractor.calls, 4)
+        self.assertTrue(torch.equal(first, features[0]))
+        # A task with the same name is still a different task
+        model.encode_features(Task("a", arrow(tint, tint), []))
+        self.assertEqual(extractor.calls, 5)
+
+        extractor.load_state_dict(CountingExtractor().state_dict())
+        self.assertFalse(torch.equal(model.encode_features(tasks[0]), first))
+        self.assertEqual(extractor.calls, 6)
+
+    def test_recurrent_features_of_tasks_match_one_at_a_time(self):
+        from dreamcoder.recognition import RecurrentFeatureExtractor
+        from dreamcoder.type import tlist
+
+        request = arrow(tlist(tint), tlist(tint))
+        tasks = [Task("reverse", request, [((x,), x[::-1]) for x in [[1, 2, 3], [4], [5, 6]]]),
+                 Task("empty", request, []),
+                 Task("double", request, [((x,), x + x) for x in [[7, 8], [], [9, 0, 1, 2]]]),
+                 Task("tail", request, [(([3, 1, 4],), [1, 4])])]
+        torch.manual_seed(0)
+        extractor = RecurrentFeatureExtractor(tasks=tasks, lexicon=list(range(10)), H=8, bidirectional=True)
+        features = extractor.featuresOfTasks(tasks)
+        self.assertIsNone(features[1])
+        for t, f in zip(tasks, features):
+            if f is not None:
+                self.assertTrue(torch.allclose(f, extractor.featuresOfTask(t), atol=1e-5), t.name)
+
+    def test_subsampled_features_are_not_cached(self):
+        from dreamcoder.recognition import RecurrentFeatureExtractor, cachedFeaturesOfTasks
+        from dreamcoder.type import tlist
+
+        request = arrow(tlist(tint), tlist(tint))
+        tasks = [Task("few", request, [((x,), x[::-1]) for x in [[1, 2], [3]]]),
+                 Task("many", request, [((x,), x[::-1]) for x in [[1, 2], [3], [4, 5, 6]]])]
+        extractor = RecurrentFeatureExtractor(tasks=tasks, lexicon=list(range(10)), H=8, bidirectional=True)
+        extractor.MAXINPUTS = 2
+        for parameter in extractor.parameters(): parameter.requires_grad = False
+        cachedFeaturesOfTasks(extractor, tasks)
+        # Every call encodes a different sample of the examples of the second task
+        self.assertIsNotNone(extractor.featureCache.lookup(tasks[0], extractor.featureCache.version))
+        self.assertIsNone(extractor.featureCache.lookup(tasks[1], extractor.featureCache.version))
+
+    def test_parallel_helmholtz_samples_match_sequential(self):
+        import random
+        from dreamcoder.recognition import RecognitionModel, RandomFeatureExtractor
+
+        grammar = Grammar.uniform([addition, multiplication, k0, k1])
+        model = RecognitionModel(example_encoder=RandomFeatureExtractor([]), grammar=grammar)
+        samples = {}
+        for CPUs in [1, 3]:
+            random.seed(0)
+            samples[CPUs] = [str(f.entries[0].program)
+                             for f in model.sampleManyHelmholtz([arrow(tint, tint)], 20, CPUs)]
+        self.assertEqual(samples[1], samples[3])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,5 +1,13 @@
+import os
+import tempfile
 import unittest
 
+from dreamcoder.domains.arithmetic.arithmeticPrimitives import addition, k0, k1, subtraction
+from dreamcoder.grammar import Context, Grammar, SymmetryRules, violatesSymmetry
+from dreamcoder.program import Program
+from dreamcoder.task import Task
+from dreamcoder.type import arrow, tint
+
 
 class TestSymmetryBreaking(unittest.TestCase):
 
@@ -10,5 +18,59 @@ class TestSymmetryBreaking(unittest.TestCase):
             self.fail('Unable to import from symmetryBreaking module')
 
 
+class TestSymmetryRules(unittest.TestCase):
+
+    def setUp(self):
+        self.grammar = Grammar.uniform([k0, k1, addition, subtraction])
+        self.tasks = [Task("t", arrow(tint, tint), [((x,), x) for x in [0, 1, 3, 7]])]
+
+    def test_builtin_rules(self):
+        car, plus, minus = Program.parse("car"), Program.parse("+"), Program.parse("-")
+        self.assertTrue(violatesSymmetry(car, Program.parse("(cons 1 empty)"), 0))
+        self.assertTrue(violatesSymmetry(plus, Program.parse("0"), 0))
+        self.assertTrue(violatesSymmetry(plus, Program.parse("(+ 1)"), 1))
+        self.assertFalse(violatesSymmetry(plus, Program.parse("(+ 1 1)"), 0))
+        self.assertFalse(violatesSymmetry(minus, Program.parse("0"), 0))
+
+    def test_mine_and_install(self):
+        rules = SymmetryRules.mine(self.grammar, self.tasks)
+        self.assertTrue(rules.violates("+", "0", 0))
+        self.assertTrue(rules.violates("-", "0", 1))
+        self.assertFalse(rules.violates("-", "0", 0))
+        # Only one orientation of an associative operator is forbidden
+        self.assertFalse(rules.violates("+", "+", 0) and rules.violates("+", "+", 1))
+
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "rules.json")
+            rules.save(path)
+            loaded = SymmetryRules.load(path)
+        self.assertEqual(loaded.rules, rules.rules)
+        self.assertEqual(loaded.primitives, ["+", "-", "0", "1"])
+
+        def count():
+            return sum(1 for _ in self.grammar.enumeration(Context.EMPTY, [], arrow(tint, tint), 10.))
+        active = SymmetryRules.active
+        try:
+            SymmetryRules.active = SymmetryRules()
+            unpruned = count()
+            loaded.install()
+            self.assertLess(count(), unpruned)
+            self.assertTrue(SymmetryRules.active.violates("car", "cons", 0))
+        finally:
+            SymmetryRules.active = active
+
+    def test_mining_respects_builtin_rules(self):
+        self.assertTrue(SymmetryRules.mine(self.grammar, self.tasks).violates("+", "1", 1))
+        builtin = SymmetryRules.BUILTIN
+        try:
+            # (+ 1 x) is the only program no bigger than (+ x 1) computing the same thing,
+            # so once it is forbidden (+ x 1) has to stay
+            SymmetryRules.BUILTIN = SymmetryRules([("+", 0, "1")])
+            rules = SymmetryRules.mine(self.grammar, self.tasks)
+        finally:
+            SymmetryRules.BUILTIN = builtin
+        self.assertFalse(rules.violates("+", "1", 1))
+
+
 if __name__ == '__main__':
     unittest.main()
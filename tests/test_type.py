@@ -0,0 +1,49 @@
+import pickle
+import unittest
+
+from dreamcoder.type import Context, TypeConstructor, TypeVariable, arrow, tbool, tint, tlist
+
+
+class TestContext(unittest.TestCase):
+
+    def test_extend_is_persistent(self):
+        k = Context.EMPTY
+        contexts = []
+        for j in range(100):
+            k, _ = k.makeVariable()
+            k = k.extend(j, tint if j % 2 else tbool)
+            contexts.append(k)
+        for j, k in enumerate(contexts):
+            self.assertEqual(len(k), j + 1)
+            self.assertEqual(k.lookup(j), tint if j % 2 else tbool)
+            self.assertIsNone(k.lookup(j + 1))
+        self.assertEqual(len(Context.EMPTY), 0)
+
+    def test_unify_and_pickle(self):
+        k = Context(2, [])
+        k = k.unify(TypeVariable(0), tlist(TypeVariable(1)))
+        k = k.unify(TypeVariable(1), tint)
+        k = k.unify(TypeVariable(-1), arrow(tint, tbool))
+        self.assertEqual(TypeVariable(0).apply(k), tlist(tint))
+        self.assertEqual(TypeVariable(-1).apply(k), arrow(tint, tbool))
+        k = pickle.loads(pickle.dumps(k))
+        self.assertEqual(sorted(v for v, _ in k.substitution), [-1, 0, 1])
+        self.assertEqual(TypeVariable(0).apply(k), tlist(tint))
+
+
+class TestTypePickling(unittest.TestCase):
+
+    def test_types_from_before_slots(self):
+        # Types used to be pickled as their __dict__
+        v = TypeVariable.__new__(TypeVariable)
+        v.__setstate__({"v": 3, "isPolymorphic": True})
+        t = TypeConstructor.__new__(TypeConstructor)
+        t.__setstate__({"name": "list", "arguments": [v], "isPolymorphic": True})
+        self.assertEqual(t, tlist(TypeVariable(3)))
+        self.assertTrue(t.isPolymorphic)
+        self.assertFalse(hasattr(t, "__dict__"))
+        self.assertEqual(pickle.loads(pickle.dumps(t)), t)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import os
+import threading
+import unittest
+from unittest import mock
+
+from dreamcoder.program import Primitive
+from dreamcoder.task import Task
+from dreamcoder.type import arrow, tint
+from dreamcoder.utilities import EVALUATIONWATCHDOG, Broadcast, CPUTimeLimit, RunWithTimeout, WorkerPool, callFork, parallelIMap, \
+    parallelMap, runWithTimeout
+
+
+FORKEDSTATE = None
+
+
+def spin(*_):
+    while True: pass
+
+
+class TestCPUTimeLimit(unittest.TestCase):
+
+    def test_run_with_timeout(self):
+        self.assertEqual(runWithTimeout(lambda: 1, 0.01), 1)
+        self.assertEqual(runWithTimeout(lambda: 1, None), 1)
+        with self.assertRaises(RunWithTimeout): runWithTimeout(spin, 0.01)
+
+    def test_nested_limits(self):
+        class Outer(Exception): pass
+        with self.assertRaises(Outer):
+            with CPUTimeLimit(0.02, Outer):
+                with CPUTimeLimit(10., RunWithTimeout):
+                    spin()
+
+    def test_task_check(self):
+        loop = Primitive("spin-forever", arrow(tint, tint), spin)
+        task = Task("t", arrow(tint, tint), [((1,), 1), ((2,), 2)])
+        self.assertFalse(task.check(loop, 0.01))
+
+    def test_threads(self):
+        outcomes = []
+        def worker():
+            try:
+                runWithTimeout(spin, 0.02)
+            except RunWithTimeout:
+                outcomes.append("timed out")
+            # Nothing arrives once the evaluation is over
+            outcomes.append(sum(range(10**6)))
+        thread = threading.Thread(target=worker)
+        thread.start()
+        thread.join(10)
+        self.assertEqual(outcomes, ["timed out", sum(range(10**6))])
+
+    def test_limit_firing_on_exit_is_removed(self):
+        exit = EVALUATIONWATCHDOG.exit
+        def interrupted(limit):
+            # The timer goes off before exit gets to remove the limit
+            EVALUATIONWATCHDOG.check(None, None)
+            exit(limit)
+        with mock.patch.object(EVALUATIONWATCHDOG, "exit", side_effect=interrupted):
+            with self.assertRaises(RunWithTimeout):
+                with CPUTimeLimit(0.):
+                    pass
+        self.assertEqual(EVALUATIONWATCHDOG.limits, [])
+
+
+class TestWorkerPool(unittest.TestCase):
+
+    def test_workers_are_reused(self):
+        offset = 3
+        self.assertEqual(parallelMap(3, lambda x, y: x * y + offset, list(range(20)), list(range(20))),
+                         [x * x + 3 for x in range(20)])
+        pool = WorkerPool.shared()
+        pids = {w["pid"] for w in pool.workers}
+        self.assertEqual(len(pids), 3)
+        self.assertEqual(list(parallelIMap(2, lambda x: x + offset, list(range(7)))), list(range(3, 10)))
+        self.assertEqual({w["pid"] for w in pool.workers}, pids)
+        # Each call sees its own function and data
+        self.assertEqual(parallelMap(3, lambda x: -x, [1, 2]), [-1, -2])
+
+    def test_failures_and_nesting(self):
+        with self.assertRaises(Exception):
+            parallelMap(2, lambda x: 1 // (x - 3), list(range(6)))
+        self.assertEqual(parallelMap(2, lambda x: sum(parallelMap(2, lambda y: y, list(range(x)))), [3, 4]), [3, 6])
+        self.assertEqual(callFork(lambda a, b=0: a + b, 1, b=2), 3)
+
+    def test_memory_sensitive_maps_fork(self):
+        pool = WorkerPool.shared()
+        pool.close()
+        self.assertEqual(parallelMap(2, lambda x: 2 * x, list(range(4)), maxtasksperchild=1), [0, 2, 4, 6])
+        self.assertEqual(parallelMap(2, lambda x: x + 1, list(range(4)), memorySensitive=True), [1, 2, 3, 4])
+        self.assertEqual(pool.workers, [])
+
+    def test_broadcast(self):
+        table = Broadcast(list(range(1000)))
+        pool = WorkerPool.shared()
+        for offset in range(3):
+            self.assertEqual(parallelMap(2, lambda j: table.value[j] + offset, [1, 10, 100]),
+                             [1 + offset, 10 + offset, 100 + offset])
+        self.assertEqual([len(w["broadcasts"]) for w in pool.workers], [1] * len(pool.workers))
+        table.release()
+        self.assertEqual(pool.broadcasts, {})
+        self.assertEqual([w["broadcasts"] for w in pool.workers], [set()] * len(pool.workers))
+
+    def test_call_fork_sees_current_state(self):
+        global FORKEDSTATE
+        FORKEDSTATE = 1
+        parallelMap(2, lambda x: x, [1, 2])
+        FORKEDSTATE = 2
+        self.assertEqual(callFork(lambda: (FORKEDSTATE, os.getppid())), (2, os.getpid()))
+        with self.assertRaises(Exception):
+            callFork(lambda: 1 // 0)
+
+
+if __name__ == '__main__':
+    unittest.main()